@@ -0,0 +1,118 @@
+""" Сравнение времени и выделений памяти при отрисовке графика с прогнозом:
+старый вариант (pyplot + seaborn, новая фигура на каждый запрос) и шаблон
+из src/chart.py.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_chart.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+from chart import render_forecast
+from strings_ru import *
+
+REPEATS = 30
+
+
+def make_result(days=31):
+    rng = np.random.default_rng(0)
+    base = 300 + np.cumsum(rng.normal(0, 10, days))
+    return pd.DataFrame({
+        'date': pd.date_range('2021-05-01', periods=days),
+        'result': base.astype(np.float32),
+        'min': base - 150,
+        'mean': base - 20,
+        'max': base + 200,
+    })
+
+
+def render_legacy(result):
+    fig, ax = plt.subplots(figsize=(12, 6))
+    sns.lineplot(data=result, y='result', x='date', label=PREDICTED_VALUE,
+                 ax=ax, linewidth=5)
+    sns.lineplot(data=result, y='min', x='date', label=HISTORY_MIN,
+                 linestyle='dashed', ax=ax, linewidth=3)
+    sns.lineplot(data=result, y='mean', x='date', label=HISTORY_MEAN,
+                 linestyle='dotted', ax=ax, linewidth=3)
+    sns.lineplot(data=result, y='max', x='date', label=HISTORY_MAX,
+                 linestyle='dashed', ax=ax, linewidth=3)
+    orig_ylim = ax.get_ylim()
+    ax.fill_between(result['date'], result['result'], alpha=0.2)
+    ax.set_ylim(orig_ylim)
+    plt.grid()
+    plt.legend()
+    plt.xticks(result['date'], labels=[x + 1 for x in range(result.shape[0])])
+    plt.xlabel('май')
+    plt.ylabel(WATER_LEVEL)
+    plt.suptitle('р.Подкаменная Тунгуска - с.Ванавара')
+    plt.title(PREDICT_TITLE.format('май', 2021))
+    xlim = ax.get_xlim()
+    xmargin = (xlim[1] - xlim[0]) * -0.045
+    ax.set_xlim(xlim[0] - xmargin, xlim[1] + xmargin)
+    with BytesIO() as img:
+        plt.savefig(img, format='png')
+        plt.close()
+        return img.getvalue()
+
+
+def render_template(result, **kwargs):
+    return render_forecast(result['date'].dt.day.to_numpy(),
+                           result['result'].to_numpy(),
+                           result['min'].to_numpy(),
+                           result['mean'].to_numpy(),
+                           result['max'].to_numpy(),
+                           suptitle='р.Подкаменная Тунгуска - с.Ванавара',
+                           title=PREDICT_TITLE.format('май', 2021),
+                           xlabel='май', **kwargs)
+
+
+def measure(name, func, result):
+    func(result)  # прогрев
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        png = func(result)
+    elapsed = (time.perf_counter() - start) / REPEATS
+
+    tracemalloc.start()
+    func(result)
+    snapshot = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+
+    print(f'{name:<28} {elapsed * 1000:8.1f} мс  '
+          f'пик {peak / 1024:8.0f} КБ  блоков {blocks:7d}  '
+          f'png {len(png) / 1024:5.0f} КБ')
+    return elapsed, peak
+
+
+def main():
+    result = make_result()
+    legacy_time, legacy_peak = measure('pyplot + seaborn', render_legacy,
+                                       result)
+    variants = {
+        'шаблон': {},
+        'шаблон, dpi=72': {'dpi': 72},
+        'шаблон, dpi=72, сжатие=1': {'dpi': 72, 'compress_level': 1},
+    }
+    for name, kwargs in variants.items():
+        elapsed, peak = measure(
+            name, lambda df: render_template(df, **kwargs), result)
+        print(f'{"":<28} ускорение x{legacy_time / elapsed:.1f}, '
+              f'память x{legacy_peak / peak:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+""" Время и пиковая память формирования датасета для обучения: построчное
+формирование (как до training.dataset.build_train_data - по постам, через
+FeatureEncoder.encode) и векторизованное build_train_data, в том числе на
+синтетических данных с большим числом постов и лет.
+
+Синтетические данные формируются во временной папке копированием таблиц
+weather и water_level: посты - с новыми uid, годы - со сдвигом дат на 28 лет
+назад (календарь и високосные годы совпадают). Данные репозитория не меняются.
+Пиковая память измеряется tracemalloc (память numpy и pandas учитывается).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_dataset.py --scales 1x1 10x1 1x10 10x10
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+import pandas as pd
+
+from utils import *
+from predict import FeatureEncoder
+from training.dataset import TRAIN_COLUMNS, build_train_data
+
+CALENDAR_YEARS = 28  # через 28 лет календарь повторяется
+
+
+def build_train_data_rows(encoder):
+    """ Построчное формирование датасета, как до векторизации """
+    weather = read_table(DATA_WEATHER, is_raw=True)
+    water_level = read_table(DATA_WATER_LEVEL, is_raw=True)
+
+    df = weather.merge(water_level, on=['uid', 'date'], how='left').dropna()
+    df = df.sort_values(['uid', 'date'], kind='stable')
+
+    parts = []
+    for uid, post_df in df.groupby('uid', sort=False):
+        weather_data = [[date.strftime('%Y-%m-%d'), latitude, longitude,
+                         temperature, weather, is_fallback_data]
+                        for date, latitude, longitude, temperature, weather,
+                        is_fallback_data in zip(
+                            post_df['date'], post_df['latitude'],
+                            post_df['longitude'], post_df['temperature'],
+                            post_df['weather'], post_df['is_fallback_data'])]
+        dates, features = encoder.encode(uid, weather_data)
+        part = pd.DataFrame(features, columns=FeatureEncoder.FEATURES)
+        part.insert(0, 'date', pd.to_datetime(dates))
+        part['water_level'] = post_df['water_level'].to_numpy()
+        parts.append(part)
+
+    result = pd.concat(parts, ignore_index=True)
+    snow = result['weather_snow']
+    rain = result['weather_v3_rain']
+    storm = result['weather_v3_storm']
+    result['weather_v1_precip'] = np.fmax(np.fmax(snow, rain), storm)
+    result['weather_v2_rain'] = np.fmax(rain, storm)
+    result['weather_v4'] = rain + 2 * storm + 3 * snow
+    return result[TRAIN_COLUMNS]
+
+
+def scale_table(df, posts, years):
+    """ Таблица с posts копиями постов и years копиями лет """
+    parts = []
+    for k in range(posts):
+        for j in range(years):
+            part = df.copy()
+            if k:
+                part['uid'] = (part['uid'].astype(int) + 100000 * k) \
+                    .astype(str)
+            if j:
+                part['date'] -= pd.DateOffset(years=CALENDAR_YEARS * j)
+            parts.append(part)
+    return pd.concat(parts, ignore_index=True)
+
+
+def measure(func):
+    """ (результат, время в с, пиковая память в МБ) """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', nargs='+', default=['1x1', '10x1', '1x10'],
+                        help='во сколько раз больше постов и лет: '
+                             '<посты>x<годы>')
+    parser.add_argument('--skip-rows', action='store_true',
+                        help='не измерять построчное формирование')
+    args = parser.parse_args()
+
+    root = os.getcwd()
+    weather = read_table(DATA_WEATHER, is_raw=True)
+    water_level = read_table(DATA_WATER_LEVEL, is_raw=True)
+    encoder = FeatureEncoder.load()
+    tmp_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp_dir, 'data', 'raw'))
+    os.chdir(tmp_dir)
+    try:
+        for scale in args.scales:
+            posts, years = map(int, scale.split('x'))
+            write_table(DATA_WEATHER, scale_table(weather, posts, years),
+                        is_raw=True)
+            write_table(DATA_WATER_LEVEL,
+                        scale_table(water_level, posts, years), is_raw=True)
+
+            (df, _), elapsed, peak = measure(build_train_data)
+            print(f'{scale:>6}: {len(df):9} строк')
+            print(f'  {"build_train_data":24} {elapsed:7.2f} с '
+                  f'{peak:8.0f} МБ')
+            if not args.skip_rows:
+                expected, rows_elapsed, rows_peak = measure(
+                    lambda: build_train_data_rows(encoder))
+                print(f'  {"построчно":24} {rows_elapsed:7.2f} с '
+                      f'{rows_peak:8.0f} МБ  x{rows_elapsed / elapsed:.1f}')
+                # с исходными данными нормализация совпадает с
+                # normalization_info.json
+                if posts == years == 1:
+                    pd.testing.assert_frame_equal(df, expected,
+                                                  check_exact=True)
+                    print('  датасеты совпадают')
+                del expected
+            del df
+    finally:
+        os.chdir(root)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+""" Проверка и замер формирования признаков для модели: старый вариант
+(_prepare_dataframe на pandas с чтением normalization_info.json на каждый
+вызов) и FeatureEncoder из src/predict.py.
+
+Признаки и предсказания модели сравниваются побитово для всех постов
+за несколько лет из кэша Gismeteo (в т.ч. високосных).
+
+Запуск из корня репозитория:
+    python benchmarks/bench_features.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import minmax_scale
+
+from utils import *
+from gismeteo_parse import get_weather_data
+from predict import Predictor
+
+CHECK_YEARS = [2008, 2012, 2016, 2017]
+REPEATS = 200
+
+
+def prepare_dataframe_legacy(uid, weather_data):
+    columns = ['date', 'latitude', 'longitude', 'temperature', 'weather',
+               'is_fallback_data']
+    df = pd.DataFrame(weather_data, columns=columns)
+    df.insert(0, 'uid', uid)
+
+    norm_info = open_file(DATA_NORMALIZATION, is_raw=True)
+    norm_info = json.loads(norm_info)
+    for row in norm_info:
+        df.loc[len(df), df.columns] = row
+
+    df['date'] = df['date'].astype('datetime64[ns]')
+
+    total_years = np.where(df['date'].dt.is_leap_year, 366, 365)
+    df['year'] = df['date'].dt.year
+    df['day_sin'] = np.sin(
+        2 * np.pi * df['date'].dt.dayofyear / total_years)
+    df['day_cos'] = np.cos(
+        2 * np.pi * df['date'].dt.dayofyear / total_years)
+
+    df['weather_snow'] = df['weather'].map(
+        {'clear': 0, 'rain': 0, 'storm': 0, 'snow': 1})
+    df['weather_v3_rain'] = df['weather'].map(
+        {'clear': 0, 'rain': 1, 'storm': 0, 'snow': 0})
+    df['weather_v3_storm'] = df['weather'].map(
+        {'clear': 0, 'rain': 0, 'storm': 1, 'snow': 0})
+
+    df = df.drop(['weather'], axis=1)
+
+    columns_to_scale = ['uid', 'temperature', 'year', 'latitude',
+                        'longitude']
+    df[columns_to_scale] = minmax_scale(df[columns_to_scale])
+
+    df = df[:-2]
+    return df
+
+
+def check_equivalence(posts, predictor):
+    encoder = predictor.encoder
+    checked = 0
+    for uid, post in posts.items():
+        for year in CHECK_YEARS:
+            for month in range(1, 13):
+                weather_data = get_weather_data(post, year, month)
+                if not weather_data:
+                    continue
+                legacy = prepare_dataframe_legacy(uid, weather_data)
+                dates, features = encoder.encode(uid, weather_data)
+
+                legacy_features = legacy.drop(['date'], axis=1)
+                assert list(legacy_features.columns) == encoder.FEATURES
+                legacy_features = legacy_features.to_numpy(dtype=np.float32)
+                assert np.array_equal(legacy_features, features,
+                                      equal_nan=True), (uid, year, month)
+                assert np.array_equal(
+                    legacy['date'].to_numpy().astype('datetime64[D]'), dates)
+
+                legacy_predict = predictor.model.predict(
+                    legacy.drop(['date'], axis=1))
+                assert np.array_equal(legacy_predict,
+                                      predictor.model.predict(features))
+                checked += 1
+    print(f'Проверено месяцев: {checked}, признаки и предсказания совпадают')
+
+
+def measure(name, func):
+    func()
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func()
+    elapsed = (time.perf_counter() - start) / REPEATS
+    print(f'{name:<24} {elapsed * 1e6:10.1f} мкс')
+    return elapsed
+
+
+def main():
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    predictor = Predictor(posts, backend='sklearn')
+    predictor.preload()
+    check_equivalence(posts, predictor)
+
+    uid = '09386'
+    weather_data = get_weather_data(posts[uid], 2016, 5)
+    legacy = measure('_prepare_dataframe',
+                     lambda: prepare_dataframe_legacy(uid, weather_data))
+    encoder = measure('FeatureEncoder.encode',
+                      lambda: predictor.encoder.encode(uid, weather_data))
+    print(f'ускорение x{legacy / encoder:.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+""" Время этапов обработчика прогноза (main.predict) и всего обработчика при
+одновременных запросах. Результаты (p50/p95/p99 в мс) сохраняются в JSON для
+сравнения между коммитами.
+
+Бот работает с локальными заглушками (benchmarks/fake_services.py):
+- Telegram Bot API - обработчик отправляет графики и получает file_id, как
+  при работе с Telegram;
+- сайт Gismeteo - отдаёт страницы из html-кэша data\\raw\\gismeteo\\.
+
+Расчёт выполняется во временной папке с моделью, постами и статистикой
+уровня воды репозитория, но без html-кэша и хранилищ метео-данных и
+предсказаний, поэтому первая загрузка метео-данных месяца - промах кэша с
+запросом к заглушке Gismeteo, а предсказания рассчитываются моделью.
+Ограничение частоты запросов к Gismeteo (HOST_RATES) для заглушки не
+действует.
+
+Этапы:
+- check_callback_date - разбор callback_data;
+- get_weather_data_miss / get_weather_data_hit - метео-данные за месяц
+  с загрузкой с заглушки Gismeteo / из хранилища метео-данных;
+- encode_features - FeatureEncoder.encode;
+- model_predict - предсказание модели (--backend);
+- water_stats_merge - статистика уровня воды по дням и таблица результата;
+- chart_render / chart_encode - обновление шаблона и отрисовка графика /
+  кодирование PNG;
+- render_chart - отрисовка с кодированием, как в боте.
+
+Нагрузка: --requests запросов прогноза по постам за LOAD_MONTHS от
+--concurrency одновременных пользователей. Перед каждым уровнем нагрузки кэш
+графиков очищается: первый запрос месяца поста строит график (miss),
+повторные отправляют file_id (hit). Метео-данные загружены заранее.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_hot_paths.py --output bench_hot_paths.json
+    python benchmarks/bench_hot_paths.py --baseline bench_hot_paths.json
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from PIL import Image
+from telegram import Bot, Update
+from telegram.utils.request import Request
+
+from utils import *
+import gismeteo_parse
+import main as bot
+from chart import CHART_COMPRESS_LEVEL, get_template
+from chart_cache import CHARTS_DIR
+from forecast import get_month_name, render_chart, setup_locale
+from gismeteo_parse import get_weather_data, is_gismeteo_cached
+from runtime import ForecastRuntime, RUNTIME_CONCURRENCY, RUNTIME_PROCESSES
+from strings_ru import PREDICT_TITLE
+from fake_services import CHAT_ID, FAKE_BOT_TOKEN, FakeTelegramApi
+from fake_services import GismeteoStub
+
+YEAR = 2016  # год из html-кэша (бот предсказывает с PREDICT_START_YEAR)
+STAGE_MONTHS = [1, 5]
+LOAD_MONTHS = [4, 8]
+LOAD_REQUESTS = 200
+LOAD_CONCURRENCY = [1, 4, 16]
+PERCENTILES = [50, 95, 99]
+STUB_RATE = 1000  # запросов в секунду к заглушке Gismeteo
+SEED = 0
+STAGES = ['check_callback_date', 'get_weather_data_miss',
+          'get_weather_data_hit', 'encode_features', 'model_predict',
+          'water_stats_merge', 'chart_render', 'chart_encode', 'render_chart']
+# данные, копируемые во временную папку
+DATA_FILES = [(DATA_POSTS_FULL_RAW, True), (DATA_NORMALIZATION, True),
+              (DATA_WATER_STATS, False)]
+
+
+def measure(func, *args):
+    """ (результат, время в мс) """
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def summarize(times):
+    """ Число замеров, среднее, перцентили и максимум, мс """
+    if not times:
+        return {'count': 0}
+    times = np.asarray(times)
+    result = {'count': len(times), 'mean': round(float(times.mean()), 3)}
+    for p in PERCENTILES:
+        result[f'p{p}'] = round(float(np.percentile(times, p)), 3)
+    result['max'] = round(float(times.max()), 3)
+    return result
+
+
+def make_update(tg_bot, callback_data, update_id):
+    """ Update с нажатием inline-кнопки, как его присылает Telegram """
+    return Update.de_json({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(CHAT_ID),
+            'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'Bench'},
+            'data': callback_data,
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': CHAT_ID, 'type': 'private'},
+                        'text': ''}}}, tg_bot)
+
+
+def draw_chart(post, year, month, result):
+    """ render_chart без кодирования PNG: обновление шаблона и отрисовка """
+    template = get_template()
+    template.update(result['date'].dt.day.to_numpy(),
+                    result['result'].to_numpy(), result['min'].to_numpy(),
+                    result['mean'].to_numpy(), result['max'].to_numpy(),
+                    suptitle=post['name'],
+                    title=PREDICT_TITLE.format(get_month_name(month).lower(),
+                                               year),
+                    xlabel=get_month_name(month))
+    template.canvas.draw()
+    return template
+
+
+def encode_png(template):
+    """ Кодирование уже отрисованного графика в PNG, как в savefig """
+    canvas = template.canvas
+    image = Image.frombuffer('RGBA', canvas.get_width_height(),
+                             canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    with BytesIO() as img:
+        image.save(img, format='png', compress_level=CHART_COMPRESS_LEVEL)
+        return img.getvalue()
+
+
+def bench_stages(tg_bot, predictor, keys):
+    samples = {stage: [] for stage in STAGES}
+    for i, (uid, year, month) in enumerate(keys):
+        post = bot.posts_info[uid]
+        update = make_update(tg_bot, f'{uid}-{year}-{month}', i)
+        _, ms = measure(bot.check_callback_date, update)
+        samples['check_callback_date'].append(ms)
+
+        # город мог быть загружен для другого поста
+        stage = 'get_weather_data_hit' if is_gismeteo_cached(
+            post, year, month) else 'get_weather_data_miss'
+        _, ms = measure(get_weather_data, post, year, month)
+        samples[stage].append(ms)
+        weather_data, ms = measure(get_weather_data, post, year, month)
+        samples['get_weather_data_hit'].append(ms)
+
+        (dates, features), ms = measure(predictor.encoder.encode, uid,
+                                        weather_data)
+        samples['encode_features'].append(ms)
+        predict, ms = measure(predictor.model.predict, features)
+        samples['model_predict'].append(ms)
+        result, ms = measure(predictor._form_result, uid, dates, predict)
+        samples['water_stats_merge'].append(ms)
+        if result.empty:
+            continue
+
+        template, ms = measure(draw_chart, post, year, month, result)
+        samples['chart_render'].append(ms)
+        _, ms = measure(encode_png, template)
+        samples['chart_encode'].append(ms)
+        _, ms = measure(render_chart, post, year, month, result)
+        samples['render_chart'].append(ms)
+    return {stage: summarize(times) for stage, times in samples.items()}
+
+
+def reset_chart_cache():
+    bot.chart_cache = None
+    shutil.rmtree(get_filepath(CHARTS_DIR, is_raw=False), ignore_errors=True)
+
+
+def bench_load(tg_bot, telegram, keys, concurrency, requests):
+    """ Время обработчика main.predict при concurrency одновременных
+    запросах
+    """
+    rng = random.Random(SEED)
+    chosen = [rng.choice(keys) for _ in range(requests)]
+    context = SimpleNamespace(bot=tg_bot)
+    reset_chart_cache()
+    chart_cache = bot.get_chart_cache()
+    uploads = telegram.uploads
+
+    def handle(item):
+        i, (uid, year, month) = item
+        is_hit = chart_cache.get_file_id(
+            uid, year, month,
+            chart_cache.get_version(uid, year, month)) is not None
+        update = make_update(tg_bot, f'{uid}-{year}-{month}', i)
+        _, ms = measure(bot.predict, update, context)
+        return is_hit, ms
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(handle, enumerate(chosen)))
+    elapsed = time.perf_counter() - start
+    return {'concurrency': concurrency,
+            'requests': requests,
+            'throughput': round(requests / elapsed, 2),  # запросов в секунду
+            'uploads': telegram.uploads - uploads,
+            'all': summarize([ms for _, ms in results]),
+            'hit': summarize([ms for is_hit, ms in results if is_hit]),
+            'miss': summarize([ms for is_hit, ms in results if not is_hit])}
+
+
+def get_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_workdir(root, tmp_dir):
+    """ Модель, посты и статистика уровня воды во временной папке """
+    shutil.copytree(os.path.join(root, 'models'),
+                    os.path.join(tmp_dir, 'models'))
+    for file_name, is_raw in DATA_FILES:
+        src_path = get_filepath(file_name, is_raw)
+        dst_path = os.path.join(tmp_dir, os.path.relpath(src_path, root))
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        shutil.copy(src_path, dst_path)
+
+
+def print_comparison(report, baseline):
+    """ Отношение p50 и p95 к результатам baseline (>1 - медленнее) """
+    rows = [(stage, report['stages'][stage], baseline['stages'].get(stage))
+            for stage in report['stages']]
+    baseline_load = {load['concurrency']: load for load in baseline['load']}
+    rows += [(f"handler x{load['concurrency']}", load['all'],
+              baseline_load.get(load['concurrency'], {}).get('all'))
+             for load in report['load']]
+    print(f"Сравнение с {baseline.get('commit')}:")
+    for name, current, previous in rows:
+        if not previous or not previous.get('count') or not current['count']:
+            continue
+        ratios = '  '.join(f"p{p} x{current[f'p{p}'] / previous[f'p{p}']:.2f}"
+                           for p in [50, 95])
+        print(f'  {name:24} {ratios}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Время этапов и обработчика прогноза')
+    parser.add_argument('--requests', type=int, default=LOAD_REQUESTS,
+                        help='число запросов на каждом уровне нагрузки')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=LOAD_CONCURRENCY,
+                        help='числа одновременных запросов')
+    parser.add_argument('--processes', type=int, default=RUNTIME_PROCESSES,
+                        help='число процессов ForecastRuntime, 0 - потоки')
+    parser.add_argument('--backend', choices=PREDICT_BACKEND_NAMES,
+                        default=PREDICT_BACKEND)
+    parser.add_argument('--telegram-delay', type=float, default=0,
+                        help='задержка ответа Telegram Bot API, мс')
+    parser.add_argument('--gismeteo-delay', type=float, default=0,
+                        help='задержка ответа Gismeteo, мс')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline',
+                        help='JSON с результатами для сравнения')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    root = os.getcwd()
+    fixtures_dir = get_filepath('gismeteo', is_raw=True)
+    tmp_dir = tempfile.mkdtemp()
+    prepare_workdir(root, tmp_dir)
+    telegram = FakeTelegramApi(delay=args.telegram_delay / 1000).start()
+    gismeteo = GismeteoStub(fixtures_dir,
+                            delay=args.gismeteo_delay / 1000).start()
+    gismeteo_parse.GISMETEO_URL = gismeteo.url
+    HOST_RATES['127.0.0.1'] = STUB_RATE
+
+    os.chdir(tmp_dir)
+    runtime = None
+    try:
+        setup_locale()
+        bot.load_posts()
+        bot.year_list.append(YEAR)
+        bot.predict_backend = args.backend
+        tg_bot = Bot(FAKE_BOT_TOKEN, base_url=telegram.base_url,
+                     request=Request(con_pool_size=max(args.concurrency)))
+        predictor = bot.get_predictor()
+        predictor.preload()
+
+        uids = sorted(bot.posts_info)
+        stages = bench_stages(tg_bot, predictor,
+                              [(uid, YEAR, month) for month in STAGE_MONTHS
+                               for uid in uids])
+
+        load_keys = [(uid, YEAR, month) for month in LOAD_MONTHS
+                     for uid in uids]
+        for uid, year, month in load_keys:
+            get_weather_data(bot.posts_info[uid], year, month)
+        runtime = ForecastRuntime(bot.posts_info, bot.get_predictor,
+                                  processes=args.processes,
+                                  concurrency=RUNTIME_CONCURRENCY,
+                                  backend=args.backend)
+        runtime.start()
+        runtime.preload()
+        bot.runtime = runtime
+        load = [bench_load(tg_bot, telegram, load_keys, concurrency,
+                           args.requests)
+                for concurrency in args.concurrency]
+    finally:
+        if runtime is not None:
+            runtime.stop()
+        telegram.stop()
+        gismeteo.stop()
+        os.chdir(root)
+        shutil.rmtree(tmp_dir)
+
+    report = {'commit': get_commit(),
+              'created': datetime.now().isoformat(timespec='seconds'),
+              'params': {'year': YEAR,
+                         'posts': len(uids),
+                         'stage_months': STAGE_MONTHS,
+                         'load_months': LOAD_MONTHS,
+                         'processes': args.processes,
+                         'runtime_concurrency': RUNTIME_CONCURRENCY,
+                         'backend': args.backend,
+                         'telegram_delay': args.telegram_delay,
+                         'gismeteo_delay': args.gismeteo_delay,
+                         'gismeteo_requests': gismeteo.requests,
+                         'cpu_count': os.cpu_count()},
+              'stages': stages,
+              'load': load}
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            file.write(text)
+        for stage, summary in stages.items():
+            if summary['count']:
+                print(f"{stage:24} p50 {summary['p50']:8.2f}  "
+                      f"p95 {summary['p95']:8.2f}  "
+                      f"p99 {summary['p99']:8.2f} мс")
+        for result in load:
+            summary = result['all']
+            print(f"{'handler x' + str(result['concurrency']):24} "
+                  f"p50 {summary['p50']:8.2f}  p95 {summary['p95']:8.2f}  "
+                  f"p99 {summary['p99']:8.2f} мс, "
+                  f"{result['throughput']:.1f} запросов/с")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, mode='r', encoding='utf-8') as file:
+            print_comparison(report, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+""" Сравнение способов расчёта предсказаний модели (PREDICT_BACKENDS из
+src/predict.py): время одного вызова для месяца (28-31 строка) и
+совпадение результата с XGBRegressor.predict на признаках из pandas
+DataFrame, как в исходной версии бота.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_inference.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+import pandas as pd
+
+from utils import *
+from gismeteo_parse import get_weather_data
+from predict import FeatureEncoder, PREDICT_BACKENDS
+
+CHECK_YEARS = [2008, 2012, 2016, 2017]
+REPEATS = 500
+
+
+def load_months(posts, encoder):
+    """ Матрицы признаков за все месяцы CHECK_YEARS из кэша Gismeteo """
+    result = []
+    for uid, post in posts.items():
+        for year in CHECK_YEARS:
+            for month in range(1, 13):
+                weather_data = get_weather_data(post, year, month)
+                if weather_data:
+                    result.append(encoder.encode(uid, weather_data)[1])
+    return result
+
+
+def measure(func):
+    func()
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        func()
+    return (time.perf_counter() - start) / REPEATS
+
+
+def main():
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    encoder = FeatureEncoder.load()
+    months = load_months(posts, encoder)
+    backends = {name: backend.load()
+                for name, backend in PREDICT_BACKENDS.items()}
+
+    sklearn = backends['sklearn']
+    expected = [sklearn.predict(pd.DataFrame(features,
+                                             columns=encoder.FEATURES))
+                for features in months]
+    features = months[len(months) // 2]
+    frame = pd.DataFrame(features, columns=encoder.FEATURES)
+    baseline = measure(lambda: sklearn.predict(frame))
+    print(f'Месяцев: {len(months)}, строк в замере: {len(features)}')
+    print(f"{'способ':<20} {'мкс/вызов':>10} {'ускорение':>10} "
+          f"{'макс. отклонение':>17} {'совпадает':>10}")
+    print(f"{'sklearn (DataFrame)':<20} {baseline * 1e6:10.1f} {1:>10}")
+
+    for name, backend in backends.items():
+        diff = 0.0
+        is_equal = True
+        for month, month_expected in zip(months, expected):
+            result = backend.predict(month)
+            diff = max(diff, float(np.max(np.abs(result - month_expected))))
+            is_equal &= np.array_equal(result, month_expected)
+        elapsed = measure(lambda: backend.predict(features))
+        print(f'{name:<20} {elapsed * 1e6:10.1f} {baseline / elapsed:10.1f} '
+              f'{diff:17.2e} {"да" if is_equal else "нет":>10}')
+
+
+if __name__ == '__main__':
+    main()
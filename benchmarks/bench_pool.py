@@ -0,0 +1,77 @@
+""" Время построения тепловой карты прогноза по всем постам подбассейна
+(forecast.compute_pool_chart: один вызов модели и одна отрисовка) в сравнении
+с построением графиков по каждому посту отдельно.
+
+Завершается с кодом 1, если медианное время построения тепловой карты
+превышает --budget мс - карта строится на лету при запросе пользователя.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_pool.py
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+
+from utils import *
+from forecast import compute_chart, compute_pool_chart, get_pool_uids
+from forecast import warm_up
+from predict import Predictor
+
+POOL_BUDGET = 500  # мс
+YEAR = 2016
+MONTHS = [1, 4, 5, 8]
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Время построения тепловой карты подбассейна')
+    parser.add_argument('--budget', type=float, default=POOL_BUDGET,
+                        help='допустимое медианное время, мс')
+    parser.add_argument('--output', help='сохранить тепловую карту в png')
+    args = parser.parse_args()
+
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    predictor = Predictor(posts)
+    warm_up(predictor)
+
+    pool_times = []
+    for subpool_id in sorted({post['subpool_id'] for post in posts.values()}):
+        uids = get_pool_uids(posts, subpool_id)
+        for month in MONTHS:
+            predictor.predict_many([(uid, YEAR, month) for uid in uids])
+            pool_time = measure(compute_pool_chart, predictor, subpool_id,
+                                YEAR, month)
+            single_time = sum(measure(compute_chart, predictor, uid, YEAR,
+                                      month) for uid in uids)
+            pool_times.append(pool_time)
+            print(f'{subpool_id} {YEAR}-{month:02d}: {len(uids)} постов, '
+                  f'тепловая карта {pool_time:6.1f} мс, графики по постам '
+                  f'{single_time:7.1f} мс')
+
+    median = float(np.median(pool_times))
+    print(f'Тепловая карта: медиана {median:.1f} мс, '
+          f'максимум {max(pool_times):.1f} мс, бюджет {args.budget:.0f} мс')
+
+    if args.output:
+        with open(args.output, mode='wb') as file:
+            file.write(compute_pool_chart(predictor, subpool_id, YEAR,
+                                          MONTHS[-1]))
+
+    if median > args.budget:
+        print('Превышен бюджет времени построения тепловой карты')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+""" Сравнение расчёта предсказаний по одному месяцу (Predictor.predict) и
+пакетом (Predictor.predict_many) для всех постов за год, с проверкой
+совпадения результатов.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_predict_many.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pandas as pd
+
+from utils import *
+from predict import Predictor
+
+YEAR = 2016
+
+
+def main():
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    predictor = Predictor(posts)
+    predictor.preload()
+    keys = [(uid, YEAR, month) for uid in posts for month in range(1, 13)]
+    predictor.predict_many(keys)  # метео-данные в кэше
+
+    start = time.perf_counter()
+    single = {key: predictor.predict(*key) for key in keys}
+    single_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    many = predictor.predict_many(keys)
+    many_time = time.perf_counter() - start
+
+    for key in keys:
+        pd.testing.assert_frame_equal(single[key], many[key])
+    print(f'Месяцев: {len(keys)}, результаты совпадают')
+    print(f'predict      {single_time * 1000:8.1f} мс')
+    print(f'predict_many {many_time * 1000:8.1f} мс')
+    print(f'ускорение x{single_time / many_time:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+""" Длительная нагрузка на обработчики прогноза (main.predict и
+main.predict_pool) для проверки того, что память бота не растёт.
+
+Бот работает с локальными заглушками Telegram Bot API и Gismeteo
+(benchmarks/fake_services.py) во временной папке, как в bench_hot_paths.py.
+Кэш графиков отключён, поэтому каждый запрос рассчитывает прогноз и рисует
+график. Запросы выбираются случайно из всех постов (и подбассейнов, доля
+--pool-share) за все месяцы YEAR, первые --warmup запросов загружают
+метео-данные и заполняют кэши и не учитываются в росте памяти.
+
+Каждые --sample-every запросов записывается резидентная память (RSS)
+основного процесса и суммарная память процессов расчёта. Результат - рост
+памяти после прогрева и его скорость в МБ на 1000 запросов; при росте
+больше --max-growth МБ скрипт завершается с кодом 1. С --memory-limit
+процессы расчёта перезапускаются MemoryWatchdog, как в боте.
+
+Запуск из корня репозитория (Linux):
+    python benchmarks/bench_soak.py --requests 10000 --output bench_soak.json
+"""
+import argparse
+import gc
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import numpy as np
+from telegram import Bot
+from telegram.utils.request import Request
+
+from utils import *
+import gismeteo_parse
+import main as bot
+from chart_cache import ChartCache
+from forecast import setup_locale
+from memory import MemoryWatchdog, format_top_allocations, get_rss
+from runtime import ForecastRuntime, RUNTIME_CONCURRENCY, RUNTIME_PROCESSES
+from bench_hot_paths import STUB_RATE, YEAR, get_commit, make_update
+from bench_hot_paths import prepare_workdir
+from fake_services import FAKE_BOT_TOKEN, FakeTelegramApi, GismeteoStub
+
+SOAK_REQUESTS = 10000
+SOAK_CONCURRENCY = 4
+SOAK_WARMUP = 1000
+SOAK_SAMPLE_EVERY = 500
+SOAK_POOL_SHARE = 0.05
+SOAK_MAX_GROWTH = 50  # МБ
+SEED = 0
+
+
+class UncachedChartCache(ChartCache):
+    """ Кэш графиков без попаданий: каждый запрос строит график """
+
+    def get_file_id(self, uid, year, month, version):
+        return None
+
+    def get_png(self, uid, year, month, version):
+        return None
+
+
+def measure_memory(runtime):
+    """ RSS основного процесса и сумма RSS процессов расчёта, МБ """
+    workers = [get_rss(pid) for pid in runtime.worker_pids().values()]
+    return (get_rss() / 2 ** 20,
+            sum(rss for rss in workers if rss is not None) / 2 ** 20)
+
+
+def get_growth(samples, warmup):
+    """ Рост памяти после прогрева: (МБ, МБ на 1000 запросов) по каждому
+    ряду
+    """
+    samples = [sample for sample in samples if sample['requests'] >= warmup]
+    if len(samples) < 2:
+        return {}
+    requests = np.array([sample['requests'] for sample in samples])
+    result = {}
+    for name in ['main_mb', 'workers_mb']:
+        values = np.array([sample[name] for sample in samples])
+        slope = np.polyfit(requests, values, 1)[0] * 1000
+        result[name] = {'growth': round(float(values[-1] - values[0]), 1),
+                        'per_1000': round(float(slope), 2)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Память бота при длительной нагрузке')
+    parser.add_argument('--requests', type=int, default=SOAK_REQUESTS)
+    parser.add_argument('--concurrency', type=int, default=SOAK_CONCURRENCY,
+                        help='число одновременных запросов')
+    parser.add_argument('--processes', type=int, default=RUNTIME_PROCESSES,
+                        help='число процессов ForecastRuntime, 0 - потоки')
+    parser.add_argument('--prefork', action='store_true')
+    parser.add_argument('--pool-share', type=float, default=SOAK_POOL_SHARE,
+                        help='доля запросов тепловой карты подбассейна')
+    parser.add_argument('--warmup', type=int, default=SOAK_WARMUP,
+                        help='запросы прогрева, не учитываемые в росте')
+    parser.add_argument('--sample-every', type=int,
+                        default=SOAK_SAMPLE_EVERY)
+    parser.add_argument('--memory-limit', type=int, default=0,
+                        help='лимит памяти процесса расчёта, МБ')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='вывести места в коде основного процесса с '
+                             'наибольшим ростом памяти после прогрева')
+    parser.add_argument('--max-growth', type=float, default=SOAK_MAX_GROWTH,
+                        help='допустимый рост памяти после прогрева, МБ')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    if get_rss() is None:
+        sys.exit('Память процессов измеряется только на Linux')
+    logging.getLogger().setLevel(logging.WARNING)
+    root = os.getcwd()
+    fixtures_dir = get_filepath('gismeteo', is_raw=True)
+    tmp_dir = tempfile.mkdtemp()
+    prepare_workdir(root, tmp_dir)
+    telegram = FakeTelegramApi().start()
+    gismeteo = GismeteoStub(fixtures_dir).start()
+    gismeteo_parse.GISMETEO_URL = gismeteo.url
+    HOST_RATES['127.0.0.1'] = STUB_RATE
+
+    os.chdir(tmp_dir)
+    runtime = None
+    watchdog = None
+    samples = []
+    top_allocations = None
+    try:
+        setup_locale()
+        bot.load_posts()
+        bot.year_list.append(YEAR)
+        bot.chart_cache = UncachedChartCache(bot.posts_info)
+        tg_bot = Bot(FAKE_BOT_TOKEN, base_url=telegram.base_url,
+                     request=Request(con_pool_size=args.concurrency))
+        runtime = ForecastRuntime(bot.posts_info, bot.get_predictor,
+                                  processes=args.processes,
+                                  concurrency=RUNTIME_CONCURRENCY,
+                                  prefork=args.prefork)
+        runtime.start()
+        runtime.preload()
+        bot.runtime = runtime
+        # проверка памяти выполняется вручную после каждого замера
+        watchdog = MemoryWatchdog(runtime, worker_limit=args.memory_limit)
+
+        rng = random.Random(SEED)
+        posts = [f'{uid}-{YEAR}-{month}' for uid in sorted(bot.posts_info)
+                 for month in range(1, 13)]
+        pools = [f'{bot.POOL_PREFIX}{subpool_id}-{YEAR}-{month}'
+                 for subpool_id in sorted(bot.sub_pools)
+                 for month in range(1, 13)]
+        chosen = [rng.choice(pools if rng.random() < args.pool_share
+                             else posts) for _ in range(args.requests)]
+        context = SimpleNamespace(bot=tg_bot)
+
+        def handle(item):
+            i, callback_data = item
+            handler = bot.predict_pool \
+                if callback_data.startswith(bot.POOL_PREFIX) else bot.predict
+            handler(make_update(tg_bot, callback_data, i), context)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            for offset in range(0, args.requests, args.sample_every):
+                batch = list(enumerate(chosen[offset:offset +
+                                              args.sample_every], offset))
+                list(executor.map(handle, batch))
+                done = offset + len(batch)
+                if args.tracemalloc and done >= args.warmup \
+                        and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    baseline = tracemalloc.take_snapshot()
+                gc.collect()
+                main_mb, workers_mb = measure_memory(runtime)
+                watchdog.check()
+                samples.append({'requests': done,
+                                'seconds': round(time.perf_counter() - start,
+                                                 1),
+                                'main_mb': round(main_mb, 1),
+                                'workers_mb': round(workers_mb, 1),
+                                'recycles': watchdog.recycles})
+                print(f'{done:7} запросов  основной процесс '
+                      f'{main_mb:7.1f} МБ  процессы расчёта '
+                      f'{workers_mb:7.1f} МБ', flush=True)
+        if tracemalloc.is_tracing():
+            top_allocations = format_top_allocations(
+                tracemalloc.take_snapshot(), baseline)
+            tracemalloc.stop()
+    finally:
+        if runtime is not None:
+            runtime.stop()
+        telegram.stop()
+        gismeteo.stop()
+        os.chdir(root)
+        shutil.rmtree(tmp_dir)
+
+    growth = get_growth(samples, args.warmup)
+    report = {'commit': get_commit(),
+              'created': datetime.now().isoformat(timespec='seconds'),
+              'params': {'year': YEAR,
+                         'requests': args.requests,
+                         'concurrency': args.concurrency,
+                         'processes': args.processes,
+                         'prefork': args.prefork,
+                         'pool_share': args.pool_share,
+                         'warmup': args.warmup,
+                         'memory_limit': args.memory_limit,
+                         'uploads': telegram.uploads,
+                         'cpu_count': os.cpu_count()},
+              'growth': growth,
+              'samples': samples}
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            file.write(json.dumps(report, ensure_ascii=False, indent=2))
+    for name, title in [('main_mb', 'основной процесс'),
+                        ('workers_mb', 'процессы расчёта')]:
+        if name in growth:
+            print(f"Рост памяти после прогрева, {title}: "
+                  f"{growth[name]['growth']:+.1f} МБ "
+                  f"({growth[name]['per_1000']:+.2f} МБ на 1000 запросов)")
+    if top_allocations:
+        print('Рост выделенной памяти основного процесса:')
+        print(top_allocations)
+    if any(series['growth'] > args.max_growth for series in growth.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+""" Время запуска бота: профиль импорта src/main.py (python -X importtime)
+и время загрузки модели и данных (--preload).
+
+Каждый замер выполняется в отдельном процессе, чтобы модули не были уже
+загружены. Завершается с кодом 1, если импорт main.py дольше --budget мс
+или загружает тяжёлые модули (HEAVY_MODULES), которые должны загружаться
+только при первом запросе прогноза.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_startup.py
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+
+HEAVY_MODULES = ['xgboost', 'pandas', 'matplotlib', 'seaborn', 'sklearn',
+                 'bs4', 'lxml']
+IMPORT_BUDGET = 1000  # мс
+REPEATS = 3
+TOP = 15
+
+PRELOAD_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+stages = {}
+
+import main
+stages['import main'] = time.perf_counter()
+main.load_posts()
+stages['load_posts'] = time.perf_counter()
+predictor = main.get_predictor()
+stages['Predictor'] = time.perf_counter()
+main.get_chart_cache()
+stages['ChartCache'] = time.perf_counter()
+predictor.preload()
+stages['Predictor.preload'] = time.perf_counter()
+from chart import get_template
+get_template()
+stages['chart template'] = time.perf_counter()
+
+prev, result = start, {}
+for name, moment in stages.items():
+    result[name] = (moment - prev) * 1000
+    prev = moment
+print(json.dumps(result))
+'''
+
+
+def run(args):
+    path = [SRC, os.environ.get('PYTHONPATH')]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, path)))
+    return subprocess.run([sys.executable] + args, cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def profile_import():
+    """ Профиль импорта main.py
+
+    :return: список (модуль, собственное время, общее время, вложенность)
+        в мкс
+    """
+    stderr = run(['-X', 'importtime', '-c', 'import main']).stderr
+    result = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        result.append((name.strip(), int(self_time), int(cumulative), depth))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Время запуска бота')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET,
+                        help='допустимое время импорта main.py, мс')
+    parser.add_argument('--output', help='сохранить результат в json')
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(REPEATS):
+        profile = profile_import()
+        totals.append(next(c for name, _, c, _ in profile
+                           if name == 'main') / 1000)
+    total = min(totals)
+    heavy = sorted({name.split('.')[0] for name, _, _, _ in profile
+                    if name.split('.')[0] in HEAVY_MODULES})
+
+    print(f'import main: {total:.0f} мс (минимум из {REPEATS})')
+    print(f'Модули верхнего уровня (топ {TOP} по общему времени):')
+    top = sorted((item for item in profile if item[3] == 1),
+                 key=lambda item: -item[2])[:TOP]
+    for name, self_time, cumulative, _ in top:
+        print(f'  {cumulative / 1000:8.1f} мс  {name}')
+    print(f"Тяжёлые модули при импорте: {', '.join(heavy) or 'нет'}")
+
+    stages = json.loads(run(['-c', PRELOAD_SCRIPT]).stdout)
+    print('Загрузка (--preload):')
+    for name, ms in stages.items():
+        print(f'  {ms:8.1f} мс  {name}')
+    print(f'  {sum(stages.values()):8.1f} мс  всего')
+
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            json.dump({'import_ms': total, 'heavy_modules': heavy,
+                       'top': [{'module': name, 'cumulative_ms': c / 1000}
+                               for name, _, c, _ in top],
+                       'preload_ms': stages}, file, ensure_ascii=False,
+                      indent=2)
+
+    if total > args.budget or heavy:
+        print(f'Регрессия: бюджет импорта {args.budget:.0f} мс, тяжёлые '
+              f'модули должны загружаться лениво')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
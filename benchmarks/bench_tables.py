@@ -0,0 +1,91 @@
+""" Время загрузки табличных данных из csv (pd.read_csv, как в ноутбуках, и
+read_table) и из колоночных форматов (parquet, feather), в том числе только
+части столбцов, с проверкой совпадения данных. Для бота - время формирования
+статистики уровня воды (WaterStats.from_csv).
+
+Конвертация выполняется во временной папке, данные репозитория не меняются.
+
+Запуск из корня репозитория:
+    python benchmarks/bench_tables.py
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import pandas as pd
+
+from utils import *
+from convert_tables import TABLES, convert_table
+from water_stats import WaterStats
+
+REPEATS = 5
+PROJECTION = 2  # число первых столбцов для загрузки части таблицы
+
+
+def measure(func):
+    """ Минимальное время вызова, мс """
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def bench_table(file_name, is_raw):
+    csv_path = get_filepath(file_name, is_raw)
+    expected = read_table(file_name, is_raw)
+    dates = [c for c in TABLE_DATE_COLUMNS if c in expected.columns]
+    columns = list(expected.columns[:PROJECTION])
+    result = {
+        'pd.read_csv': measure(lambda: pd.read_csv(
+            csv_path, parse_dates=dates, dtype={'uid': str})),
+        'read_table csv': measure(lambda: read_table(file_name, is_raw)),
+    }
+    for table_format in TABLE_FORMATS:
+        convert_table(file_name, is_raw, table_format)
+        pd.testing.assert_frame_equal(read_table(file_name, is_raw), expected)
+        result[f'read_table {table_format}'] = measure(
+            lambda: read_table(file_name, is_raw))
+        result[f'read_table {table_format} {columns}'] = measure(
+            lambda: read_table(file_name, is_raw, columns=columns))
+    return result
+
+
+def main():
+    root = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    tables = []
+    for file_name, is_raw in TABLES:
+        src_path = get_filepath(file_name, is_raw)
+        if os.path.isfile(src_path):
+            tables.append((file_name, is_raw))
+            dst_path = os.path.join(tmp_dir, os.path.relpath(src_path, root))
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            shutil.copy(src_path, dst_path)
+
+    os.chdir(tmp_dir)
+    try:
+        water_stats_csv = measure(WaterStats.from_csv)
+        for file_name, is_raw in tables:
+            print(f'{file_name} ({len(read_table(file_name, is_raw))} строк), '
+                  f'данные совпадают:')
+            result = bench_table(file_name, is_raw)
+            base = result['pd.read_csv']
+            for name, ms in result.items():
+                print(f'  {name:45} {ms:8.1f} мс  x{base / ms:.1f}')
+        print('WaterStats.from_csv:')
+        print(f'  {"csv":45} {water_stats_csv:8.1f} мс')
+        print(f'  {TABLE_FORMATS[-1]:45} '
+              f'{measure(WaterStats.from_csv):8.1f} мс')
+    finally:
+        os.chdir(root)
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
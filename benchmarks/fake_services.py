@@ -0,0 +1,154 @@
+""" Локальные HTTP-серверы для benchmarks: заглушка Telegram Bot API и
+заглушка сайта Gismeteo, которая отдаёт страницы из html-кэша
+data\\raw\\gismeteo\\ репозитория.
+
+Серверы работают в потоках текущего процесса и не обращаются к сети.
+"""
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_BOT_TOKEN = '123456:benchmark'
+CHAT_ID = 1
+# страница Gismeteo: /diary/<id_гисметео>/<год>/<месяц>/
+DIARY_PATH = re.compile(r'^/diary/(\d+)/(\d{4})/(\d{1,2})/?$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящих серверов
+
+    def do_GET(self):
+        self.server.owner.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.owner.handle(self, 'POST')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer:
+    """ HTTP-сервер в отдельном потоке на свободном порту 127.0.0.1 """
+
+    def __init__(self, delay=0.0):
+        """
+        :param delay: задержка ответа, секунд
+        """
+        self.delay = delay
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.owner = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request, method):
+        body = b''
+        length = int(request.headers.get('Content-Length') or 0)
+        if length:
+            body = request.rfile.read(length)
+        with self.lock:
+            self.requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+        status, content_type, data = self.respond(method, request.path, body)
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def respond(self, method, path, body):
+        """ :return: (код ответа, Content-Type, тело ответа) """
+        raise NotImplementedError
+
+
+class FakeTelegramApi(StubServer):
+    """ Заглушка Telegram Bot API: отвечает на методы, которые вызывает
+    обработчик прогноза (sendPhoto, editMessageText, deleteMessage), как
+    Telegram. Отправленные фотографии получают новый file_id.
+    """
+
+    def __init__(self, delay=0.0):
+        super().__init__(delay)
+        self.uploads = 0  # фотографии, отправленные файлом, а не file_id
+        self.message_id = 0
+
+    @property
+    def base_url(self):
+        """ base_url для telegram.Bot """
+        return f'{self.url}/bot'
+
+    def respond(self, method, path, body):
+        api_method = path.rsplit('/', 1)[-1]
+        with self.lock:
+            self.message_id += 1
+            message_id = self.message_id
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': CHAT_ID, 'type': 'private'}}
+        if api_method == 'getMe':
+            result = {'id': 123456, 'is_bot': True,
+                      'first_name': 'Water Predictor',
+                      'username': 'water_predictor_bench_bot'}
+        elif api_method == 'sendPhoto':
+            # фотография передаётся файлом в multipart/form-data
+            if body.startswith(b'--'):
+                with self.lock:
+                    self.uploads += 1
+            message['photo'] = [{'file_id': f'photo-{message_id}',
+                                 'file_unique_id': f'unique-{message_id}',
+                                 'width': 1200, 'height': 600}]
+            result = message
+        elif api_method == 'editMessageText':
+            message['text'] = ''
+            result = message
+        elif api_method == 'deleteMessage':
+            result = True
+        else:
+            return 404, 'application/json', json.dumps(
+                {'ok': False, 'error_code': 404,
+                 'description': 'Not Found'}).encode('utf-8')
+        return 200, 'application/json', json.dumps(
+            {'ok': True, 'result': result}).encode('utf-8')
+
+
+class GismeteoStub(StubServer):
+    """ Заглушка сайта Gismeteo: страницы дневника погоды из html-кэша """
+
+    def __init__(self, fixtures_dir, delay=0.0):
+        """
+        :param fixtures_dir: папка html-кэша (data\\raw\\gismeteo\\)
+        """
+        super().__init__(delay)
+        self.fixtures_dir = fixtures_dir
+
+    def respond(self, method, path, body):
+        match = DIARY_PATH.match(path)
+        if method != 'GET' or not match:
+            return 404, 'text/html', b'Not Found'
+        gismeteo_id, year, month = match.groups()
+        file_path = os.path.join(self.fixtures_dir, gismeteo_id,
+                                 f'{year}-{int(month):02d}.html')
+        if not os.path.isfile(file_path):
+            return 404, 'text/html', b'Not Found'
+        with open(file_path, mode='rb') as file:
+            content = file.read()
+        page = b'<html><body>' + content + b'</body></html>'
+        return 200, 'text/html; charset=utf-8', page
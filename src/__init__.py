@@ -1,5 +1,4 @@
 from src.gismeteo_parse import *
-from src.main import *
 from src.predict import *
 from src.secret_auth import *
 from src.strings_ru import *
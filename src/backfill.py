@@ -0,0 +1,106 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import *
+from gismeteo_parse import get_weather_data, is_gismeteo_cached
+
+# Предварительная загрузка метео-данных Gismeteo для всех постов, чтобы
+# новый сервер не заставлял пользователей ждать загрузки (PLEASE_WAIT_MESSAGE).
+# Загрузка идёт в несколько потоков, общая частота запросов к Gismeteo
+# ограничивается HTTP-клиентом (HOST_RATES). Каждый загруженный месяц сразу
+# сохраняется в хранилище метео-данных, поэтому прерванную загрузку можно
+# продолжить повторным запуском - загруженные месяцы будут пропущены.
+BACKFILL_REPORT = 'backfill_report.json'
+BACKFILL_THREADS = 4
+
+
+def get_missing_months(posts, years, now=None):
+    """ Месяцы, метео-данных за которые нет в кэше
+
+    :param posts: словарь с информацией о постах
+    :param years: список лет
+    :return: список (uid, год, месяц)
+    """
+    now = now or datetime.now()
+    result = []
+    for uid, post in posts.items():
+        for year in years:
+            for month in range(1, 13):
+                if (year, month) > (now.year, now.month):
+                    break
+                if not is_gismeteo_cached(post, year, month):
+                    result.append((uid, year, month))
+    return result
+
+
+def backfill(posts, months, threads=BACKFILL_THREADS):
+    """ Загрузка метео-данных за месяцы
+
+    :param posts: словарь с информацией о постах
+    :param months: список (uid, год, месяц)
+    :param threads: число потоков загрузки
+    :return: словарь с месяцами без данных (empty) и с ошибками (failed)
+    """
+    report = {'empty': [], 'failed': []}
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = {executor.submit(get_weather_data, posts[uid], year,
+                                   month): (uid, year, month)
+                   for uid, year, month in months}
+        for i, future in enumerate(as_completed(futures), start=1):
+            uid, year, month = futures[future]
+            key = f'{uid}-{year}-{month:02d}'
+            try:
+                if not future.result():
+                    report['empty'].append(key)
+            except Exception as e:
+                report['failed'].append(f'{key}: {e}')
+
+            if i % 10 == 0 or i == len(futures):
+                elapsed = time.monotonic() - start
+                print(f'{i}/{len(futures)} месяцев, {elapsed:.0f} с')
+    report['empty'].sort()
+    report['failed'].sort()
+    return report
+
+
+def main():
+    """ Предварительная загрузка метео-данных Gismeteo.
+
+    Пример: python src/backfill.py --start-year 2018 --dry-run
+    """
+    parser = argparse.ArgumentParser(
+        description='Загрузка метео-данных Gismeteo для постов наблюдения')
+    parser.add_argument('--posts', nargs='*',
+                        help='uid постов, по умолчанию - все посты')
+    parser.add_argument('--start-year', type=int, default=PREDICT_START_YEAR)
+    parser.add_argument('--end-year', type=int, default=datetime.now().year)
+    parser.add_argument('--threads', type=int, default=BACKFILL_THREADS)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='только подсчитать незагруженные месяцы')
+    args = parser.parse_args()
+
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    if args.posts:
+        unknown = [uid for uid in args.posts if uid not in posts]
+        if unknown:
+            parser.error(f"неизвестные uid постов: {', '.join(unknown)}")
+        posts = {uid: posts[uid] for uid in args.posts}
+    years = list(range(args.start_year, args.end_year + 1))
+
+    months = get_missing_months(posts, years)
+    print(f'Незагруженных месяцев: {len(months)}')
+    if args.dry_run or not months:
+        return
+
+    report = backfill(posts, months, threads=args.threads)
+    write_data(BACKFILL_REPORT, data=report, is_raw=False)
+    print(f"Месяцев без данных: {len(report['empty'])}, "
+          f"с ошибками: {len(report['failed'])}")
+    for line in report['failed']:
+        print(f'  {line}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import threading
+from io import BytesIO
+
+import numpy as np
+from matplotlib import colormaps
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from strings_ru import *
+from utils import CHART_COMPRESS_LEVEL, CHART_DPI
+
+# Отрисовка графика с прогнозом. Вместо создания новой фигуры через pyplot и
+# seaborn на каждый запрос используется заранее оформленный шаблон
+# (Figure + Axes), в котором обновляются только данные линий и подписи.
+# Шаблон свой у каждого потока, т.к. объекты matplotlib не потокобезопасны.
+# Фигуры создаются напрямую (Figure), без pyplot, поэтому не регистрируются в
+# его глобальном списке фигур и не остаются в памяти после ошибки. Шаблон,
+# при отрисовке которого возникла ошибка, освобождается и при следующем
+# запросе создаётся заново.
+CHART_SIZE = (12, 6)  # размер в дюймах
+
+# тепловая карта прогноза по всем постам подбассейна: строка - пост,
+# столбец - день, цвет - положение прогноза в историческом диапазоне поста
+POOL_CHART_SIZE = (12, 7)
+POOL_COLORMAP = 'RdYlBu_r'
+
+_local = threading.local()
+
+
+class ChartTemplate:
+    def __init__(self):
+        self.figure = Figure(figsize=CHART_SIZE)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+
+        ax = self.ax
+        self.line_result, = ax.plot([], [], label=PREDICTED_VALUE,
+                                    color='C0', linewidth=5)
+        self.line_min, = ax.plot([], [], label=HISTORY_MIN, color='C1',
+                                 linestyle='dashed', linewidth=3)
+        self.line_mean, = ax.plot([], [], label=HISTORY_MEAN, color='C2',
+                                  linestyle='dotted', linewidth=3)
+        self.line_max, = ax.plot([], [], label=HISTORY_MAX, color='C3',
+                                 linestyle='dashed', linewidth=3)
+        self.fill = None
+
+        ax.grid()
+        ax.legend()
+        ax.set_ylabel(WATER_LEVEL)
+        self.suptitle = self.figure.suptitle('')
+
+    def update(self, days, result, history_min, history_mean, history_max,
+               suptitle, title, xlabel):
+        ax = self.ax
+        self.line_result.set_data(days, result)
+        self.line_min.set_data(days, history_min)
+        self.line_mean.set_data(days, history_mean)
+        self.line_max.set_data(days, history_max)
+
+        # пределы по осям считаются только по линиям, без заливки
+        if self.fill is not None:
+            self.fill.remove()
+        ax.set_autoscale_on(True)
+        ax.relim()
+        ax.autoscale_view()
+        ylim = ax.get_ylim()
+        self.fill = ax.fill_between(days, result, color='C0', alpha=0.2)
+        ax.set_ylim(ylim)
+
+        ax.set_xticks(days, labels=[str(day) for day in days])
+        ax.set_xlabel(xlabel)
+        ax.set_title(title)
+        self.suptitle.set_text(suptitle)
+
+        # уменьшение боковых отступов
+        xlim = ax.get_xlim()
+        xmargin = (xlim[1] - xlim[0]) * -0.045
+        ax.set_xlim(xlim[0] - xmargin, xlim[1] + xmargin)
+
+    def release(self):
+        self.figure.clear()
+        self.fill = None
+
+    def to_png(self, dpi=CHART_DPI, compress_level=CHART_COMPRESS_LEVEL):
+        with BytesIO() as img:
+            self.figure.savefig(img, format='png', dpi=dpi,
+                                pil_kwargs={'compress_level': compress_level})
+            return img.getvalue()
+
+
+class PoolChartTemplate:
+    def __init__(self):
+        self.figure = Figure(figsize=POOL_CHART_SIZE)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.figure.subplots_adjust(left=0.3, right=0.97)
+
+        cmap = colormaps[POOL_COLORMAP].copy()
+        cmap.set_bad('lightgrey')  # нет данных
+        self.image = self.ax.imshow(np.zeros((1, 1)), cmap=cmap, vmin=0,
+                                    vmax=1, aspect='auto',
+                                    interpolation='nearest')
+        colorbar = self.figure.colorbar(self.image, ax=self.ax,
+                                        extend='both', fraction=0.05)
+        colorbar.set_label(POOL_LEVEL)
+        self.suptitle = self.figure.suptitle('')
+
+    def update(self, days, names, levels, suptitle, title, xlabel):
+        ax = self.ax
+        self.image.set_data(np.ma.masked_invalid(levels))
+        self.image.set_extent((days[0] - 0.5, days[-1] + 0.5,
+                               len(names) - 0.5, -0.5))
+        ax.set_xticks(days, labels=[str(day) for day in days])
+        ax.set_yticks(np.arange(len(names)), labels=names)
+        ax.set_xlabel(xlabel)
+        ax.set_title(title)
+        self.suptitle.set_text(suptitle)
+
+    def release(self):
+        self.figure.clear()
+
+    def to_png(self, dpi=CHART_DPI, compress_level=CHART_COMPRESS_LEVEL):
+        with BytesIO() as img:
+            self.figure.savefig(img, format='png', dpi=dpi,
+                                pil_kwargs={'compress_level': compress_level})
+            return img.getvalue()
+
+
+def get_template():
+    """ Шаблон графика текущего потока (создаётся при первом обращении) """
+    template = getattr(_local, 'template', None)
+    if template is None:
+        template = ChartTemplate()
+        _local.template = template
+    return template
+
+
+def get_pool_template():
+    """ Шаблон тепловой карты подбассейна текущего потока """
+    template = getattr(_local, 'pool_template', None)
+    if template is None:
+        template = PoolChartTemplate()
+        _local.pool_template = template
+    return template
+
+
+def release_template(name):
+    """ Освобождение шаблона текущего потока
+
+    :param name: 'template' или 'pool_template'
+    """
+    template = getattr(_local, name, None)
+    if template is not None:
+        setattr(_local, name, None)
+        template.release()
+
+
+def render_forecast(days, result, history_min, history_mean, history_max,
+                    suptitle, title, xlabel, dpi=CHART_DPI,
+                    compress_level=CHART_COMPRESS_LEVEL):
+    """ Отрисовка графика с прогнозом уровня воды за месяц
+
+    :param days: номера дней месяца (ось x)
+    :param result: предсказанный уровень воды
+    :param history_min: исторический минимум
+    :param history_mean: историческое среднее
+    :param history_max: исторический максимум
+    :param suptitle: заголовок графика (название поста)
+    :param title: подзаголовок графика
+    :param xlabel: подпись оси x
+    :param dpi: разрешение изображения
+    :param compress_level: уровень сжатия PNG
+    :return: изображение в формате PNG (bytes)
+    """
+    template = get_template()
+    try:
+        template.update(np.asarray(days), np.asarray(result),
+                        np.asarray(history_min), np.asarray(history_mean),
+                        np.asarray(history_max), suptitle, title, xlabel)
+        return template.to_png(dpi=dpi, compress_level=compress_level)
+    except Exception:
+        # шаблон мог остаться в промежуточном состоянии (например, без
+        # заливки под линией прогноза)
+        release_template('template')
+        raise
+
+
+def render_pool(days, names, levels, suptitle, title, xlabel, dpi=CHART_DPI,
+                compress_level=CHART_COMPRESS_LEVEL):
+    """ Отрисовка тепловой карты прогноза по постам подбассейна
+
+    :param days: номера дней месяца (ось x)
+    :param names: названия постов (ось y)
+    :param levels: массив (пост, день) - положение прогноза в историческом
+        диапазоне поста: 0 - минимум, 1 - максимум, NaN - нет данных
+    :param suptitle: заголовок графика (название подбассейна)
+    :param title: подзаголовок графика
+    :param xlabel: подпись оси x
+    :param dpi: разрешение изображения
+    :param compress_level: уровень сжатия PNG
+    :return: изображение в формате PNG (bytes)
+    """
+    template = get_pool_template()
+    try:
+        template.update(np.asarray(days), names, np.asarray(levels), suptitle,
+                        title, xlabel)
+        return template.to_png(dpi=dpi, compress_level=compress_level)
+    except Exception:
+        release_template('pool_template')
+        raise
@@ -0,0 +1,147 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils import *
+from forecast import chart_quality
+from gismeteo_parse import get_weather_version
+from prediction_store import get_model_fingerprint
+
+# Кэш графиков с прогнозами. График одинаков для всех пользователей, которые
+# запросили один и тот же пост и месяц, поэтому хранится:
+# 1. PNG в памяти (LRU) и на диске в data\processed\charts\;
+# 2. file_id фотографии, который Telegram вернул после первой отправки -
+#    повторная отправка по file_id не требует ни отрисовки, ни загрузки.
+# Записи привязаны к версии: отпечатку модели, метео-данных поста за месяц и
+# качеству PNG (chart_quality), при их изменении записи считаются
+# устаревшими.
+CHARTS_DIR = 'charts'
+CHARTS_FILE_IDS = os.path.join(CHARTS_DIR, 'file_ids.json')
+CHARTS_MEMORY_SIZE = 128  # число графиков в памяти
+
+# увеличивается при изменении внешнего вида графика
+CHART_VERSION = 2
+
+
+class ChartCache:
+    def __init__(self, posts, max_items=CHARTS_MEMORY_SIZE):
+        self.posts = posts
+        self.max_items = max_items
+        self.model_version = get_model_fingerprint()
+        self.memory = OrderedDict()  # ключ: (версия, png)
+        self.lock = threading.Lock()
+
+        self.file_ids = {}  # ключ: [версия, file_id]
+        if is_data_exists(CHARTS_FILE_IDS, is_raw=False):
+            self.file_ids = json.loads(open_file(CHARTS_FILE_IDS,
+                                                 is_raw=False))
+
+    @staticmethod
+    def _key(uid, year, month):
+        return f'{uid}-{year}-{month}'
+
+    def get_version(self, uid, year, month):
+        """ Версия графика: зависит от модели, метео-данных, вида и качества
+        графика
+        """
+        version = '/'.join([self._get_chart_version(), self.model_version,
+                            get_weather_version(self.posts[uid], year, month)])
+        return hashlib.md5(version.encode('utf-8')).hexdigest()[:16]
+
+    def get_pool_version(self, subpool_id, year, month):
+        """ Версия тепловой карты подбассейна: зависит от модели, метео-данных
+        всех постов подбассейна, вида и качества графика
+        """
+        weather = [get_weather_version(post, year, month)
+                   for _, post in sorted(self.posts.items())
+                   if post['subpool_id'] == subpool_id]
+        version = '/'.join([self._get_chart_version(), self.model_version]
+                           + weather)
+        return hashlib.md5(version.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _get_chart_version():
+        return '{}-{dpi}-{compress_level}'.format(CHART_VERSION,
+                                                   **chart_quality)
+
+    @staticmethod
+    def pool_key(subpool_id):
+        """ Ключ тепловой карты подбассейна вместо uid поста в get_file_id,
+        set_file_id, get_png и put_png
+        """
+        return f'pool{subpool_id}'
+
+    def get_file_id(self, uid, year, month, version):
+        with self.lock:
+            entry = self.file_ids.get(self._key(uid, year, month))
+        if entry and entry[0] == version:
+            return entry[1]
+        return None
+
+    def set_file_id(self, uid, year, month, version, file_id):
+        key = self._key(uid, year, month)
+        with self.lock:
+            if self.file_ids.get(key) == [version, file_id]:
+                return
+            self.file_ids[key] = [version, file_id]
+            write_data(CHARTS_FILE_IDS, data=self.file_ids, is_raw=False)
+
+    def get_png(self, uid, year, month, version):
+        key = self._key(uid, year, month)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[0] == version:
+                self.memory.move_to_end(key)
+                return entry[1]
+
+        file_path = get_filepath(self._png_filename(key, version),
+                                 is_raw=False)
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, mode='rb') as file:
+            png = file.read()
+        self._remember(key, version, png)
+        return png
+
+    def has_png(self, uid, year, month, version):
+        """ Есть ли график с версией version в памяти или на диске """
+        key = self._key(uid, year, month)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[0] == version:
+                return True
+        return os.path.isfile(get_filepath(self._png_filename(key, version),
+                                           is_raw=False))
+
+    def put_png(self, uid, year, month, version, png):
+        key = self._key(uid, year, month)
+        self._remember(key, version, png)
+
+        file_name = self._png_filename(key, version)
+        # запись с заменой: график читается другими обработчиками и
+        # предварительным расчётом, недописанный файл не должен попасть в кэш
+        with replace_file(file_name, is_raw=False) as tmp_path:
+            with open(tmp_path, mode='wb') as file:
+                file.write(png)
+
+        # удаление устаревших версий графика (кроме временных файлов других
+        # потоков, которые ещё записываются)
+        charts_dir = get_filepath(CHARTS_DIR, is_raw=False)
+        for name in os.listdir(charts_dir):
+            if name.startswith(key + '_') and not name.endswith('.tmp') \
+                    and name != os.path.basename(file_name):
+                try:
+                    os.remove(os.path.join(charts_dir, name))
+                except FileNotFoundError:  # удалена другим запросом
+                    pass
+
+    def _remember(self, key, version, png):
+        with self.lock:
+            self.memory[key] = (version, png)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    @staticmethod
+    def _png_filename(key, version):
+        return os.path.join(CHARTS_DIR, f'{key}_{version}.png')
@@ -0,0 +1,60 @@
+import argparse
+from time import perf_counter
+
+from utils import *
+
+# Конвертация табличных данных из csv в колоночный формат (см. TABLE_FORMATS
+# в utils.py). csv файлы остаются исходными данными: после их изменения
+# read_table снова загружает csv, пока конвертация не будет выполнена повторно.
+TABLES = [(DATA_WATER_LEVEL, True),
+          (DATA_WEATHER, True),
+          (DATA_WATER_STATS, False),
+          (DATA_PROCESSED_TRAIN, False)]
+
+
+def convert_table(file_name, is_raw, table_format=TABLE_FORMAT):
+    """ Конвертация csv файла в колоночный формат
+
+    :return: путь к записанному файлу
+    """
+    df = read_table(file_name, is_raw)
+    file_path = write_table(file_name, df, is_raw, table_format)
+    # файлы в других форматах больше не соответствуют csv
+    for extension in TABLE_FORMATS:
+        other_path = os.path.splitext(file_path)[0] + extension
+        if extension != table_format and os.path.isfile(other_path):
+            os.remove(other_path)
+    return file_path
+
+
+def main():
+    """ Конвертация табличных данных в колоночный формат.
+
+    Пример: python src/convert_tables.py --format .feather
+    """
+    parser = argparse.ArgumentParser(
+        description='Конвертация csv файлов в колоночный формат')
+    parser.add_argument('--format', choices=TABLE_FORMATS,
+                        default=TABLE_FORMAT)
+    parser.add_argument('tables', nargs='*',
+                        help='названия csv файлов, по умолчанию - все')
+    args = parser.parse_args()
+
+    for file_name, is_raw in TABLES:
+        if args.tables and file_name not in args.tables:
+            continue
+        csv_path = get_filepath(file_name, is_raw)
+        if not os.path.isfile(csv_path):
+            print(f'{file_name}: нет файла')
+            continue
+
+        start = perf_counter()
+        file_path = convert_table(file_name, is_raw, args.format)
+        print(f'{file_name} -> {os.path.basename(file_path)}: '
+              f'{os.path.getsize(csv_path) / 2 ** 20:.1f} МБ -> '
+              f'{os.path.getsize(file_path) / 2 ** 20:.1f} МБ, '
+              f'{perf_counter() - start:.1f} с')
+
+
+if __name__ == '__main__':
+    main()
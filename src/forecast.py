@@ -0,0 +1,146 @@
+import calendar
+import locale
+from calendar import monthrange
+
+import numpy as np
+
+from metrics import stage
+from singleflight import SingleFlight
+from strings_ru import *
+from utils import CHART_COMPRESS_LEVEL, CHART_DPI
+
+# Общий код формирования прогноза, который используется как в основном
+# процессе бота, так и в процессах-обработчиках (см. runtime.py)
+BOT_LOCALE = 'ru_RU'
+
+# ключ: (uid, year, month) или ('pool', subpool_id, year, month)
+chart_flight = SingleFlight()
+
+# качество PNG графиков: разрешение и уровень сжатия (set_chart_quality)
+chart_quality = {'dpi': CHART_DPI, 'compress_level': CHART_COMPRESS_LEVEL}
+
+
+def setup_locale():
+    """ Русские названия месяцев в модуле calendar """
+    locale.setlocale(locale.LC_ALL, BOT_LOCALE)
+
+
+def set_chart_quality(dpi=CHART_DPI, compress_level=CHART_COMPRESS_LEVEL):
+    """ Качество PNG графиков: меньшее разрешение или уровень сжатия
+    ускоряют отрисовку. Задаётся в основном процессе до запуска
+    ForecastRuntime, процессы-обработчики получают его при создании.
+    """
+    if not 0 <= compress_level <= 9:
+        raise ValueError('compress_level должен быть в интервале [0, 9]')
+    chart_quality.update(dpi=dpi, compress_level=compress_level)
+
+
+def get_month_name(month, pretty=False):
+    result = calendar.month_name[month]
+    if pretty:
+        emoji = '🌱'  # весна
+        if month == 12 or month <= 2:  # зима
+            emoji = '❄'
+        elif month >= 9:  # осень
+            emoji = '🍂'
+        elif month >= 6:  # лето
+            emoji = '☀'
+        result = f'{emoji} {result}'
+    return result
+
+
+def render_chart(post, year, month, result):
+    """ Отрисовка графика с прогнозом
+
+    :param post: информация о посте
+    :param result: результат Predictor.predict
+    :return: изображение в формате PNG (bytes)
+    """
+    from chart import render_forecast  # matplotlib - при первой отрисовке
+
+    with stage('render'):
+        return render_forecast(result['date'].dt.day.to_numpy(),
+                               result['result'].to_numpy(),
+                               result['min'].to_numpy(),
+                               result['mean'].to_numpy(),
+                               result['max'].to_numpy(),
+                               suptitle=post['name'],
+                               title=PREDICT_TITLE.format(
+                                   get_month_name(month).lower(), year),
+                               xlabel=get_month_name(month),
+                               **chart_quality)
+
+
+def get_pool_uids(posts, subpool_id):
+    """ uid постов подбассейна в порядке кодов постов """
+    return sorted(uid for uid, post in posts.items()
+                  if post['subpool_id'] == subpool_id)
+
+
+def render_pool_chart(posts, year, month, results):
+    """ Отрисовка тепловой карты прогноза по постам подбассейна
+
+    :param posts: словарь с информацией о постах
+    :param results: словарь uid: результат Predictor.predict по постам
+        одного подбассейна
+    :return: изображение в формате PNG (bytes)
+    """
+    from chart import render_pool
+
+    days = np.arange(1, monthrange(year, month)[1] + 1)
+    first_day = (np.datetime64(f'{year}-{month:02d}-01')
+                 - np.datetime64(f'{year}-01-01')).astype(np.int64) + 1
+    levels = np.full((len(results), len(days)), np.nan)
+    for i, result in enumerate(results.values()):
+        index = result['day_of_year'].to_numpy() - first_day
+        history_range = (result['max'] - result['min']).to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            levels[i, index] = np.where(
+                history_range > 0,
+                (result['result'] - result['min']).to_numpy() / history_range,
+                np.nan)
+
+    uids = list(results)
+    with stage('render_pool'):
+        return render_pool(days, [posts[uid]['name'] for uid in uids],
+                           levels, suptitle=posts[uids[0]]['subpool_name'],
+                           title=POOL_TITLE.format(
+                               get_month_name(month).lower(), year),
+                           xlabel=get_month_name(month),
+                           **chart_quality)
+
+
+def warm_up(predictor):
+    """ Загрузка модели, данных и шаблона графика до первого запроса """
+    from chart import get_pool_template, get_template
+
+    predictor.preload()
+    get_template()
+    get_pool_template()
+
+
+def compute_chart(predictor, uid, year, month):
+    """ Предсказание и отрисовка графика за месяц
+
+    :return: изображение в формате PNG (bytes)
+    """
+    def compute():
+        result = predictor.predict(uid, year, month)
+        return render_chart(predictor.posts[uid], year, month, result)
+
+    return chart_flight.do((uid, year, month), compute)
+
+
+def compute_pool_chart(predictor, subpool_id, year, month):
+    """ Предсказание по всем постам подбассейна одним вызовом модели и
+    отрисовка тепловой карты
+
+    :return: изображение в формате PNG (bytes)
+    """
+    def compute():
+        uids = get_pool_uids(predictor.posts, subpool_id)
+        results = predictor.predict_many([(uid, year, month) for uid in uids])
+        results = {uid: results[uid, year, month] for uid in uids}
+        return render_pool_chart(predictor.posts, year, month, results)
+
+    return chart_flight.do(('pool', subpool_id, year, month), compute)
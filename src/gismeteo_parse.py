@@ -1,35 +1,65 @@
-from bs4 import BeautifulSoup
-from htmlmin import minify
+import logging
 from calendar import monthrange
+from time import time
+
+import numpy as np
 
-from preparation.utils import AuthError, get_auth_data
 from utils import *
+from metrics import cache_request, stage
+from singleflight import SingleFlight
+import weather_store
 
 # В данный модуль выделен код для обработки страниц Gismeteo из ноутбука
 # notebooks\parse_gismeteo.ipynb
 
+# адрес сайта Gismeteo (в benchmarks - локальный сервер-заглушка)
+GISMETEO_URL = 'https://www.gismeteo.ru'
+
+# одна и та же страница, нужная нескольким постам, загружается один раз
+_fetch_flight = SingleFlight()
+
+logger = logging.getLogger(__name__)
+
 
 def get_cached_filename(gismeteo_id, year, month):
     return os.path.join('gismeteo', str(gismeteo_id), f'{year}-{month:02d}.html')
 
 
-def get_gismeteo_table(gismeteo_id, year, month):
+def get_gismeteo_table(gismeteo_id, year, month, refresh=False):
+    """ Таблица Gismeteo за месяц из html-кэша или с сайта
+
+    :param refresh: загрузить страницу с сайта, даже если она есть в кэше
+    :return: таблица или None, если за месяц нет данных
+    """
+    # разбор html нужен только при загрузке новых данных, поэтому модули
+    # импортируются при первом вызове, а не при запуске бота
+    from bs4 import BeautifulSoup
+    from htmlmin import minify
+
     file_name = get_cached_filename(gismeteo_id, year, month)
-    if is_data_exists(file_name, is_raw=True):
-        weather = open_file(file_name, is_raw=True)
-        soup = BeautifulSoup(weather, 'lxml')
+    if not refresh and is_data_exists(file_name, is_raw=True):
+        with stage('gismeteo_page'):
+            weather = open_file(file_name, is_raw=True)
+            soup = BeautifulSoup(weather, 'lxml')
         if soup.find(class_='empty_phrase'):
+            cache_request('gismeteo_page', 'empty')
+            release_html(soup)
             return None
+        cache_request('gismeteo_page', 'hit')
         return soup
     else:
-        url = f'https://www.gismeteo.ru/diary/{gismeteo_id}/{year}/{month}/'
-        r = get_url(url)
-        weather = r.text
-        soup = BeautifulSoup(weather, 'lxml')
+        url = f'{GISMETEO_URL}/diary/{gismeteo_id}/{year}/{month}/'
+        with stage('gismeteo_page'):
+            r = get_url(url)
+            weather = r.text
+            soup = BeautifulSoup(weather, 'lxml')
         empty_phrase = soup.find(class_='empty_phrase')
         if empty_phrase:
+            cache_request('gismeteo_page', 'empty')
             write_data(file_name, data=str(empty_phrase), is_raw=True)
+            release_html(soup)
             return None
+        cache_request('gismeteo_page', 'miss')
 
         table = soup.find('table')
         # для формирования форматированных html-страниц (с отступами и
@@ -39,6 +69,92 @@ def get_gismeteo_table(gismeteo_id, year, month):
         write_data(file_name, data=minify(str(table)), is_raw=True)
         return table
 
+def parse_gismeteo_table(gismeteo_id, year, month, table):
+    """ Разбор таблицы Gismeteo за месяц
+
+    :param table: таблица из get_gismeteo_table или None
+    :return: строки [день, температура, погода] или None, если за месяц нет
+        данных
+    """
+    if not table or table.find(class_='empty_phrase'):
+        return None
+
+    data_rows = table.find_all('tr')[2:]  # убрать шапку таблицы
+    try:
+        return [process_history_row(row) for row in data_rows]
+    except Exception:
+        raise Exception(f"check https://www.gismeteo.ru/diary/{gismeteo_id}/"
+                        f"{year}/{month}/")
+
+
+def get_gismeteo_rows(gismeteo_id, year, month):
+    """ Метео-данные города за месяц. Данные берутся из хранилища
+    разобранных метео-данных, при их отсутствии - из html-кэша или с сайта
+    Gismeteo с последующим сохранением в хранилище. Незавершённый месяц
+    загружается с сайта повторно, если данные старше
+    weather_store.REFRESH_TTL.
+
+    :return: строки [день, температура, погода] или None, если за месяц нет
+        данных
+    """
+    is_stored, rows = weather_store.get_month(gismeteo_id, year, month)
+    if is_stored and not weather_store.is_stale(gismeteo_id, year, month):
+        cache_request('weather_store', 'hit')
+        return rows
+    cache_request('weather_store', 'miss')
+    return _fetch_flight.do((gismeteo_id, year, month), _fetch_gismeteo_rows,
+                            gismeteo_id, year, month)
+
+
+def _fetch_gismeteo_rows(gismeteo_id, year, month):
+    # месяц мог быть загружен, пока ожидалось завершение другого запроса
+    is_stored, rows = weather_store.get_month(gismeteo_id, year, month)
+    if is_stored and not weather_store.is_stale(gismeteo_id, year, month):
+        return rows
+
+    # время загрузки сохраняется, только если страница загружена с сайта
+    fetched = None
+    if is_stored or not is_data_exists(
+            get_cached_filename(gismeteo_id, year, month), is_raw=True):
+        fetched = time()
+    if is_stored:
+        try:
+            table = get_gismeteo_table(gismeteo_id, year, month, refresh=True)
+        except requests.RequestException as e:
+            # сайт недоступен - используются уже загруженные данные
+            logger.warning('Не удалось обновить %s/%s-%02d: %s', gismeteo_id,
+                           year, month, e)
+            return rows
+        try:
+            new_rows = parse_gismeteo_table(gismeteo_id, year, month, table)
+        finally:
+            release_html(table)
+        # в хранилище добавляются только новые дни
+        return weather_store.merge_month(gismeteo_id, year, month, new_rows,
+                                         fetched)
+
+    table = get_gismeteo_table(gismeteo_id, year, month)
+    try:
+        rows = parse_gismeteo_table(gismeteo_id, year, month, table)
+    finally:
+        release_html(table)
+
+    weather_store.put_month(gismeteo_id, year, month, rows, fetched=fetched)
+    return rows
+
+
+def release_html(tag):
+    """ Освобождение дерева BeautifulSoup, в котором находится tag. Узлы
+    дерева ссылаются друг на друга, поэтому без decompose() оно освобождается
+    только сборщиком мусора.
+    """
+    if tag is None:
+        return
+    while tag.parent is not None:
+        tag = tag.parent
+    tag.decompose()
+
+
 def process_history_row(row):
     cells = row.find_all('td')
 
@@ -82,20 +198,12 @@ def process_history_row(row):
 def form_historical_dataset(post, year, month):
     result = []
 
-    def get_data_rows(gismeteo_id):
-        table = get_gismeteo_table(gismeteo_id, year, month)
-        if not table:
-            return None
-
-        data_rows = table.find_all('tr')
-        return data_rows[2:]  # убрать шапку таблицы
-
     # В приоритете используются метео-данными из основного источника, если их
     # Примеры неполных метеоданных:
     # с 18 + пропуски https://www.gismeteo.ru/diary/158155/2015/3/
     # до 19 числа https://www.gismeteo.ru/diary/4015/2015/9/
     # с 29 по 31 https://www.gismeteo.ru/diary/4015/2015/10/
-    main_data = get_data_rows(post['gismeteo_id'])
+    main_data = get_gismeteo_rows(post['gismeteo_id'], year, month)
     main_gps = [post['latitude'], post['longitude']]
     fallback_dict = None
     fallback_gps = None
@@ -105,15 +213,13 @@ def form_historical_dataset(post, year, month):
             and 'fallback' in post.keys()):
         fallback_gps = [post['fallback']['latitude'],
                         post['fallback']['longitude']]
-        fallback_data = get_data_rows(
-            post['fallback']['gismeteo_id'])
+        fallback_data = get_gismeteo_rows(
+            post['fallback']['gismeteo_id'], year, month)
         if not fallback_data:
             # в течении месяца нет информации ни у оригинального источника,
             # ни у дополнительного
             return None
         if main_data:
-            fallback_data = [process_history_row(row) for row in
-                             fallback_data]
             fallback_dict = {
                 day: (temperature, weather, 1)  # 1 is is_fallback_data
                 for day, temperature, weather in fallback_data}
@@ -124,15 +230,7 @@ def form_historical_dataset(post, year, month):
     is_fallback = int(main_gps == fallback_gps or post[
         'clean_name'] == 'Светлана')  # check if it is Светлана
     day = 1
-    for row in main_data:
-        try:
-            data = process_history_row(row)
-        except Exception:
-            err_str = f"check https://www.gismeteo.ru/diary/{post['gismeteo_id']}/{year}/{month}/"
-            if 'fallback' in post.keys():
-                err_str += f"\n+ https://www.gismeteo.ru/diary/{post['fallback']['gismeteo_id']}/{year}/{month}/"
-            raise Exception(err_str)
-
+    for data in main_data:
         row_day = data[0]
         while day != row_day:
             # если есть пропуски в днях в основном источнике метео-данных
@@ -154,11 +252,149 @@ def form_historical_dataset(post, year, month):
     return result
 
 
-def is_gismeteo_cached(post, year, month):
-    file_name = get_cached_filename(post['gismeteo_id'], year, month)
+# погода по коду записи хранилища, UNKNOWN_WEATHER (-1) - последний элемент
+_WEATHER_NAMES = np.array(weather_store.WEATHER_CODES + [None], dtype=object)
+
+
+def form_historical_arrays(post, months):
+    """ Метео-данные поста сразу за несколько месяцев, как в
+    form_historical_dataset, но в виде столбцов numpy и без загрузки с сайта:
+    файл каждого города хранилища читается один раз.
+
+    :param months: список (год, месяц)
+    :return: словарь (год, месяц): (даты, широта, долгота, температура,
+        погода, is_fallback_data). Месяцы, которых нет в хранилище или
+        которые нужно загрузить повторно, в словарь не попадают - их данные
+        нужно получить через get_weather_data
+    """
+    fallback = post.get('fallback')
+    main_months = weather_store.get_month_records(post['gismeteo_id'],
+                                                  months)
+    fallback_months = weather_store.get_month_records(
+        fallback['gismeteo_id'], months) if fallback else {}
+    main_gps = [post['latitude'], post['longitude']]
+    is_svetlana = post['clean_name'] == 'Светлана'
+
+    result = {}
+    for year, month in months:
+        main = _get_stored_records(post['gismeteo_id'], main_months, year,
+                                   month)
+        if main is None:
+            continue
+        gps = main_gps
+        fill = main[:0]
+        is_fallback = int(is_svetlana)
+        if len(main) == 0 or (len(main) < monthrange(year, month)[1]
+                              and fallback):
+            if not fallback:
+                continue
+            records = _get_stored_records(fallback['gismeteo_id'],
+                                          fallback_months, year, month)
+            if records is None:
+                continue
+            fallback_gps = [fallback['latitude'], fallback['longitude']]
+            is_fallback = int(main_gps == fallback_gps or is_svetlana)
+            if len(main) == 0:
+                main, gps, is_fallback = records, fallback_gps, 1
+            else:
+                # пропуски основного источника до его последнего дня
+                # заполняются из резервного
+                fill = records[(records['day'] < main['day'][-1])
+                               & ~np.isin(records['day'], main['day'])]
+            fill_gps = fallback_gps
+        else:
+            fill_gps = gps
+
+        records = np.concatenate([main, fill])
+        order = np.argsort(records['day'], kind='stable')
+        records = records[order]
+        is_main = (np.arange(len(order)) < len(main))[order]
+        temperature = records['temperature'].astype(np.float64)
+        temperature[records['temperature'] == weather_store.NO_TEMPERATURE] \
+            = np.nan
+        result[year, month] = (
+            np.datetime64(f'{year}-{month:02d}-01')
+            + records['day'].astype(np.int64) - 1,
+            np.where(is_main, gps[0], fill_gps[0]),
+            np.where(is_main, gps[1], fill_gps[1]),
+            temperature,
+            _WEATHER_NAMES[records['weather']],
+            np.where(is_main, is_fallback, 1).astype(np.float64))
+    return result
+
+
+def _get_stored_records(gismeteo_id, stored_months, year, month):
+    """ Записи города за месяц из get_month_records, пустой массив - за месяц
+    нет данных, None - месяца нет в хранилище или его нужно загрузить
+    повторно
+    """
+    records = stored_months.get((year, month))
+    if records is None or weather_store.is_stale(gismeteo_id, year, month):
+        return None
+    cache_request('weather_store', 'hit')
+    if records[0]['day'] == 0:
+        return records[:0]
+    return records
+
+
+def is_month_cached(gismeteo_id, year, month):
+    """ Есть ли актуальные данные за месяц без загрузки с сайта """
+    if weather_store.has_month(gismeteo_id, year, month):
+        return not weather_store.is_stale(gismeteo_id, year, month)
+    file_name = get_cached_filename(gismeteo_id, year, month)
     return is_data_exists(file_name, is_raw=True)
 
 
+def is_gismeteo_cached(post, year, month):
+    """ Есть ли актуальные метео-данные поста за месяц без загрузки с сайта
+    Gismeteo. Данные резервного города нужны, только если данные основного
+    неполные (или ещё не разобраны в хранилище), - тогда они тоже должны
+    быть загружены, чтобы загрузка не выполнялась в процессе расчёта.
+    """
+    if not is_month_cached(post['gismeteo_id'], year, month):
+        return False
+    if 'fallback' not in post.keys():
+        return True
+    _, rows = weather_store.get_month(post['gismeteo_id'], year, month)
+    if rows and len(rows) >= monthrange(year, month)[1]:
+        return True
+    return is_month_cached(post['fallback']['gismeteo_id'], year, month)
+
+
+def is_weather_stale(post, year, month):
+    """ Нужно ли повторно загрузить уже загруженные метео-данные поста за
+    месяц (основного или резервного города)
+    """
+    return any(weather_store.has_month(gismeteo_id, year, month)
+               and weather_store.is_stale(gismeteo_id, year, month)
+               for gismeteo_id in _get_used_gismeteo_ids(post, year, month))
+
+
+def get_weather_version(post, year, month):
+    """ Версия метео-данных поста за месяц: меняется при изменении данных
+    в хранилище разобранных метео-данных
+
+    :return: строка с контрольными суммами данных основного и резервного
+        городов
+    """
+    return '|'.join(weather_store.get_month_version(gismeteo_id, year, month)
+                    for gismeteo_id in _get_used_gismeteo_ids(post, year,
+                                                              month))
+
+
+def _get_used_gismeteo_ids(post, year, month):
+    """ Города, метео-данные которых используются в form_historical_dataset:
+    резервный - только если данные основного неполные или не разобраны
+    """
+    gismeteo_ids = [post['gismeteo_id']]
+    if 'fallback' not in post.keys():
+        return gismeteo_ids
+    _, rows = weather_store.get_month(post['gismeteo_id'], year, month)
+    if not rows or len(rows) < monthrange(year, month)[1]:
+        gismeteo_ids.append(post['fallback']['gismeteo_id'])
+    return gismeteo_ids
+
+
 def get_weather_data(post, year, month):
     return form_historical_dataset(post, year, month)
 
@@ -0,0 +1,188 @@
+import random
+import threading
+from collections import OrderedDict
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import HTTP_ERRORS, HTTP_SECONDS
+
+# Общий HTTP-клиент для парсеров Gismeteo и АИС ГМВО:
+# - одна сессия requests с пулом keep-alive соединений, поэтому TCP и TLS
+#   соединение не устанавливается заново на каждый запрос;
+# - ограничение частоты запросов к каждому сайту (token bucket) перед
+#   запросом вместо ожидания после каждого запроса;
+# - повтор запроса с экспоненциальной задержкой при ответах 429/5xx и ошибках
+#   соединения. Неидемпотентные запросы (POST: вход в АИС ГМВО, выгрузка
+#   данных) повторяются, только если сайт ответил 429/503 с Retry-After, т.е.
+#   запрос точно не был выполнен;
+# - условные GET-запросы (If-None-Match / If-Modified-Since), если сайт
+#   возвращает ETag или Last-Modified;
+# - длительность каждой попытки и ошибки (код ответа или тип исключения)
+#   записываются в метрики по сайтам (metrics.py).
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD'}
+# ответы, после которых неидемпотентный запрос можно повторить (с Retry-After)
+NOT_PROCESSED_STATUSES = {429, 503}
+DEFAULT_RATE = 1.0  # запросов в секунду к сайту, для которого не задан лимит
+DEFAULT_TIMEOUT = 30  # секунд
+CONDITIONAL_CACHE_SIZE = 64  # число ответов, сохраняемых для условных запросов
+# секунд, наибольшая задержка из заголовка Retry-After: при большей запрос не
+# повторяется, чтобы не занимать поток и ожидающий его обработчик бота
+MAX_RETRY_AFTER = 5
+
+
+class TokenBucket:
+    """ Ограничение частоты запросов: rate запросов в секунду с возможностью
+    сделать до capacity запросов подряд.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Получение разрешения на запрос, при необходимости с ожиданием """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # токен резервируется сразу, ожидание - вне блокировки, поэтому
+            # одновременные запросы встают в очередь друг за другом
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class HttpClient:
+    def __init__(self, headers=None, host_rates=None, default_rate=DEFAULT_RATE,
+                 retries=3, backoff=1.0, timeout=DEFAULT_TIMEOUT,
+                 pool_size=8):
+        """
+        :param headers: заголовки для всех запросов
+        :param host_rates: словарь сайт: число запросов в секунду
+        :param default_rate: число запросов в секунду для остальных сайтов
+        :param retries: число повторов запроса при ошибке
+        :param backoff: задержка перед первым повтором, секунд
+        :param timeout: время ожидания ответа, секунд
+        :param pool_size: число keep-alive соединений с каждым сайтом
+        """
+        self.session = requests.Session()
+        if headers:
+            self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.host_rates = host_rates or {}
+        self.default_rate = default_rate
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.buckets = {}
+        self.conditional = OrderedDict()  # (url, params, cookies): ответ
+        self.lock = threading.Lock()
+
+    def _get_bucket(self, host):
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.host_rates.get(host,
+                                                         self.default_rate))
+                self.buckets[host] = bucket
+        return bucket
+
+    def _retry_delay(self, attempt, response=None):
+        """ :return: задержка перед повтором, секунд, или None, если сайт
+        просит подождать дольше MAX_RETRY_AFTER
+        """
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                retry_after = int(retry_after)
+                return retry_after if retry_after <= MAX_RETRY_AFTER else None
+        return self.backoff * 2 ** attempt * (1 + random.random() / 2)
+
+    def request(self, method, url, **kwargs):
+        """ HTTP-запрос с ограничением частоты и повторами
+
+        :return: requests.Response, при ошибке - исключение
+            requests.HTTPError или requests.RequestException
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        is_idempotent = method.upper() in IDEMPOTENT_METHODS
+        host = urlsplit(url).hostname
+        bucket = self._get_bucket(host)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            start = perf_counter()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                HTTP_SECONDS.observe(host, value=perf_counter() - start)
+                HTTP_ERRORS.inc(host, type(e).__name__)
+                # неидемпотентный запрос мог дойти до сайта
+                if attempt == self.retries or not is_idempotent:
+                    raise
+                sleep(self._retry_delay(attempt))
+                continue
+
+            HTTP_SECONDS.observe(host, value=perf_counter() - start)
+            if r.status_code >= 400:
+                HTTP_ERRORS.inc(host, str(r.status_code))
+            if r.status_code in RETRY_STATUSES and attempt < self.retries \
+                    and (is_idempotent or self._is_not_processed(r)):
+                delay = self._retry_delay(attempt, r)
+                if delay is not None:
+                    sleep(delay)
+                    continue
+            return r
+
+    @staticmethod
+    def _is_not_processed(response):
+        """ Сайт не выполнял запрос и просит повторить его позже """
+        return response.status_code in NOT_PROCESSED_STATUSES \
+            and 'Retry-After' in response.headers
+
+    def get(self, url, params=None, cookies=None):
+        # ответ одной сессии АИС ГМВО не должен возвращаться для другой
+        key = (url, tuple(sorted((params or {}).items())),
+               tuple(sorted((cookies or {}).items())))
+        headers = {}
+        with self.lock:
+            cached = self.conditional.get(key)
+        if cached is not None:
+            if 'ETag' in cached.headers:
+                headers['If-None-Match'] = cached.headers['ETag']
+            if 'Last-Modified' in cached.headers:
+                headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+        r = self.request('GET', url, params=params, cookies=cookies,
+                         headers=headers)
+        if r.status_code == 304 and cached is not None:
+            return cached
+        r.raise_for_status()
+
+        if 'ETag' in r.headers or 'Last-Modified' in r.headers:
+            with self.lock:
+                self.conditional[key] = r
+                self.conditional.move_to_end(key)
+                while len(self.conditional) > CONDITIONAL_CACHE_SIZE:
+                    self.conditional.popitem(last=False)
+        return r
+
+    def post(self, url, data=None, cookies=None, allow_redirects=True):
+        r = self.request('POST', url, data=data, cookies=cookies,
+                         allow_redirects=allow_redirects)
+        r.raise_for_status()
+        return r
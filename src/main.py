@@ -1,10 +1,8 @@
-import calendar
-import locale
+import argparse
+import html
 import logging
-import seaborn as sns
-import matplotlib
-import matplotlib.pyplot as plt
-from io import BytesIO
+import signal
+import threading
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram import ReplyKeyboardRemove, Update
@@ -12,10 +10,18 @@ from telegram.ext import CallbackContext, ConversationHandler
 from telegram.ext import CallbackQueryHandler
 from telegram.ext import Updater, CommandHandler
 
+import secret_auth
 from secret_auth import tg_bot_token
 from strings_ru import *
 from utils import *
-from predict import Predictor
+from forecast import get_month_name, set_chart_quality, setup_locale
+import metrics
+from metrics import cache_request, stage, track_handler
+from runtime import ForecastRuntime, RUNTIME_CONCURRENCY, RUNTIME_PROCESSES
+from runtime import RUNTIME_STATS_INTERVAL
+from prewarm import PrewarmScheduler, PREWARM_CPU_BUDGET, PREWARM_HOURS
+from profiler import PROFILE_DURATION, SamplingProfiler
+from memory import MEMORY_WORKER_LIMIT, MemoryWatchdog
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,20 +29,64 @@ logging.basicConfig(
 )
 
 logger = logging.getLogger(__name__)
-locale.setlocale(locale.LC_ALL, 'ru_RU')
 
 YEAR, MONTH, PREDICT = range(3)
-posts_info = open_file(DATA_POSTS_FULL_RAW, is_raw=True)
-posts_info = json.loads(posts_info)
-posts_info = {k: v for k, v in
-              sorted(posts_info.items(), key=lambda x: x[1]['name'])}
-sub_pools = {post['subpool_id']: post['subpool_name']
-             for post in posts_info.values()}
-
-uids_list = list(posts_info.keys())
-year_list = [x for x in range(2018, datetime.now().year + 1)]
-
-predictor = Predictor(posts_info)
+POOL_PREFIX = 'pool-'  # callback_data тепловой карты подбассейна
+# символов отчёта профилирования в сообщении (ограничение Telegram - 4096)
+PROFILE_MESSAGE_SIZE = 3500
+posts_info = {}
+sub_pools = {}
+uids_list = []
+year_list = []
+
+# модель, данные и кэш графиков загружаются при первом запросе прогноза
+# (или при запуске с --preload), чтобы бот начинал работу сразу
+predictor = None
+chart_cache = None
+runtime = None  # ForecastRuntime, создаётся при запуске бота
+prewarm = None  # PrewarmScheduler, при запуске с --prewarm
+profiler = None  # SamplingProfiler, при запуске с --profiler
+memory_watchdog = None  # MemoryWatchdog
+# пользователи Telegram, которым доступна команда /profile
+admin_ids = set(getattr(secret_auth, 'tg_admin_ids', []))
+predict_backend = PREDICT_BACKEND
+_load_lock = threading.Lock()
+
+
+def load_posts():
+    global posts_info, sub_pools, uids_list, year_list
+
+    posts_info = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    posts_info = {k: v for k, v in
+                  sorted(posts_info.items(), key=lambda x: x[1]['name'])}
+    sub_pools = {post['subpool_id']: post['subpool_name']
+                 for post in posts_info.values()}
+
+    uids_list = list(posts_info.keys())
+    year_list = [x for x in range(PREDICT_START_YEAR,
+                                  datetime.now().year + 1)]
+
+
+def get_predictor():
+    global predictor
+    with _load_lock:
+        if predictor is None:
+            from predict import Predictor
+            from prediction_store import PredictionStore
+
+            predictor = Predictor(posts_info, store=PredictionStore.load(),
+                                  backend=predict_backend)
+    return predictor
+
+
+def get_chart_cache():
+    global chart_cache
+    with _load_lock:
+        if chart_cache is None:
+            from chart_cache import ChartCache
+
+            chart_cache = ChartCache(posts_info)
+    return chart_cache
 
 
 def invalid_data_msg(update: Update):
@@ -45,24 +95,15 @@ def invalid_data_msg(update: Update):
     return False
 
 
-def get_month_name(month, pretty=False):
-    result = calendar.month_name[month]
-    if pretty:
-        emoji = '🌱'  # весна
-        if month == 12 or month <= 2:  # зима
-            emoji = '❄'
-        elif month >= 9:  # осень
-            emoji = '🍂'
-        elif month >= 6:  # лето
-            emoji = '☀'
-        result = f'{emoji} {result}'
-    return result
-
-def check_callback_date(update: Update):
+def check_callback_date(update: Update, is_pool=False):
     """ Проверка значений, переданных через Callback кнопок.
     Обычный пользователь всегда будет проходить данные проверки.
+
+    :param is_pool: вместо uid поста передан id подбассейна (pool-id-...)
     """
     callback_data = update.callback_query.data
+    if is_pool:
+        callback_data = callback_data[len(POOL_PREFIX):]
     callback_data = callback_data.split("-")
     uid, year, month = None, None, None
     is_valid = True
@@ -90,7 +131,7 @@ def check_callback_date(update: Update):
     if is_valid and len(callback_data) >= 1:  # uid поста
         try:
             uid = callback_data[0]
-            if uid not in uids_list:
+            if uid not in (sub_pools if is_pool else uids_list):
                 is_valid &= invalid_data_msg(update)
         except:
             is_valid &= invalid_data_msg(update)
@@ -133,6 +174,9 @@ def select_post(update: Update, context: CallbackContext):
                                                   callback_data=uid)])
 
     #keyboard = [keyboard]
+    keyboard.append([InlineKeyboardButton(
+        text=POOL_LABEL,
+        callback_data=POOL_PREFIX + subpool_uid)])
     keyboard.append([InlineKeyboardButton(
         text=BACK_LABEL,
         callback_data='start')])
@@ -141,33 +185,20 @@ def select_post(update: Update, context: CallbackContext):
                                             parse_mode='HTML',
                                             reply_markup=reply_markup)
 
-def select_year(update: Update, context: CallbackContext):
-    uid, _, _ = check_callback_date(update)
-    if not uid:
-        return
-
-    formatted_msg = SELECT_YEAR.format(posts_info[uid]['name'])
+def get_year_keyboard(prefix, back_data):
     keyboard = []
     for i, year in enumerate(year_list):
         keyboard.append(InlineKeyboardButton(text=str(year),
-                                                   callback_data=f'{uid}-'
+                                                   callback_data=f'{prefix}-'
                                                                  f'{year}'))
     keyboard = [keyboard]
     keyboard.append([InlineKeyboardButton(
         text=BACK_LABEL,
-        callback_data='query-' + posts_info[uid]['subpool_id'])])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.callback_query.message.edit_text(formatted_msg,
-                                            parse_mode='HTML',
-                                            reply_markup=reply_markup)
+        callback_data=back_data)])
+    return InlineKeyboardMarkup(keyboard)
 
 
-def select_month(update: Update, context: CallbackContext):
-    uid, year, _ = check_callback_date(update)
-    if not uid:
-        return
-
-    formatted_msg = SELECT_MONTH.format(posts_info[uid]['name'], year)
+def get_month_keyboard(prefix, year, back_data):
     keyboard = []
     last_month = 12
     if year == datetime.now().year:
@@ -178,7 +209,7 @@ def select_month(update: Update, context: CallbackContext):
         month_str = get_month_name(month, pretty=True).lower()
 
         reply_row.append(InlineKeyboardButton(text=str(month_str),
-                                              callback_data=f'{uid}-{year}-'
+                                              callback_data=f'{prefix}-{year}-'
                                                             f'{month}'))
         if month % 4 == 0:
             keyboard.append(reply_row)
@@ -188,50 +219,67 @@ def select_month(update: Update, context: CallbackContext):
         keyboard.append(reply_row)
 
     keyboard.append([InlineKeyboardButton(text=BACK_LABEL,
-                                                callback_data=f'{uid}')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+                                                callback_data=back_data)])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def select_year(update: Update, context: CallbackContext):
+    uid, _, _ = check_callback_date(update)
+    if not uid:
+        return
+
+    formatted_msg = SELECT_YEAR.format(posts_info[uid]['name'])
+    reply_markup = get_year_keyboard(
+        uid, back_data='query-' + posts_info[uid]['subpool_id'])
+    update.callback_query.message.edit_text(formatted_msg,
+                                            parse_mode='HTML',
+                                            reply_markup=reply_markup)
+
+
+def select_month(update: Update, context: CallbackContext):
+    uid, year, _ = check_callback_date(update)
+    if not uid:
+        return
+
+    formatted_msg = SELECT_MONTH.format(posts_info[uid]['name'], year)
+    reply_markup = get_month_keyboard(uid, year, back_data=f'{uid}')
+    update.callback_query.message.edit_text(formatted_msg,
+                                            parse_mode='HTML',
+                                            reply_markup=reply_markup)
+
+
+def select_pool_year(update: Update, context: CallbackContext):
+    subpool_uid, _, _ = check_callback_date(update, is_pool=True)
+    if not subpool_uid:
+        return
+
+    formatted_msg = SELECT_POOL_YEAR.format(sub_pools[subpool_uid])
+    reply_markup = get_year_keyboard(POOL_PREFIX + subpool_uid,
+                                     back_data='query-' + subpool_uid)
+    update.callback_query.message.edit_text(formatted_msg,
+                                            parse_mode='HTML',
+                                            reply_markup=reply_markup)
+
+
+def select_pool_month(update: Update, context: CallbackContext):
+    subpool_uid, year, _ = check_callback_date(update, is_pool=True)
+    if not subpool_uid:
+        return
+
+    formatted_msg = SELECT_POOL_MONTH.format(sub_pools[subpool_uid], year)
+    reply_markup = get_month_keyboard(POOL_PREFIX + subpool_uid, year,
+                                      back_data=POOL_PREFIX + subpool_uid)
     update.callback_query.message.edit_text(formatted_msg,
                                             parse_mode='HTML',
                                             reply_markup=reply_markup)
 
 
+@track_handler('predict')
 def predict(update: Update, context: CallbackContext):
-    uid, year, month = check_callback_date(update)
+    with stage('check_callback_date'):
+        uid, year, month = check_callback_date(update)
     if not uid:
         return
-    if not predictor.is_cached_data(uid, year, month):
-        update.callback_query.message.edit_text(PLEASE_WAIT_MESSAGE,
-                                                reply_markup=None)
-    result = predictor.predict(uid, year, month)
-
-    fig, ax = plt.subplots(figsize=(12, 6))
-    sns.lineplot(data=result, y='result', x='date', label=PREDICTED_VALUE,
-                 ax=ax, linewidth=5)
-    sns.lineplot(data=result, y='min', x='date', label=HISTORY_MIN,
-                 linestyle='dashed', ax=ax, linewidth=3)
-    sns.lineplot(data=result, y='mean', x='date', label=HISTORY_MEAN,
-                 linestyle='dotted', ax=ax, linewidth=3)
-    sns.lineplot(data=result, y='max', x='date', label=HISTORY_MAX,
-                 linestyle='dashed', ax=ax, linewidth=3)
-
-    # после заполнения цветом график сдвигается вверх, необходимо сохранить
-    # ограничение графика по y и его же установить после заполнения
-    orig_ylim = ax.get_ylim()
-    ax.fill_between(result['date'], result['result'], alpha=0.2)
-    ax.set_ylim(orig_ylim)
-
-    plt.grid()
-    plt.legend()
-    plt.xticks(result['date'], labels=[x + 1 for x in range(result.shape[0])])
-    plt.xlabel(get_month_name(month))
-    plt.ylabel(WATER_LEVEL)
-    plt.suptitle(posts_info[uid]['name'])
-    plt.title(PREDICT_TITLE.format(get_month_name(month).lower(), year))
-
-    # уменьшение боковых отступов
-    xlim = ax.get_xlim()
-    xmargin = (xlim[1] - xlim[0]) * -0.045
-    ax.set_xlim(xlim[0] - xmargin, xlim[1] + xmargin)
 
     post = posts_info[uid]
     yandex_url = f"https://yandex.ru/maps/?ll={post['longitude']}%2C{post['latitude']}&z=14"
@@ -242,18 +290,124 @@ def predict(update: Update, context: CallbackContext):
                                            f"https://ru.wikipedia.org/wiki/{post['wiki_page']}",
                                            f"https://www.gismeteo.ru/diary/{post['gismeteo_id']}/{year}/{month}")
 
-    with BytesIO() as img:
-        plt.savefig(img, format='png')
-        plt.close()
+    # повторная отправка уже загруженного в Telegram графика, если
+    # метео-данные за месяц не нужно обновлять
+    chart_cache = get_chart_cache()
+    with stage('chart_cache'):
+        is_cached = get_predictor().is_cached_data(uid, year, month)
+        version = chart_cache.get_version(uid, year, month)
+        photo = None
+        if is_cached:
+            photo = chart_cache.get_file_id(uid, year, month, version) or \
+                    chart_cache.get_png(uid, year, month, version)
+    cache_request('chart', 'miss' if photo is None else 'hit')
+    if prewarm:
+        prewarm.record_request(year, month, is_hit=photo is not None)
+    if not photo:
+        if not is_cached:
+            update.callback_query.message.edit_text(PLEASE_WAIT_MESSAGE,
+                                                    reply_markup=None)
+        # расчёт в пуле процессов, поток обработчика ожидает результат
+        with stage('compute'):
+            photo = runtime.render(uid, year, month)
+        # после загрузки метео-данных версия графика меняется
+        version = chart_cache.get_version(uid, year, month)
+        chart_cache.put_png(uid, year, month, version, photo)
+
+    with stage('send_photo'):
+        message = context.bot.send_photo(
+            chat_id=update.callback_query.message.chat_id,
+            photo=photo, parse_mode='HTML', caption=formatted_msg)
+    if message.photo:
+        chart_cache.set_file_id(uid, year, month, version,
+                                message.photo[-1].file_id)
 
-        img.seek(0)
-        context.bot.send_photo(chat_id=update.callback_query.message.chat_id,
-                               photo=img, parse_mode='HTML',
-                               caption=formatted_msg)
+    update.callback_query.message.delete()
+
+
+def log_runtime_stats(context: CallbackContext):
+    logger.info('Метрики расчёта прогнозов: %s', runtime.stats())
+    if prewarm:
+        logger.info('Метрики предварительного расчёта: %s', prewarm.stats())
+    logger.info('Память: %s', memory_watchdog.stats())
+
+
+@track_handler('predict_pool')
+def predict_pool(update: Update, context: CallbackContext):
+    with stage('check_callback_date'):
+        subpool_uid, year, month = check_callback_date(update, is_pool=True)
+    if not subpool_uid:
+        return
+
+    formatted_msg = POOL_MESSAGE.format(sub_pools[subpool_uid],
+                                        get_month_name(month).lower(), year)
+
+    chart_cache = get_chart_cache()
+    predictor = get_predictor()
+    key = chart_cache.pool_key(subpool_uid)
+    with stage('chart_cache'):
+        is_cached = all(predictor.is_cached_data(uid, year, month)
+                        for uid, post in posts_info.items()
+                        if post['subpool_id'] == subpool_uid)
+        version = chart_cache.get_pool_version(subpool_uid, year, month)
+        photo = None
+        if is_cached:
+            photo = chart_cache.get_file_id(key, year, month, version) or \
+                    chart_cache.get_png(key, year, month, version)
+    cache_request('pool_chart', 'miss' if photo is None else 'hit')
+    if prewarm:
+        prewarm.record_request(year, month, is_hit=photo is not None)
+    if not photo:
+        if not is_cached:
+            update.callback_query.message.edit_text(PLEASE_WAIT_MESSAGE,
+                                                    reply_markup=None)
+        # все посты подбассейна рассчитываются одним вызовом модели
+        with stage('compute'):
+            photo = runtime.render_pool(subpool_uid, year, month)
+        version = chart_cache.get_pool_version(subpool_uid, year, month)
+        chart_cache.put_png(key, year, month, version, photo)
+
+    with stage('send_photo'):
+        message = context.bot.send_photo(
+            chat_id=update.callback_query.message.chat_id,
+            photo=photo, parse_mode='HTML', caption=formatted_msg)
+    if message.photo:
+        chart_cache.set_file_id(key, year, month, version,
+                                message.photo[-1].file_id)
 
     update.callback_query.message.delete()
 
 
+def profile(update: Update, context: CallbackContext):
+    """ /profile [секунд] - профилирование бота, только для admin_ids.
+    После завершения отправляется отчёт и файл со стеками.
+    """
+    if update.effective_user.id not in admin_ids:
+        return
+
+    duration = PROFILE_DURATION
+    if context.args and context.args[0].isdigit():
+        duration = int(context.args[0])
+    chat_id = update.effective_chat.id
+
+    def send_profile(folded_path, summary_path, summary):
+        context.bot.send_message(
+            chat_id=chat_id, parse_mode='HTML',
+            text=f'<pre>{html.escape(summary[:PROFILE_MESSAGE_SIZE])}</pre>')
+        with open(folded_path, mode='rb') as file:
+            context.bot.send_document(chat_id=chat_id, document=file)
+
+    if profiler.start(duration, callback=send_profile):
+        update.message.reply_text(PROFILE_STARTED.format(duration))
+    else:
+        update.message.reply_text(PROFILE_RUNNING)
+
+
+def start_profile_on_signal(signum, frame):
+    """ Профилирование по сигналу SIGUSR2: kill -USR2 <pid> """
+    profiler.start(PROFILE_DURATION)
+
+
 def main():
     """ Запуск бота Telegram.
     Алгоритм работы:
@@ -262,16 +416,104 @@ def main():
     3. Выбор месяца
     4. Вывод прогноза
     """
-    matplotlib.use('Agg')  # отключить интерактивный режим matplotlib
-
-    # Запуск бота
-    updater = Updater(tg_bot_token)
+    global runtime, prewarm, profiler, memory_watchdog, predict_backend
+
+    parser = argparse.ArgumentParser(description='Бот Water Predictor')
+    parser.add_argument('--processes', type=int, default=RUNTIME_PROCESSES,
+                        help='число процессов для расчёта прогнозов, '
+                             '0 - расчёт в основном процессе')
+    parser.add_argument('--concurrency', type=int,
+                        default=RUNTIME_CONCURRENCY,
+                        help='число одновременно рассчитываемых прогнозов')
+    parser.add_argument('--prefork', action='store_true',
+                        help='создавать процессы через fork с уже '
+                             'загруженными моделью и данными (Linux)')
+    parser.add_argument('--preload', action='store_true',
+                        help='загрузить модель и данные во всех процессах '
+                             'до начала обработки запросов')
+    parser.add_argument('--backend', choices=PREDICT_BACKEND_NAMES,
+                        default=PREDICT_BACKEND,
+                        help='способ расчёта предсказаний модели')
+    parser.add_argument('--chart-dpi', type=int, default=CHART_DPI,
+                        help='разрешение графиков: меньше - быстрее '
+                             'отрисовка и меньше файл')
+    parser.add_argument('--chart-compress-level', type=int,
+                        choices=range(10), default=CHART_COMPRESS_LEVEL,
+                        help='уровень сжатия PNG графиков (0-9): меньше - '
+                             'быстрее кодирование, больше - меньше файл')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='заранее рассчитывать прогнозы за месяц, '
+                             'который стал доступен для выбора')
+    parser.add_argument('--prewarm-hours', type=int, nargs=2,
+                        default=PREWARM_HOURS, metavar=('START', 'END'),
+                        help='часы низкой нагрузки для предварительного '
+                             'расчёта')
+    parser.add_argument('--prewarm-budget', type=float,
+                        default=PREWARM_CPU_BUDGET,
+                        help='доля времени одного слота расчёта для '
+                             'предварительного расчёта')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='порт HTTP-сервера метрик в формате Prometheus '
+                             f'(http://{metrics.METRICS_HOST}:<порт>/metrics)')
+    parser.add_argument('--trace', action='store_true',
+                        help='записывать в лог длительность этапов каждого '
+                             'запроса прогноза')
+    parser.add_argument('--profiler', action='store_true',
+                        help='профилирование по сигналу SIGUSR2 и команде '
+                             '/profile (tg_admin_ids в secret_auth.py)')
+    parser.add_argument('--memory-limit', type=int,
+                        default=MEMORY_WORKER_LIMIT,
+                        help='лимит памяти процесса расчёта, МБ, после '
+                             'которого он перезапускается (0 - без лимита)')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='записывать в лог места в коде с наибольшим '
+                             'ростом памяти (замедляет работу)')
+    args = parser.parse_args()
+
+    predict_backend = args.backend
+    metrics.enable_tracing(args.trace)
+    setup_locale()
+    set_chart_quality(args.chart_dpi, args.chart_compress_level)
+    load_posts()
+    runtime = ForecastRuntime(posts_info, get_predictor,
+                              processes=args.processes,
+                              concurrency=args.concurrency,
+                              prefork=args.prefork,
+                              backend=args.backend)
+    # потоки основного процесса запускаются после процесса-шаблона
+    # (--prefork), иначе обработчики могут унаследовать их блокировки
+    runtime.start()
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = metrics.start_server(args.metrics_port)
+        logger.info('Метрики: http://%s:%s/metrics', metrics.METRICS_HOST,
+                    args.metrics_port)
+    memory_watchdog = MemoryWatchdog(runtime, worker_limit=args.memory_limit,
+                                     trace=args.tracemalloc)
+    memory_watchdog.start()
+    if args.preload:
+        get_chart_cache()
+        runtime.preload()
+        logger.info('Модель и данные загружены')
+    if args.prewarm:
+        prewarm = PrewarmScheduler(posts_info, runtime, get_predictor,
+                                   get_chart_cache,
+                                   hours=tuple(args.prewarm_hours),
+                                   cpu_budget=args.prewarm_budget)
+        prewarm.start()
+
+    # Запуск бота. Прогнозы строятся асинхронно (run_async), поэтому
+    # потоков обработчиков должно хватать на все одновременные расчёты
+    updater = Updater(tg_bot_token, workers=args.concurrency * 2)
     dispatcher = updater.dispatcher
 
     uid_regexp = r'^(\d+)$'
     year_regexp = r'^(\d+-\d{4})$'
     month_regexp = r'^(\d+-\d{4}-\d+)$'
     subpool_regexp = r'^query-\d+$'
+    pool_year_regexp = r'^pool-\d+$'
+    pool_month_regexp = r'^pool-\d+-\d{4}$'
+    pool_predict_regexp = r'^pool-\d+-\d{4}-\d+$'
     start_regexp = r'^start$'
 
     dispatcher.add_handler(CommandHandler('start', start))
@@ -284,10 +526,32 @@ def main():
     dispatcher.add_handler(CallbackQueryHandler(select_month,
                                                 pattern=year_regexp))
     dispatcher.add_handler(CallbackQueryHandler(predict,
-                                                pattern=month_regexp))
+                                                pattern=month_regexp,
+                                                run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(select_pool_year,
+                                                pattern=pool_year_regexp))
+    dispatcher.add_handler(CallbackQueryHandler(select_pool_month,
+                                                pattern=pool_month_regexp))
+    dispatcher.add_handler(CallbackQueryHandler(predict_pool,
+                                                pattern=pool_predict_regexp,
+                                                run_async=True))
+
+    updater.job_queue.run_repeating(log_runtime_stats,
+                                    interval=RUNTIME_STATS_INTERVAL)
+    if args.profiler:
+        profiler = SamplingProfiler()
+        dispatcher.add_handler(CommandHandler('profile', profile))
+        if hasattr(signal, 'SIGUSR2'):  # нет в Windows
+            signal.signal(signal.SIGUSR2, start_profile_on_signal)
 
     updater.start_polling()
     updater.idle()
+    if prewarm:
+        prewarm.stop()
+    memory_watchdog.stop()
+    runtime.stop()
+    if metrics_server:
+        metrics_server.shutdown()
 
 
 if __name__ == '__main__':
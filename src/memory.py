@@ -0,0 +1,157 @@
+import logging
+import os
+import threading
+import tracemalloc
+from time import monotonic
+
+from metrics import PROCESS_RSS, WORKER_RECYCLES
+
+# Контроль памяти бота. Отдельный поток периодически измеряет резидентную
+# память (RSS) основного процесса и процессов расчёта:
+# - процесс расчёта, превысивший лимит, плавно перезапускается
+#   (ForecastRuntime.recycle_workers), т.к. освободить память фрагментированной
+#   кучи Python внутри процесса нельзя;
+# - при включённом tracemalloc (только основной процесс) в лог периодически
+#   записываются места в коде с наибольшим ростом выделенной памяти с момента
+#   запуска.
+# Память процессов берётся из /proc, поэтому контроль работает только на
+# Linux; на остальных платформах watchdog ничего не делает.
+MEMORY_CHECK_INTERVAL = 60  # секунд
+MEMORY_WORKER_LIMIT = 1024  # МБ, 0 - без перезапуска процессов расчёта
+MEMORY_REPORT_INTERVAL = 3600  # секунд между отчётами tracemalloc
+MEMORY_TRACE_FRAMES = 5  # глубина стека в tracemalloc
+MEMORY_TOP = 10  # число мест в коде в отчёте tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# в отчёт tracemalloc не попадает память импорта модулей и самого tracemalloc
+_TRACE_FILTERS = [tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+                  tracemalloc.Filter(False,
+                                     '<frozen importlib._bootstrap_external>'),
+                  tracemalloc.Filter(False, '<unknown>')]
+
+
+def get_rss(pid=None):
+    """ Резидентная память процесса
+
+    :param pid: процесс, None - текущий
+    :return: байт или None, если процесс завершился или платформа не Linux
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/statm", mode='r') as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def format_top_allocations(snapshot, baseline=None, top=MEMORY_TOP):
+    """ Места в коде с наибольшим объёмом выделенной памяти или, если задан
+    baseline, с наибольшим её ростом
+    """
+    snapshot = snapshot.filter_traces(_TRACE_FILTERS)
+    if baseline is not None:
+        statistics = snapshot.compare_to(
+            baseline.filter_traces(_TRACE_FILTERS), 'lineno')
+        return '\n'.join(f'{stat.size_diff / 2 ** 20:+8.2f} МБ '
+                         f'{stat.count_diff:+8} {stat.traceback}'
+                         for stat in statistics[:top])
+    return '\n'.join(f'{stat.size / 2 ** 20:8.2f} МБ {stat.count:8} '
+                     f'{stat.traceback}'
+                     for stat in snapshot.statistics('lineno')[:top])
+
+
+class MemoryWatchdog:
+    def __init__(self, runtime, worker_limit=MEMORY_WORKER_LIMIT,
+                 interval=MEMORY_CHECK_INTERVAL, trace=False,
+                 report_interval=MEMORY_REPORT_INTERVAL):
+        """
+        :param runtime: ForecastRuntime
+        :param worker_limit: лимит памяти процесса расчёта, МБ, 0 - без
+            перезапуска
+        :param interval: период проверки, секунд
+        :param trace: отслеживать выделение памяти в основном процессе
+            (tracemalloc, замедляет работу)
+        :param report_interval: период записи отчёта tracemalloc, секунд
+        """
+        self.runtime = runtime
+        self.worker_limit = worker_limit * 2 ** 20
+        self.interval = interval
+        self.trace = trace
+        self.report_interval = report_interval
+        self.rss = {}  # процесс: байт
+        self.peak = {}  # процесс: байт
+        self.recycles = 0
+        self.baseline = None  # снимок tracemalloc после запуска
+        self.last_report = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run,
+                                       name='memory-watchdog', daemon=True)
+
+    def start(self):
+        if get_rss() is None:
+            logger.info('Контроль памяти недоступен на этой платформе')
+            return
+        if self.trace:
+            tracemalloc.start(MEMORY_TRACE_FRAMES)
+            self.baseline = tracemalloc.take_snapshot()
+            self.last_report = monotonic()
+        PROCESS_RSS.set_function(
+            lambda: {(name,): value for name, value in self.rss.items()})
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.trace:
+            tracemalloc.stop()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Ошибка контроля памяти')
+
+    def check(self):
+        """ Измерение памяти, перезапуск процессов расчёта, превысивших
+        лимит, и отчёт tracemalloc
+        """
+        rss = {'main': get_rss()}
+        over_limit = []
+        for number, pid in self.runtime.worker_pids().items():
+            value = get_rss(pid)
+            if value is None:  # процесс уже завершился
+                continue
+            rss[f'worker-{number}'] = value
+            if self.worker_limit and value > self.worker_limit:
+                logger.warning('Процесс расчёта %s (pid %s) занимает %.0f МБ, '
+                               'перезапуск', number, pid, value / 2 ** 20)
+                over_limit.append(number)
+        self.rss = rss
+        for name, value in rss.items():
+            self.peak[name] = max(self.peak.get(name, 0), value)
+        if over_limit:
+            self.recycles += len(over_limit)
+            WORKER_RECYCLES.inc(value=len(over_limit))
+            self.runtime.recycle_workers(over_limit)
+
+        if self.trace and monotonic() - self.last_report \
+                >= self.report_interval:
+            self.last_report = monotonic()
+            logger.info('Рост выделенной памяти с момента запуска:\n%s',
+                        self.report())
+
+    def report(self):
+        """ Отчёт tracemalloc: места в коде с наибольшим ростом памяти """
+        return format_top_allocations(tracemalloc.take_snapshot(),
+                                      self.baseline)
+
+    def stats(self):
+        return {'rss_mb': {name: round(value / 2 ** 20, 1)
+                           for name, value in self.rss.items()},
+                'peak_mb': {name: round(value / 2 ** 20, 1)
+                            for name, value in self.peak.items()},
+                'recycles': self.recycles}
@@ -0,0 +1,380 @@
+import functools
+import logging
+import threading
+import uuid
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+# Метрики бота в текстовом формате Prometheus без сторонних библиотек:
+# - счётчики (Counter), гистограммы (Histogram) и текущие значения (Gauge)
+#   с метками хранятся в памяти основного процесса и отдаются по HTTP
+#   (start_server, GET /metrics);
+# - этапы расчёта измеряются через stage(); в процессах-обработчиках
+#   наблюдения собираются в список (collect) и передаются в основной процесс
+#   вместе с результатом (merge);
+# - при включённой трассировке (enable_tracing) обработчик запроса
+#   записывает в лог длительность всех своих этапов, в том числе
+#   выполненных в процессах-обработчиках (add_spans).
+METRICS_HOST = '127.0.0.1'
+METRICS_PREFIX = 'water_predictor_'
+# границы гистограмм длительности, секунд
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1, 2.5, 5, 10, 30)
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_tracing = False
+
+
+def _format_value(value):
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values, extra=''):
+    labels = [f'{name}="{_escape(value)}"'
+              for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = METRICS_PREFIX + name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = OrderedDict()  # значения меток: значение метрики
+        self.lock = threading.Lock()
+
+    def _record(self, labels, value):
+        """ Запись наблюдения или, внутри collect(), его сохранение для
+        передачи в основной процесс
+        """
+        buffer = getattr(_local, 'buffer', None)
+        if buffer is not None:
+            buffer.append((self.name, labels, value))
+        else:
+            self.apply(labels, value)
+
+    def apply(self, labels, value):
+        raise NotImplementedError
+
+    def samples(self):
+        """ Строки метрики: (суффикс названия, значения меток,
+        дополнительная метка, значение)
+        """
+        with self.lock:
+            return [('', labels, '', value)
+                    for labels, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{_format_labels(self.labels, labels, extra)} '
+                         f'{_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, value=1):
+        self._record(labels, value)
+
+    def apply(self, labels, value):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def get(self, *labels):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        """
+        :param func: функция без аргументов, возвращающая значение метрики
+            при каждом запросе /metrics: число или словарь значения меток:
+            значение метрики
+        """
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def set_function(self, func):
+        self.func = func
+
+    def inc(self, *labels, value=1):
+        self._record(labels, value)
+
+    def dec(self, *labels, value=1):
+        self._record(labels, -value)
+
+    def apply(self, labels, value):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        if self.func is None:
+            return super().samples()
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [('', labels, '', value) for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        self._record(labels, value)
+
+    def apply(self, labels, value):
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                # число наблюдений в каждом интервале, сумма, число
+                data = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[labels] = data
+            data[0][bisect_left(self.buckets, value)] += 1
+            data[1] += value
+            data[2] += 1
+
+    def samples(self):
+        result = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (None,),
+                                               counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound is None else _format_value(bound)
+                    result.append(('_bucket', labels, f'le="{le}"',
+                                   cumulative))
+                result.append(('_sum', labels, '', total))
+                result.append(('_count', labels, '', count))
+        return result
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def merge(self, observations):
+        """ Запись наблюдений, собранных collect() """
+        for name, labels, value in observations:
+            self.metrics[name].apply(labels, value)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.add(Histogram(
+    'stage_seconds', 'Длительность этапов расчёта прогноза, секунд',
+    ['stage']))
+CACHE_REQUESTS = REGISTRY.add(Counter(
+    'cache_requests_total', 'Обращения к кэшам: hit, miss, empty (месяц '
+    'без метео-данных)', ['cache', 'result']))
+HTTP_SECONDS = REGISTRY.add(Histogram(
+    'http_request_seconds', 'Длительность исходящих HTTP-запросов, секунд',
+    ['host']))
+HTTP_ERRORS = REGISTRY.add(Counter(
+    'http_errors_total', 'Ошибки исходящих HTTP-запросов: код ответа или '
+    'тип исключения', ['host', 'reason']))
+HANDLER_SECONDS = REGISTRY.add(Histogram(
+    'handler_seconds', 'Длительность обработки запросов прогноза, секунд',
+    ['handler']))
+HANDLERS_ACTIVE = REGISTRY.add(Gauge(
+    'handlers_active', 'Число одновременно обрабатываемых запросов',
+    ['handler']))
+RUNTIME_QUEUE_DEPTH = REGISTRY.add(Gauge(
+    'runtime_queue_depth', 'Прогнозы, ожидающие свободного слота расчёта'))
+RUNTIME_ACTIVE = REGISTRY.add(Gauge(
+    'runtime_active', 'Рассчитываемые прогнозы'))
+PROCESS_RSS = REGISTRY.add(Gauge(
+    'process_rss_bytes', 'Резидентная память процессов бота, байт',
+    ['process']))
+WORKER_RECYCLES = REGISTRY.add(Counter(
+    'worker_recycles_total', 'Перезапуски процессов расчёта из-за превышения '
+    'лимита памяти'))
+PREWARM_JOB_SECONDS = REGISTRY.add(Histogram(
+    'prewarm_job_seconds', 'Длительность заданий предварительного расчёта, '
+    'секунд: ok или error', ['result']))
+PREWARM_REQUESTS = REGISTRY.add(Counter(
+    'prewarm_requests_total', 'Запросы пользователей за предрассчитанные '
+    'месяцы: hit - график отправлен из кэша, miss - рассчитан', ['result']))
+PREWARM_HIT_RATIO = REGISTRY.add(Gauge(
+    'prewarm_hit_ratio', 'Доля запросов за предрассчитанные месяцы, '
+    'отправленных из кэша'))
+
+
+def _get_hit_ratios():
+    totals = {}  # кэш: (попадания, обращения)
+    with CACHE_REQUESTS.lock:
+        for (cache, result), value in CACHE_REQUESTS.values.items():
+            if result == 'empty':
+                continue
+            hits, count = totals.get(cache, (0, 0))
+            totals[cache] = (hits + value * (result == 'hit'), count + value)
+    return {(cache,): hits / count
+            for cache, (hits, count) in totals.items() if count}
+
+
+CACHE_HIT_RATIO = REGISTRY.add(Gauge(
+    'cache_hit_ratio', 'Доля попаданий в кэш (без empty)', ['cache'],
+    func=_get_hit_ratios))
+
+
+@contextmanager
+def stage(name):
+    """ Измерение длительности этапа: with stage('encode'): ... """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        duration = perf_counter() - start
+        STAGE_SECONDS.observe(name, value=duration)
+        trace = getattr(_local, 'trace', None)
+        if trace is not None:
+            trace.spans.append((name, duration))
+
+
+def cache_request(cache, result):
+    """ :param result: 'hit', 'miss' или 'empty' """
+    CACHE_REQUESTS.inc(cache, result)
+
+
+@contextmanager
+def collect():
+    """ Наблюдения, сделанные в текущем потоке внутри with collect() as
+    observations, не записываются в метрики, а добавляются в список
+    observations - для передачи из процесса-обработчика в основной процесс
+    """
+    previous = getattr(_local, 'buffer', None)
+    _local.buffer = []
+    try:
+        yield _local.buffer
+    finally:
+        _local.buffer = previous
+
+
+def merge(observations):
+    REGISTRY.merge(observations)
+
+
+def enable_tracing(enabled=True):
+    global _tracing
+    _tracing = enabled
+
+
+class _Trace:
+    def __init__(self, name, attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.spans = []  # (этап, длительность в секундах)
+        self.start = perf_counter()
+
+
+def add_spans(observations):
+    """ Добавление этапов из наблюдений collect() в трассировку текущего
+    потока
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return
+    trace.spans.extend((labels[0], value)
+                       for name, labels, value in observations
+                       if name == STAGE_SECONDS.name)
+
+
+def track_handler(name):
+    """ Декоратор обработчика python-telegram-bot: длительность, число
+    одновременных запросов и, при включённой трассировке, запись этапов
+    запроса в лог
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(update, context):
+            HANDLERS_ACTIVE.inc(name)
+            start = perf_counter()
+            trace = None
+            if _tracing:
+                query = update.callback_query
+                trace = _Trace(name, query.data if query else None)
+                _local.trace = trace
+            try:
+                return func(update, context)
+            finally:
+                duration = perf_counter() - start
+                HANDLERS_ACTIVE.dec(name)
+                HANDLER_SECONDS.observe(name, value=duration)
+                if trace is not None:
+                    _local.trace = None
+                    logger.info('Трассировка %s %s %s: %.1f мс (%s)',
+                                trace.id, trace.name, trace.attributes,
+                                duration * 1000,
+                                ', '.join(f'{span} {seconds * 1000:.1f} мс'
+                                          for span, seconds in trace.spans))
+        return wrapper
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port, host=METRICS_HOST):
+    """ HTTP-сервер метрик в отдельном потоке: http://host:port/metrics
+
+    :return: ThreadingHTTPServer (остановка - shutdown())
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics',
+                     daemon=True).start()
+    return server
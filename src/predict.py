@@ -1,87 +1,450 @@
-from xgboost import XGBRegressor
-from sklearn.preprocessing import minmax_scale
+import threading
 
 import pandas as pd
 import numpy as np
 
 from utils import *
-from gismeteo_parse import get_weather_data, is_gismeteo_cached
+from gismeteo_parse import form_historical_arrays, get_weather_data
+from gismeteo_parse import get_weather_version
+from gismeteo_parse import is_gismeteo_cached, is_weather_stale
+from metrics import cache_request, stage
+from prediction_store import is_live_month
+from singleflight import SingleFlight
+from water_stats import WaterStats
 
 
 class Predictor:
-    def __init__(self, posts):
-        self.xgboost = XGBRegressor()
-        self.xgboost.load_model(get_xgboost_path())
+    def __init__(self, posts, store=None, backend=PREDICT_BACKEND):
+        """
+        :param posts: словарь с информацией о постах
+        :param store: PredictionStore с заранее рассчитанными предсказаниями,
+            если None - все предсказания считаются на лету
+        :param backend: способ расчёта предсказаний, ключ PREDICT_BACKENDS
+        """
         self.posts = posts
-        self.water_stats = pd.read_csv(get_filepath(DATA_WATER_STATS,
-                                                    is_raw=False),
-                                       dtype={'uid': str})
+        self.store = store
+        self.backend = backend
+        # модель и данные загружаются при первом предсказании или в preload,
+        # чтобы не замедлять запуск бота
+        self.model = None
+        self.encoder = None
+        self.water_stats = None
+        self.lock = threading.Lock()
+        # одновременные запросы одного и того же месяца считаются один раз
+        self.flight = SingleFlight()
+
+    def preload(self):
+        """ Загрузка модели и данных, нужных для предсказания """
+        with self.lock:
+            if self.model is not None:
+                return
+            model = PREDICT_BACKENDS[self.backend].load()
+            self.encoder = FeatureEncoder.load()
+            self.water_stats = WaterStats.load()
+            self.model = model  # последним - признак завершения загрузки
 
     def is_cached_data(self, uid, year, month):
+        if self._get_stored(uid, year, month) is not None:
+            return True
         current_post = self.posts[uid]
         return is_gismeteo_cached(current_post, year, month)
 
+    def _get_stored(self, uid, year, month):
+        if self.store is None or is_live_month(year, month):
+            return None
+        # месяц мог быть загружен до его окончания: пока его метео-данные
+        # обновляются или если они изменились после расчёта хранилища,
+        # предсказание считается заново
+        post = self.posts[uid]
+        if is_weather_stale(post, year, month):
+            return None
+        return self.store.get(uid, year, month,
+                              get_weather_version(post, year, month))
+
+    def _load_stored(self, uid, year, month):
+        """ Предсказания из хранилища с записью обращения в метрики """
+        stored = self._get_stored(uid, year, month)
+        if self.store is not None and not is_live_month(year, month):
+            cache_request('prediction_store',
+                          'miss' if stored is None else 'hit')
+        return stored
+
     def predict(self, uid, year, month):
-        current_post = self.posts[uid]
+        """ Предсказание уровня воды за месяц
+
+        :return: DataFrame (date, day_of_year, result, min, mean, max), общий
+            для одновременных запросов - не изменять
+        """
+        return self.flight.do((uid, year, month), self._predict, uid, year,
+                              month)
+
+    def _predict(self, uid, year, month):
+        with stage('predict'):
+            if self.model is None:
+                self.preload()
+
+            stored = self._load_stored(uid, year, month)
+            if stored is not None:
+                return self._form_stored(uid, year, month, stored)
 
-        weather_data = get_weather_data(current_post, year, month)
-        df = _prepare_dataframe(uid, weather_data)
-        predict = self.xgboost.predict(df.drop(['date'], axis=1))
-        #predict = np.rint(predict)  # округление чисел до целых
+            current_post = self.posts[uid]
 
-        result = pd.DataFrame({
-            "date": df['date'],
-            "day_of_year": df['date'].dt.dayofyear,
-            "result": predict
-        })
-        stats = self.water_stats[self.water_stats['uid'] == uid]
-        stats = stats.drop(['uid'], axis=1)
+            with stage('weather'):
+                weather_data = get_weather_data(current_post, year, month)
+            with stage('encode'):
+                dates, features = self.encoder.encode(uid, weather_data)
+            with stage('inference'):
+                predict = self.model.predict(features)
+            #predict = np.rint(predict)  # округление чисел до целых
+            return self._form_result(uid, dates, predict)
 
-        result = result.merge(stats, on='day_of_year', how='inner')
+    def predict_many(self, keys):
+        """ Предсказание уровня воды за несколько месяцев и постов с одним
+        вызовом модели для всех месяцев, которых нет в хранилище
+
+        :param keys: список (uid, год, месяц)
+        :return: словарь (uid, год, месяц): DataFrame как в predict
+        """
+        if self.model is None:
+            self.preload()
+
+        result = {}
+        pending = {}  # uid: [(год, месяц)] - месяцы, которых нет в хранилище
+        for uid, year, month in dict.fromkeys(keys):
+            stored = self._load_stored(uid, year, month)
+            if stored is not None:
+                result[uid, year, month] = self._form_stored(uid, year, month,
+                                                             stored)
+                continue
+            pending.setdefault(uid, []).append((year, month))
+
+        batch = []  # (ключ, столбцы метео-данных)
+        with stage('weather'):
+            for uid, months in pending.items():
+                post = self.posts[uid]
+                # месяцы всех городов поста читаются из хранилища разом
+                arrays = form_historical_arrays(post, months)
+                for year, month in months:
+                    columns = arrays.get((year, month))
+                    if columns is None:  # загрузка с сайта Gismeteo
+                        columns = FeatureEncoder.split_rows(
+                            get_weather_data(post, year, month))
+                    batch.append(((uid, year, month), columns))
+        if not batch:
+            return result
+
+        lengths = np.array([len(columns[0]) for _, columns in batch])
+        offsets = np.cumsum(lengths) - lengths
+        columns = [np.concatenate([columns[i] for _, columns in batch])
+                   for i in range(6)]
+        predict = np.zeros(0, dtype=np.float32)
+        if len(columns[0]):
+            with stage('encode'):
+                uids = np.repeat([float(uid) for (uid, _, _), _ in batch],
+                                 lengths)
+                # каждый месяц нормализуется отдельно, как в predict
+                features = self.encoder.encode_arrays(
+                    uids, *columns, starts=offsets[lengths > 0])
+            with stage('inference'):
+                predict = self.model.predict(features)
+
+        frames = self._form_results([uid for (uid, _, _), _ in batch],
+                                    columns[0], predict, lengths)
+        for (key, _), frame in zip(batch, frames):
+            result[key] = frame
         return result
 
+    def _form_stored(self, uid, year, month, stored):
+        days = np.flatnonzero(~np.isnan(stored))
+        dates = np.datetime64(format_data(year, month, 1)) + days
+        return self._form_result(uid, dates, stored[days])
+
+    def _form_results(self, uids, dates, predict, lengths):
+        """ Результаты нескольких месяцев: создание DataFrame дороже самого
+        расчёта, поэтому создаётся один DataFrame для всех месяцев, который
+        делится на части
+
+        :param uids: uid поста каждого месяца
+        :param dates: даты всех месяцев подряд (datetime64[D])
+        :param predict: предсказания по датам
+        :param lengths: число дат каждого месяца
+        :return: список DataFrame как в predict
+        """
+        day_of_year = _get_day_of_year(dates)
+        ends = np.cumsum(lengths)
+        with stage('water_stats'):
+            stats = np.concatenate(
+                [self.water_stats.get(uid, day_of_year[end - length:end])
+                 for uid, end, length in zip(uids, ends, lengths)])
+        has_stats = ~np.isnan(stats[:, 0])
+        frame = _form_frame(dates, day_of_year, predict, stats, has_stats)
+        # границы месяцев после отбрасывания дней без статистики
+        ends = np.append(0, np.cumsum(has_stats))[ends]
+        return [frame.iloc[end - length:end].reset_index(drop=True)
+                for end, length in zip(ends, np.diff(ends, prepend=0))]
+
+    def _form_result(self, uid, dates, predict):
+        """
+        :param dates: даты (datetime64[D])
+        :param predict: предсказания по датам
+        """
+        day_of_year = _get_day_of_year(dates)
+        with stage('water_stats'):
+            stats = self.water_stats.get(uid, day_of_year)
+        has_stats = ~np.isnan(stats[:, 0])
+        return _form_frame(dates, day_of_year, predict, stats, has_stats)
+
+
+def _get_day_of_year(dates):
+    return (dates - dates.astype('datetime64[Y]')).astype(np.int64) + 1
+
+
+def _form_frame(dates, day_of_year, predict, stats, has_stats):
+    # дни без статистики отбрасываются
+    return pd.DataFrame({
+        "date": dates[has_stats].astype('datetime64[ns]'),
+        "day_of_year": day_of_year[has_stats],
+        "result": np.asarray(predict)[has_stats],
+        "min": stats[has_stats, 0],
+        "mean": stats[has_stats, 1],
+        "max": stats[has_stats, 2]
+    })
+
+class SklearnBackend:
+    """ Предсказание через XGBRegressor.predict """
+
+    def __init__(self, model):
+        self.model = model
+
+    @classmethod
+    def load(cls):
+        from xgboost import XGBRegressor
+
+        model = XGBRegressor()
+        model.load_model(get_xgboost_path())
+        return cls(model)
+
+    def predict(self, features):
+        return self.model.predict(features)
+
+
+class BoosterBackend:
+    """ Предсказание через Booster.inplace_predict - без обёртки sklearn,
+    проверки названий признаков и создания DMatrix на каждый вызов
+    """
+
+    def __init__(self, booster):
+        self.booster = booster
+
+    @classmethod
+    def load(cls):
+        from xgboost import Booster
+
+        return cls(Booster(model_file=get_xgboost_path()))
+
+    def predict(self, features):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        return self.booster.inplace_predict(features)
+
+
+class NumpyTreeBackend:
+    """ Обход деревьев модели из xgboost_model.json средствами numpy.
+    Все деревья объединены в общие массивы узлов, листья ссылаются сами на
+    себя, поэтому за depth шагов все строки одновременно спускаются по всем
+    деревьям до листьев. Значения листьев суммируются по порядку деревьев
+    в float32, как в XGBoost, поэтому результат совпадает побитово.
+    """
+
+    def __init__(self, model):
+        """
+        :param model: модель XGBoost в формате json (gbtree, одна цель)
+        """
+        learner = model['learner']
+        trees = learner['gradient_booster']['model']['trees']
+        self.base_score = np.float32(
+            learner['learner_model_param']['base_score'])
+        self.n_features = int(learner['learner_model_param']['num_feature'])
+
+        roots, features, thresholds, children, default_left = \
+            [], [], [], [], []
+        offset = 0
+        for tree in trees:
+            left = np.array(tree['left_children'], dtype=np.int64)
+            right = np.array(tree['right_children'], dtype=np.int64)
+            is_leaf = left == -1
+            index = np.arange(len(left)) + offset
+            roots.append(offset)
+            features.append(np.array(tree['split_indices'], dtype=np.int64))
+            # у листьев split_conditions - значение листа
+            thresholds.append(np.array(tree['split_conditions'],
+                                       dtype=np.float32))
+            # потомки узла: [правый, левый], индекс - узел * 2 + (x < порог)
+            children.append(np.stack([np.where(is_leaf, index, right + offset),
+                                      np.where(is_leaf, index, left + offset)],
+                                     axis=1).ravel())
+            default_left.append(np.array(tree['default_left'], dtype=bool))
+            offset += len(left)
+
+        self.roots = np.array(roots, dtype=np.int64)
+        self.features = np.concatenate(features)
+        self.thresholds = np.concatenate(thresholds)
+        self.children = np.concatenate(children)
+        self.default_left = np.concatenate(default_left)
+        self.depth = max(self._get_depth(tree) for tree in trees)
+
+    @staticmethod
+    def _get_depth(tree):
+        depth = np.zeros(len(tree['left_children']), dtype=np.int64)
+        for node, parent in enumerate(tree['parents']):
+            if node > 0:
+                depth[node] = depth[parent] + 1
+        return int(depth.max())
+
+    @classmethod
+    def load(cls):
+        with open(get_xgboost_path(), mode='r', encoding='utf-8') as file:
+            return cls(json.load(file))
+
+    def predict(self, features):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        n = len(features)
+        flat = features.ravel()
+        row_offsets = (np.arange(n) * self.n_features)[:, None]
+        nodes = np.broadcast_to(self.roots, (n, len(self.roots)))
+        for _ in range(self.depth):
+            values = np.take(flat, np.take(self.features, nodes) + row_offsets)
+            go_left = values < np.take(self.thresholds, nodes)
+            is_missing = np.isnan(values)
+            if is_missing.any():
+                go_left = np.where(is_missing,
+                                   np.take(self.default_left, nodes), go_left)
+            nodes = np.take(self.children, nodes * 2 + go_left)
+
+        # cumsum складывает последовательно, в отличие от np.sum
+        leaves = np.take(self.thresholds, nodes)
+        leaves = np.concatenate([np.full((n, 1), self.base_score,
+                                         dtype=np.float32), leaves], axis=1)
+        return np.cumsum(leaves, axis=1)[:, -1]
+
+
+PREDICT_BACKENDS = {'sklearn': SklearnBackend,
+                    'booster': BoosterBackend,
+                    'numpy': NumpyTreeBackend}
+
+
+class FeatureEncoder:
+    """ Преобразование метео-данных за месяц в признаки для модели.
+    Повторяет кодирование из ноутбука notebooks/eda.ipynb: синус/косинус дня
+    в году, кодирование погоды и мин-макс нормализацию по данным из
+    normalization_info.json, которые загружаются один раз.
+    """
+    FEATURES = ['uid', 'latitude', 'longitude', 'temperature',
+                'is_fallback_data', 'year', 'day_sin', 'day_cos',
+                'weather_snow', 'weather_v3_rain', 'weather_v3_storm']
+    # столбцы для нормализации в порядке FEATURES
+    SCALED = [0, 1, 2, 3, 5]
+    WEATHER = {'snow': 8, 'rain': 9, 'storm': 10}
+
+    def __init__(self, norm_info):
+        """
+        :param norm_info: строки с мин. и макс. значениями признаков
+            (uid, date, latitude, longitude, temperature, weather,
+            is_fallback_data)
+        """
+        bounds = np.array([[float(uid), latitude, longitude, temperature,
+                            int(date[:4])]
+                           for uid, date, latitude, longitude, temperature, _,
+                           _ in norm_info], dtype=np.float64)
+        self.data_min = bounds.min(axis=0)
+        self.data_max = bounds.max(axis=0)
+
+    @classmethod
+    def load(cls):
+        return cls(json.loads(open_file(DATA_NORMALIZATION, is_raw=True)))
+
+    def encode(self, uid, weather_data):
+        """ Формирование матрицы признаков
+
+        :param uid: uid поста
+        :param weather_data: строки из get_weather_data (date, latitude,
+            longitude, temperature, weather, is_fallback_data)
+        :return: даты (datetime64[D]) и матрица признаков (float32)
+        """
+        columns = self.split_rows(weather_data)
+        if len(columns[0]) == 0:
+            return columns[0], np.zeros((0, len(self.FEATURES)),
+                                        dtype=np.float32)
+        return columns[0], self.encode_arrays(float(uid), *columns)
+
+    @staticmethod
+    def split_rows(weather_data):
+        """ Строки из get_weather_data в виде столбцов, как в
+        form_historical_arrays
+
+        :return: (даты, широта, долгота, температура, погода,
+            is_fallback_data)
+        """
+        weather_data = weather_data or []
+        dates = np.array([row[0] for row in weather_data],
+                         dtype='datetime64[D]')
+        # latitude, longitude, temperature, is_fallback_data
+        values = np.array([row[1:4] + [row[5]] for row in weather_data],
+                          dtype=np.float64).reshape(-1, 4)
+        weather = np.array([row[4] for row in weather_data], dtype=object)
+        return (dates, values[:, 0], values[:, 1], values[:, 2], weather,
+                values[:, 3])
+
+    def encode_arrays(self, uid, dates, latitude, longitude, temperature,
+                      weather, is_fallback_data, starts=None):
+        """ Формирование матрицы признаков из столбцов данных, в т.ч. сразу
+        для нескольких постов
+
+        :param uid: uid поста (число) или массив uid для каждой строки
+        :param dates: массив дат (datetime64[D])
+        :param weather: массив с погодой (clear, rain, snow, storm)
+        :param starts: начала непустых частей (месяцев), которые
+            нормализуются отдельно друг от друга, как при вызове encode для
+            каждой части; None - все строки нормализуются вместе
+        :return: матрица признаков (float32)
+        """
+        n = len(dates)
+        features = np.empty((n, len(self.FEATURES)), dtype=np.float64)
+        features[:, 0] = uid
+        features[:, 1] = latitude
+        features[:, 2] = longitude
+        features[:, 3] = temperature
+        features[:, 4] = is_fallback_data
+
+        years = dates.astype('datetime64[Y]')
+        year = years.astype(np.int64) + 1970
+        day_of_year = (dates - years).astype(np.int64) + 1
+        is_leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        total_years = np.where(is_leap, 366, 365)
+        features[:, 5] = year
+        features[:, 6] = np.sin(2 * np.pi * day_of_year / total_years)
+        features[:, 7] = np.cos(2 * np.pi * day_of_year / total_years)
 
-def _prepare_dataframe(uid, weather_data):
-    # date, latitude, longitude, temperature, weather, is_fallback_data
-    columns = ['date', 'latitude', 'longitude', 'temperature', 'weather',
-               'is_fallback_data']
-    df = pd.DataFrame(weather_data, columns=columns)
-    df.insert(0, 'uid', uid)
-
-    # добавляем строки с мин и макс значениями, после нормализации удалим их
-    norm_info = open_file(DATA_NORMALIZATION, is_raw=True)
-    norm_info = json.loads(norm_info)
-    for row in norm_info:
-        df.loc[len(df), df.columns] = row
-
-    df['date'] = df['date'].astype('datetime64[ns]')
-    #print(df.tail(3).T)
-
-    # добавление строк с годом и синусом/косинусом дня в году
-    total_years = np.where(df['date'].dt.is_leap_year, 366, 365)
-    df['year'] = df['date'].dt.year
-    df['day_sin'] = np.sin(
-        2 * np.pi * df['date'].dt.dayofyear / total_years)
-    df['day_cos'] = np.cos(
-        2 * np.pi * df['date'].dt.dayofyear / total_years)
-
-    # кодирование погоды
-    df['weather_snow'] = df['weather'].map(
-        {'clear': 0, 'rain': 0, 'storm': 0, 'snow': 1})
-    df['weather_v3_rain'] = df['weather'].map(
-        {'clear': 0, 'rain': 1, 'storm': 0, 'snow': 0})
-    df['weather_v3_storm'] = df['weather'].map(
-        {'clear': 0, 'rain': 0, 'storm': 1, 'snow': 0})
-
-    df = df.drop(['weather'], axis=1)
-
-    # нормализация
-    columns_to_scale = ['uid', 'temperature', 'year', 'latitude',
-                        'longitude']
-    df[columns_to_scale] = minmax_scale(df[columns_to_scale])
-    #print(df.tail(3).T)
-
-    df = df[:-2]  # удаляем строки с данными для корректной нормализации
-    #print(df.tail(3).T)
-    return df
+        is_known = weather == 'clear'
+        for name, column in self.WEATHER.items():
+            is_weather = weather == name
+            features[:, column] = is_weather
+            is_known |= is_weather
+        # неизвестная погода не кодируется, как и в pandas.map
+        features[~is_known, 8:] = np.nan
 
+        # мин-макс нормализация, как в sklearn.preprocessing.minmax_scale
+        scaled = features[:, self.SCALED]
+        if starts is None:
+            data_min = np.fmin(self.data_min, np.nanmin(scaled, axis=0))
+            data_max = np.fmax(self.data_max, np.nanmax(scaled, axis=0))
+        else:
+            lengths = np.diff(np.append(starts, n))
+            data_min = np.repeat(np.fmin(self.data_min, np.fmin.reduceat(
+                scaled, starts, axis=0)), lengths, axis=0)
+            data_max = np.repeat(np.fmax(self.data_max, np.fmax.reduceat(
+                scaled, starts, axis=0)), lengths, axis=0)
+        data_range = data_max - data_min
+        data_range[data_range < 10 * np.finfo(np.float64).eps] = 1.0
+        scale = 1.0 / data_range
+        features[:, self.SCALED] = scaled * scale + (0 - data_min * scale)
+        return features.astype(np.float32)
@@ -0,0 +1,155 @@
+import hashlib
+import logging
+from calendar import monthrange
+
+import numpy as np
+
+from utils import *
+
+# Хранилище заранее рассчитанных предсказаний. Для прошедших месяцев
+# результат работы модели не меняется, поэтому его можно рассчитать один раз
+# для всех постов и лет, сохранить в data\processed\predictions\ и отдавать
+# ответ без разбора html Gismeteo и вызова XGBoost.
+#
+# values.npy   - float32 массив (пост, год, месяц, день), NaN - нет данных
+# computed.npy - bool массив (пост, год, месяц), True - месяц рассчитан
+# index.json   - порядок uid постов и лет, отпечаток модели и версии
+#                метео-данных каждого месяца при расчёте: если данные месяца
+#                позже обновились (месяц был загружен до его окончания),
+#                предсказание из хранилища не используется
+PREDICTIONS_DIR = 'predictions'
+PREDICTIONS_VALUES = os.path.join(PREDICTIONS_DIR, 'values.npy')
+PREDICTIONS_COMPUTED = os.path.join(PREDICTIONS_DIR, 'computed.npy')
+PREDICTIONS_INDEX = os.path.join(PREDICTIONS_DIR, 'index.json')
+
+logger = logging.getLogger(__name__)
+
+
+def get_model_fingerprint():
+    """ Отпечаток файла модели - при его изменении хранилище устаревает """
+    with open(get_xgboost_path(), mode='rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def is_live_month(year, month, now=None):
+    """ Проверка, нужно ли считать предсказание за месяц на лету.
+    Метео-данные текущего и следующего месяца ещё меняются, поэтому такие
+    месяцы в хранилище не попадают.
+    """
+    now = now or datetime.now()
+    current = now.year * 12 + now.month - 1
+    return year * 12 + month - 1 >= current
+
+
+class PredictionStore:
+    def __init__(self, uids, years, values, computed, weather):
+        self.uids = {uid: i for i, uid in enumerate(uids)}
+        self.years = {year: i for i, year in enumerate(years)}
+        self.values = values
+        self.computed = computed
+        self.weather = weather  # '<uid>/<год>-<месяц>': версия метео-данных
+
+    @classmethod
+    def load(cls):
+        """ Загрузка хранилища через memory-map, без чтения в память целиком
+
+        :return: PredictionStore или None, если хранилище не сформировано
+            или рассчитано другой моделью или без версий метео-данных
+        """
+        if not is_data_exists(PREDICTIONS_INDEX, is_raw=False):
+            return None
+        index = json.loads(open_file(PREDICTIONS_INDEX, is_raw=False))
+        if index['model'] != get_model_fingerprint():
+            logger.warning('Хранилище предсказаний рассчитано другой '
+                           'моделью и не будет использовано')
+            return None
+        if 'weather' not in index:
+            logger.warning('В хранилище предсказаний нет версий метео-данных, '
+                           'оно не будет использовано до пересчёта')
+            return None
+
+        values = np.load(get_filepath(PREDICTIONS_VALUES, is_raw=False),
+                         mmap_mode='r')
+        computed = np.load(get_filepath(PREDICTIONS_COMPUTED, is_raw=False),
+                           mmap_mode='r')
+        return cls(index['uids'], index['years'], values, computed,
+                   index['weather'])
+
+    def get(self, uid, year, month, weather_version=None):
+        """ Предсказание за месяц из хранилища
+
+        :param weather_version: текущая версия метео-данных поста за месяц
+            (get_weather_version), None - не проверять
+        :return: массив значений по дням месяца (NaN - нет данных) или None,
+            если месяц не рассчитан или рассчитан по другим метео-данным
+        """
+        if uid not in self.uids or year not in self.years:
+            return None
+        i, j = self.uids[uid], self.years[year]
+        if not self.computed[i, j, month - 1]:
+            return None
+        if weather_version is not None and \
+                self.weather.get(_weather_key(uid, year, month)) \
+                != weather_version:
+            return None
+        return self.values[i, j, month - 1, :monthrange(year, month)[1]]
+
+    def contains(self, uid, year, month):
+        return self.get(uid, year, month) is not None
+
+
+def _weather_key(uid, year, month):
+    return f'{uid}/{year}-{month:02d}'
+
+
+def build_prediction_store(predictor, years):
+    """ Расчёт предсказаний по всем постам за все прошедшие месяцы
+
+    :param predictor: Predictor без подключенного хранилища
+    :param years: список лет
+    :return:
+    """
+    from gismeteo_parse import get_weather_version
+
+    uids = list(predictor.posts.keys())
+    values = np.full((len(uids), len(years), 12, 31), np.nan,
+                     dtype=np.float32)
+    computed = np.zeros((len(uids), len(years), 12), dtype=bool)
+    weather = {}
+
+    for i, uid in enumerate(uids):
+        # все месяцы поста рассчитываются одним вызовом модели
+        keys = [(uid, year, month) for year in years for month in range(1, 13)
+                if not is_live_month(year, month)]
+        for (_, year, month), result in predictor.predict_many(keys).items():
+            j = years.index(year)
+            days = result['date'].dt.day.to_numpy() - 1
+            values[i, j, month - 1, days] = result['result']
+            computed[i, j, month - 1] = True
+            # метео-данные загружены при расчёте предсказания
+            weather[_weather_key(uid, year, month)] = get_weather_version(
+                predictor.posts[uid], year, month)
+        print(f'{uid}: готово')
+
+    write_npy(PREDICTIONS_VALUES, values, is_raw=False)
+    write_npy(PREDICTIONS_COMPUTED, computed, is_raw=False)
+    index = {'uids': uids, 'years': list(years),
+             'model': get_model_fingerprint(), 'weather': weather}
+    # индекс записывается последним - без него хранилище не используется
+    write_data(PREDICTIONS_INDEX, data=index, is_raw=False)
+
+
+def main():
+    """ Формирование хранилища предсказаний для бота. Метео-данные, которых
+    нет в кэше, будут загружены с Gismeteo.
+    """
+    from predict import Predictor
+
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    years = list(range(PREDICT_START_YEAR, datetime.now().year + 1))
+    build_prediction_store(Predictor(posts), years)
+    print('Хранилище предсказаний сформировано')
+
+
+if __name__ == '__main__':
+    main()
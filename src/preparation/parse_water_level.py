@@ -1,7 +1,9 @@
+import tempfile
 from calendar import monthrange
 
 from bs4 import BeautifulSoup
 from htmlmin import minify
+from lxml import etree
 
 from preparation.utils import AuthError, get_auth_data
 from utils import *
@@ -207,90 +209,159 @@ def get_water_data(auth_cookie, years, posts_data):
     write_data(DATA_WATER_RAW, data=minify(r.text), is_raw=True)
 
 
-def form_dataset():
-    """ Формирование датасета: id_поста,дата,уровень_воды
+def _get_text(element):
+    return ''.join(element.itertext())
+
+
+def _has_class(element, class_name):
+    return class_name in (element.get('class') or '').split()
+
+
+def _parse_info_table(info_table):
+    """ Информация о посте из таблицы с классом table
+
+    :return: uid поста, год, отметка нуля, система высот
     """
-    water_data = open_file(DATA_WATER_RAW, is_raw=True)
-    soup = BeautifulSoup(water_data, 'lxml')
+    id_list = ['kod_hpr', 'year', 'altitude', 'alt_system']
+    infos = [_get_text(info) for info in info_table.iter('p')
+             if info.get('id') in id_list]
+    uid = infos[0]
+    year = int(infos[1])
+    [altitude, alt_system] = infos[2:]
+    return uid, year, altitude, alt_system
+
 
-    # Данные с информацией о постах находятся в таблицах с классом table
-    info_tables = soup.findAll('table', {'class': ['table']})
+def _parse_data_table(data_table, uid, year):
+    """ Наблюдения поста за год из таблицы с классом calend
+
+    :return: список [id_поста, дата, уровень_воды], отсортированный по дате
+    """
+    result = []
+    data_rows = list(data_table.iter('tr'))[1:]  # убираем заголовок
+    data_rows = data_rows[:31]  # убираем статистическую информацию
+    if _get_text(next(data_rows[0].iter('td'))) != '1':
+        raise Exception('В таблице не обнаружено первое число.')
+    for row in data_rows:
+        cells = list(row.iter('td'))
+        day = int(_get_text(cells[0]))
+        for month in range(0, 12):
+            # не во всех месяцах есть данные за все 31 день, пропускаем их
+            if day > monthrange(year, month + 1)[1]:
+                continue
+            water_level = _get_text(cells[month + 1]).strip()
+            if len(water_level) == 0 or \
+                    '-' in water_level or \
+                    water_level == 'прмз' or \
+                    water_level == 'прсх' or \
+                    water_level == 'пр' or \
+                    water_level == 'прс' or \
+                    water_level == 'прм':
+                # пусто или тире - данные не велись, пример - Кербо 2008
+                # прмз - река промерзла или пересохла
+                # расшифровка остальных не указана
+                continue
+            else:
+                try:
+                    water_level = re.search(r'\d+', water_level).group(0)
+                except Exception as e:
+                    print(etree.tostring(row, encoding='unicode'))
+                    print(water_level)
+                    raise e
+            result.append([uid, format_data(year, month + 1, day),
+                           water_level])
+    return sorted(result)
+
+
+def iter_water_tables(file_path):
+    """ Потоковый разбор файла с наблюдениями (lxml.etree.iterparse): в памяти
+    находится только текущая таблица, обработанные элементы удаляются.
+
+    :param file_path: путь к файлу water_data.html
+    :return: генератор (uid поста, год, отметка нуля, система высот,
+        наблюдения за год)
+    """
+    info = None
+    calend_count = 0
+    for _, element in etree.iterparse(file_path, events=('end',),
+                                      tag='table', html=True,
+                                      encoding='utf-8'):
+        if _has_class(element, 'table'):
+            # Данные с информацией о постах находятся в таблицах с классом
+            # table
+            if info is not None:
+                raise Exception('Число таблиц с информацией не совпадает '
+                                'с числом таблиц с наблюдениями.')
+            info = _parse_info_table(element)
+        elif _has_class(element, 'calend'):
+            # В таблицах с классом calend помимо необходимых наблюдений есть
+            # данные о статистике за год (низший, средний и высший уровни за
+            # год) - каждая вторая таблица, они не нужны, т.к. при
+            # необходимости их можно вычислить средствами pandas
+            calend_count += 1
+            if calend_count % 2 == 1:
+                if info is None:
+                    raise Exception('Число таблиц с информацией не совпадает '
+                                    'с числом таблиц с наблюдениями.')
+                uid, year, altitude, alt_system = info
+                yield uid, year, altitude, alt_system, \
+                    _parse_data_table(element, uid, year)
+                info = None
+        else:
+            continue
 
-    # В таблицах с классом calend помимо необходимых наблюдений есть данные
-    # о статистике за год (низший, средний и высший уровни за год)
-    # они не нужны, т.к. при необходимости их можно вычислить средствами pandas
-    data_tables = soup.findAll('table', {'class': ['calend']})[::2]
+        # освобождение памяти от уже обработанных элементов
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
 
-    if len(info_tables) != len(data_tables):
+    if info is not None:
         raise Exception('Число таблиц с информацией не совпадает '
                         'с числом таблиц с наблюдениями.')
 
-    result_data = []  # id_поста,дата,уровень_воды
-    result_info = {}  # id_поста,отметка_нуля,система_высот
-    id_list = ['kod_hpr', 'year', 'altitude', 'alt_system']
-    for i in range(len(info_tables)):
-        # информация
-        info_table = info_tables[i]
-        infos = [info.text for info in info_table.find_all('p', id=id_list)]
-        uid = infos[0]
-        year = int(infos[1])
-        [altitude, alt_system] = infos[2:]
-
-        if uid in result_info and result_info[uid] != [altitude, alt_system]:
-            raise Exception(f'У поста {uid} изменена отметка нуля '
-                            f'или система высот')
-        result_info[uid] = [altitude, alt_system]
-
-        # наблюдение
-        data_table = data_tables[i]
-        data_rows = data_table.find_all('tr')[1:]  # убираем заголовок
-        data_rows = data_rows[:31]  # убираем статистическую информацию
-        if data_rows[0].find('td').text != '1':
-            raise Exception('В таблице не обнаружено первое число.')
-        for row in data_rows:
-            cells = row.find_all('td')
-            day = int(cells[0].text)
-            for month in range(0, 12):
-                # не во всех месяцах есть данные за все 31 день, пропускаем их
-                if day > monthrange(year, month + 1)[1]:
-                    continue
-                water_level = cells[month + 1].text.strip()
-                if len(water_level) == 0 or \
-                        '-' in water_level or \
-                        water_level == 'прмз' or \
-                        water_level == 'прсх' or \
-                        water_level == 'пр' or \
-                        water_level == 'прс' or \
-                        water_level == 'прм':
-                    # пусто или тире - данные не велись, пример - Кербо 2008
-                    # прмз - река промерзла или пересохла
-                    # прмз - река промерзла или пересохла
-                    # расшифровка остальных не указана
-                    continue
-                else:
-                    try:
-                        water_level = re.search(r'\d+', water_level).group(0)
-                    except Exception as e:
-                        print(row)
-                        print(water_level)
-                        raise e
-                result_data.append([uid,
-                                    format_data(year, month + 1, day),
-                                    water_level])
-                # for day in range(0, monthrange(year, month + 1)[1]):
-                # print(month + 1, day + 1)
-        '''
-        for month in range(0, 12):
-            row = data_rows[month]
-            print(row)
-            #for day in range(0, monthrange(year, month + 1)[1]):
-                #print(month + 1, day + 1)
-                '''
 
+def iter_water_levels(file_path):
+    """ Наблюдения из файла water_data.html, отсортированные по посту и дате.
+
+    Таблицы в файле упорядочены по году, а затем по посту, поэтому
+    наблюдения каждого поста сначала записываются во временный файл, а затем
+    файлы постов читаются по порядку - в памяти находится не более одной
+    таблицы (или наблюдений одного поста, если годы идут не по порядку).
+
+    :param file_path: путь к файлу water_data.html
+    :return: генератор [id_поста, дата, уровень_воды]
+    """
+    result_info = {}  # id_поста: [отметка_нуля, система_высот, последний год]
+    unsorted_uids = set()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for uid, year, altitude, alt_system, rows in \
+                iter_water_tables(file_path):
+            if uid in result_info:
+                if result_info[uid][:2] != [altitude, alt_system]:
+                    raise Exception(f'У поста {uid} изменена отметка нуля '
+                                    f'или система высот')
+                if year <= result_info[uid][2]:
+                    unsorted_uids.add(uid)
+            result_info[uid] = [altitude, alt_system, year]
+
+            with open(os.path.join(tmp_dir, f'{uid}.csv'), mode='a',
+                      encoding='utf-8', newline='') as file:
+                csv.writer(file).writerows(rows)
+
+        for uid in sorted(result_info):
+            with open(os.path.join(tmp_dir, f'{uid}.csv'), mode='r',
+                      encoding='utf-8', newline='') as file:
+                rows = csv.reader(file)
+                if uid in unsorted_uids:
+                    rows = sorted(rows)
+                yield from rows
+
+
+def form_dataset():
+    """ Формирование датасета: id_поста,дата,уровень_воды
+    """
     header = ['uid', 'date', 'water_level']
-    result_data = sorted(result_data)
-    write_csv(DATA_WATER_LEVEL, header, result_data, is_raw=True)
-    # print(result_data)
+    rows = iter_water_levels(get_filepath(DATA_WATER_RAW, is_raw=True))
+    write_csv(DATA_WATER_LEVEL, header, rows, is_raw=True)
 
 
 def main():
@@ -0,0 +1,315 @@
+import argparse
+import logging
+import threading
+from time import monotonic
+
+from utils import *
+from metrics import PREWARM_HIT_RATIO, PREWARM_JOB_SECONDS, PREWARM_REQUESTS
+
+# Предварительный расчёт прогнозов для месяца, который только что стал
+# доступен для выбора (get_month_keyboard в main.py). Без него первый
+# пользователь, запросивший новый месяц, ждёт загрузки метео-данных,
+# предсказания и отрисовки графика.
+#
+# Планировщик работает в отдельном потоке бота и через ForecastRuntime
+# загружает метео-данные, рассчитывает и сохраняет в ChartCache графики всех
+# постов и тепловые карты подбассейнов. Расчёт идёт только:
+# - в часы низкой нагрузки (PREWARM_HOURS, по местному времени сервера);
+# - когда нет запросов пользователей;
+# - не больше PREWARM_CPU_BUDGET времени одного слота расчёта: после задания
+#   длительностью d следует пауза d * (1 - бюджет) / бюджет.
+# Задание пропускается, если график с текущей версией уже есть в кэше.
+# Длительность заданий и попадания запросов пользователей в кэш
+# предрассчитанных месяцев записываются в метрики (metrics.py).
+PREWARM_HOURS = (1, 7)  # [начало, конец), окно может переходить через полночь
+PREWARM_CPU_BUDGET = 0.5  # доля времени одного слота расчёта
+PREWARM_MONTHS = 1  # число последних доступных для выбора месяцев
+PREWARM_POLL = 60  # секунд, период проверки окна и новых месяцев
+PREWARM_BUSY_POLL = 5  # секунд, ожидание завершения запросов пользователей
+
+logger = logging.getLogger(__name__)
+
+
+def get_prewarm_months(now=None, count=PREWARM_MONTHS):
+    """ Последние месяцы, доступные пользователю для выбора: предыдущий
+    календарный месяц и count - 1 месяцев до него
+
+    :return: список (год, месяц)
+    """
+    now = now or datetime.now()
+    current = now.year * 12 + now.month - 1
+    result = []
+    for i in range(1, count + 1):
+        year, month = divmod(current - i, 12)
+        if year < PREDICT_START_YEAR:
+            break
+        result.append((year, month + 1))
+    return result
+
+
+def is_off_peak(hours, now=None):
+    """ Находится ли текущий час в окне низкой нагрузки [начало, конец) """
+    start, end = hours
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class PrewarmScheduler:
+    def __init__(self, posts, runtime, get_predictor, get_chart_cache,
+                 hours=PREWARM_HOURS, cpu_budget=PREWARM_CPU_BUDGET,
+                 months=PREWARM_MONTHS):
+        """
+        :param posts: словарь с информацией о постах
+        :param runtime: запущенный ForecastRuntime
+        :param get_predictor: функция, возвращающая Predictor основного
+            процесса
+        :param get_chart_cache: функция, возвращающая ChartCache
+        :param hours: окно низкой нагрузки (начальный час, конечный час) или
+            None - расчёт в любое время
+        :param cpu_budget: доля времени одного слота расчёта (0, 1]
+        :param months: число последних доступных для выбора месяцев
+        """
+        if not 0 < cpu_budget <= 1:
+            raise ValueError('cpu_budget должен быть в интервале (0, 1]')
+        self.posts = posts
+        self.runtime = runtime
+        self.get_predictor = get_predictor
+        self.get_chart_cache = get_chart_cache
+        self.hours = hours
+        self.cpu_budget = cpu_budget
+        self.months = months
+
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.targets = []  # (год, месяц)
+        self.failed = set()  # задания с ошибкой, до смены месяцев
+
+        # метрики
+        self.warmed = 0  # рассчитанные задания
+        self.warm = set()  # задания, график которых есть в кэше
+        self.errors = 0
+        self.durations = []  # длительности рассчитанных заданий, секунд
+        self.requests = 0  # запросы пользователей за предрассчитанные месяцы
+        self.hits = 0  # из них отправленные из кэша
+
+    def start(self):
+        PREWARM_HIT_RATIO.set_function(self._get_hit_ratio)
+        self.thread = threading.Thread(target=self._loop, name='prewarm',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def get_jobs(self):
+        """ Задания на текущие месяцы: сначала посты, затем подбассейны,
+        метео-данные которых к этому моменту уже загружены
+
+        :return: список (uid поста или None, id подбассейна или None, год,
+            месяц)
+        """
+        subpools = sorted({post['subpool_id'] for post in self.posts.values()})
+        jobs = []
+        for year, month in self.targets:
+            jobs += [(uid, None, year, month) for uid in self.posts]
+            jobs += [(None, subpool_id, year, month)
+                     for subpool_id in subpools]
+        return jobs
+
+    def is_warm(self, job):
+        """ Отправит ли бот график задания из кэша без расчёта """
+        uid, subpool_id, year, month = job
+        predictor = self.get_predictor()
+        chart_cache = self.get_chart_cache()
+        if uid is not None:
+            if not predictor.is_cached_data(uid, year, month):
+                return False
+            return chart_cache.has_png(
+                uid, year, month, chart_cache.get_version(uid, year, month))
+
+        if not all(predictor.is_cached_data(uid, year, month)
+                   for uid, post in self.posts.items()
+                   if post['subpool_id'] == subpool_id):
+            return False
+        return chart_cache.has_png(
+            chart_cache.pool_key(subpool_id), year, month,
+            chart_cache.get_pool_version(subpool_id, year, month))
+
+    def run_job(self, job):
+        """ Расчёт графика задания и сохранение его в кэш
+
+        :return: длительность, секунд
+        """
+        uid, subpool_id, year, month = job
+        chart_cache = self.get_chart_cache()
+        start = monotonic()
+        if uid is not None:
+            png = self.runtime.render(uid, year, month)
+            chart_cache.put_png(uid, year, month,
+                                chart_cache.get_version(uid, year, month), png)
+        else:
+            png = self.runtime.render_pool(subpool_id, year, month)
+            chart_cache.put_png(
+                chart_cache.pool_key(subpool_id), year, month,
+                chart_cache.get_pool_version(subpool_id, year, month), png)
+        return monotonic() - start
+
+    def _update_targets(self):
+        targets = get_prewarm_months(count=self.months)
+        with self.lock:
+            if targets != self.targets:
+                logger.info('Предварительный расчёт месяцев: %s', targets)
+                self.targets = targets
+                self.failed.clear()
+                self.warm.clear()
+
+    def _next_job(self):
+        result = None
+        for job in self.get_jobs():
+            is_warm = self.is_warm(job)
+            with self.lock:
+                if is_warm:
+                    self.warm.add(job)
+                else:
+                    self.warm.discard(job)
+            if result is None and not is_warm and job not in self.failed:
+                result = job
+        return result
+
+    def _is_busy(self):
+        return self.runtime.active > 0 or self.runtime.queue_depth > 0
+
+    def _loop(self):
+        while not self.stop_event.is_set():
+            if self.hours is not None and not is_off_peak(self.hours):
+                self.stop_event.wait(PREWARM_POLL)
+                continue
+            if self._is_busy():
+                # запросы пользователей в приоритете
+                self.stop_event.wait(PREWARM_BUSY_POLL)
+                continue
+
+            self._update_targets()
+            job = self._next_job()
+            if job is None:
+                self.stop_event.wait(PREWARM_POLL)
+                continue
+
+            duration = self._run(job)
+            self.stop_event.wait(
+                duration * (1 - self.cpu_budget) / self.cpu_budget)
+
+    def _run(self, job):
+        start = monotonic()
+        try:
+            duration = self.run_job(job)
+        except Exception:
+            logger.exception('Ошибка предварительного расчёта %s', job)
+            PREWARM_JOB_SECONDS.observe('error', value=monotonic() - start)
+            with self.lock:
+                self.errors += 1
+                self.failed.add(job)
+            return monotonic() - start
+
+        PREWARM_JOB_SECONDS.observe('ok', value=duration)
+        with self.lock:
+            self.warmed += 1
+            self.warm.add(job)
+            self.durations.append(duration)
+        return duration
+
+    def run_once(self):
+        """ Расчёт всех заданий без учёта окна и бюджета (запуск отдельным
+        процессом)
+        """
+        self._update_targets()
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            self._run(job)
+
+    def record_request(self, year, month, is_hit):
+        """ Учёт запроса пользователя для доли попаданий в кэш
+
+        :param is_hit: график отправлен из кэша без расчёта
+        """
+        with self.lock:
+            if (year, month) not in self.targets:
+                return
+            self.requests += 1
+            self.hits += int(is_hit)
+        PREWARM_REQUESTS.inc('hit' if is_hit else 'miss')
+
+    def _get_hit_ratio(self):
+        with self.lock:
+            return self.hits / self.requests if self.requests else 0
+
+    def stats(self):
+        with self.lock:
+            durations = sorted(self.durations)
+            return {'months': [f'{y}-{m:02d}' for y, m in self.targets],
+                    'off_peak': self.hours is None or is_off_peak(self.hours),
+                    'jobs': len(self.get_jobs()),
+                    'warm': len(self.warm),
+                    'warmed': self.warmed,
+                    'errors': self.errors,
+                    'job_mean': round(sum(durations) / len(durations), 3)
+                    if durations else 0,
+                    'job_p95': round(durations[int(len(durations) * 0.95)],
+                                     3) if durations else 0,
+                    'job_max': round(durations[-1], 3) if durations else 0,
+                    'requests': self.requests,
+                    'hit_ratio': round(self.hits / self.requests, 3)
+                    if self.requests else None}
+
+
+def main():
+    """ Предварительный расчёт прогнозов отдельным процессом, например по
+    расписанию cron в начале месяца. Графики сохраняются в
+    data\\processed\\charts\\ и используются ботом.
+
+    Пример: python src/prewarm.py --months 2
+    """
+    from chart_cache import ChartCache
+    from forecast import set_chart_quality, setup_locale
+    from predict import Predictor
+    from prediction_store import PredictionStore
+    from runtime import ForecastRuntime, RUNTIME_PROCESSES
+
+    parser = argparse.ArgumentParser(
+        description='Предварительный расчёт прогнозов за последние месяцы')
+    parser.add_argument('--months', type=int, default=PREWARM_MONTHS)
+    parser.add_argument('--processes', type=int, default=RUNTIME_PROCESSES)
+    # качество должно совпадать с ботом, иначе графики не будут использованы
+    parser.add_argument('--chart-dpi', type=int, default=CHART_DPI)
+    parser.add_argument('--chart-compress-level', type=int,
+                        choices=range(10), default=CHART_COMPRESS_LEVEL)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    setup_locale()
+    set_chart_quality(args.chart_dpi, args.chart_compress_level)
+    posts = json.loads(open_file(DATA_POSTS_FULL_RAW, is_raw=True))
+    predictor = Predictor(posts, store=PredictionStore.load())
+    chart_cache = ChartCache(posts)
+    runtime = ForecastRuntime(posts, lambda: predictor,
+                              processes=args.processes)
+    runtime.start()
+
+    scheduler = PrewarmScheduler(posts, runtime, lambda: predictor,
+                                 lambda: chart_cache, hours=None,
+                                 months=args.months)
+    start = monotonic()
+    scheduler.run_once()
+    runtime.stop()
+    print(f'Рассчитано за {monotonic() - start:.0f} с: {scheduler.stats()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from time import monotonic, sleep
+
+from utils import *
+
+# Сэмплирующий профилировщик для работающего бота. Пока профилирование не
+# запущено, никакого кода в потоках бота не выполняется. После запуска
+# отдельный поток в течение заданного времени периодически снимает стеки
+# всех потоков процесса (sys._current_frames) и записывает:
+# - data\processed\profiles\<время>.folded - стеки в формате collapsed
+#   stacks (flamegraph.pl, speedscope): "поток;функция;...;функция число";
+# - data\processed\profiles\<время>.txt - функции с наибольшим собственным
+#   и общим временем.
+# Процессы-обработчики (--processes) не профилируются: для профиля
+# предсказания и отрисовки графиков бот запускается с --processes 0.
+PROFILES_DIR = 'profiles'
+PROFILE_DURATION = 30  # секунд
+PROFILE_MAX_DURATION = 300  # секунд
+PROFILE_INTERVAL = 0.01  # секунд между замерами
+PROFILE_TOP = 25  # число функций в отчёте
+# потоки, ожидающие в этих функциях, считаются простаивающими и не
+# учитываются (ожидание сети в socket/ssl учитывается)
+IDLE_FRAMES = {('threading.py', 'wait'),
+               ('threading.py', '_wait_for_tstate_lock'),
+               ('selectors.py', 'select'),
+               ('queue.py', 'get'),
+               ('thread.py', '_worker'),  # ThreadPoolExecutor без заданий
+               ('socketserver.py', 'serve_forever'),
+               ('updater.py', 'idle')}
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:' \
+           f'{code.co_firstlineno})'
+
+
+def _is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename),
+            frame.f_code.co_name) in IDLE_FRAMES
+
+
+def sample_stacks(duration, interval=PROFILE_INTERVAL, include_idle=False):
+    """ Замеры стеков всех потоков процесса, кроме текущего
+
+    :param duration: длительность профилирования, секунд
+    :param interval: время между замерами, секунд
+    :param include_idle: учитывать простаивающие потоки
+    :return: (Counter стек в формате collapsed stacks: число замеров,
+        число замеров)
+    """
+    own_thread = threading.get_ident()
+    stacks = Counter()
+    samples = 0
+    end = monotonic() + duration
+    while monotonic() < end:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread or (not include_idle
+                                           and _is_idle(frame)):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            stacks[';'.join(reversed(stack))] += 1
+        samples += 1
+        sleep(interval)
+    return stacks, samples
+
+
+def format_summary(stacks, samples, duration, top=PROFILE_TOP):
+    """ Отчёт с функциями, на которые приходится больше всего замеров:
+    собственное время (функция в вершине стека) и общее время (функция
+    где-либо в стеке)
+    """
+    total = sum(stacks.values())
+    own_time = Counter()
+    cumulative_time = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(';')[1:]  # без названия потока
+        if frames:
+            own_time[frames[-1]] += count
+        for frame in set(frames):
+            cumulative_time[frame] += count
+
+    lines = [f'Замеров: {samples} за {duration} с, стеков потоков: {total}']
+    for title, counter in [('Собственное время', own_time),
+                           ('Общее время', cumulative_time)]:
+        lines.append(f'{title}:')
+        for frame, count in counter.most_common(top):
+            lines.append(f'{count / total * 100:6.1f}% {count:7} {frame}')
+    return '\n'.join(lines)
+
+
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL, top=PROFILE_TOP):
+        """
+        :param interval: время между замерами, секунд
+        :param top: число функций в отчёте
+        """
+        self.interval = interval
+        self.top = top
+        self.thread = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self.thread is not None
+
+    def start(self, duration=PROFILE_DURATION, callback=None):
+        """ Запуск профилирования в отдельном потоке
+
+        :param duration: длительность, секунд (не больше PROFILE_MAX_DURATION)
+        :param callback: функция (путь к .folded, путь к отчёту, отчёт),
+            вызываемая после записи результатов
+        :return: False, если профилирование уже запущено
+        """
+        duration = min(duration, PROFILE_MAX_DURATION)
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.thread = threading.Thread(target=self._run,
+                                           args=(duration, callback),
+                                           name='profiler', daemon=True)
+            self.thread.start()
+        logger.info('Профилирование запущено на %s с', duration)
+        return True
+
+    def _run(self, duration, callback):
+        try:
+            stacks, samples = sample_stacks(duration, self.interval)
+            summary = format_summary(stacks, samples, duration, self.top)
+            name = os.path.join(PROFILES_DIR,
+                                datetime.now().strftime('%Y%m%d-%H%M%S'))
+            write_data(f'{name}.folded',
+                       data=''.join(f'{stack} {count}\n'
+                                    for stack, count in stacks.items()),
+                       is_raw=False)
+            write_data(f'{name}.txt', data=summary + '\n', is_raw=False)
+            folded_path = get_filepath(f'{name}.folded', is_raw=False)
+            summary_path = get_filepath(f'{name}.txt', is_raw=False)
+            logger.info('Профилирование завершено: %s, %s', folded_path,
+                        summary_path)
+            if callback:
+                callback(folded_path, summary_path, summary)
+        except Exception:
+            logger.exception('Ошибка профилирования')
+        finally:
+            with self.lock:
+                self.thread = None
@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from forecast import compute_chart, compute_pool_chart, get_pool_uids
+from forecast import chart_quality, set_chart_quality, setup_locale, warm_up
+from gismeteo_parse import get_weather_data, is_gismeteo_cached
+from metrics import RUNTIME_ACTIVE, RUNTIME_QUEUE_DEPTH, add_spans, collect
+from metrics import merge
+from singleflight import AsyncSingleFlight
+from supervisor import WorkerSupervisor
+from utils import PREDICT_BACKEND
+
+# Неблокирующий конвейер построения прогнозов для бота.
+# Обработчики python-telegram-bot работают в потоках, поэтому конвейер
+# запускает собственный цикл asyncio в отдельном потоке:
+# 1. загрузка метео-данных с Gismeteo выполняется асинхронной задачей
+#    в пуле потоков ввода-вывода и не занимает процессы-обработчики;
+# 2. предсказание XGBoost и отрисовка графика выполняются в ограниченном пуле
+#    процессов, каждый из которых один раз загружает модель и данные;
+# 3. одинаковые запросы (пост, год, месяц), пришедшие во время расчёта,
+#    ожидают результат уже запущенной задачи.
+# В режиме prefork вместо пула процессов используется WorkerSupervisor:
+# обработчики создаются через fork и получают уже загруженные модель и данные
+# основного процесса (см. supervisor.py).
+# Метрики этапов расчёта собираются в потоке или процессе, выполнявшем
+# расчёт, и возвращаются вместе с результатом: они записываются в метрики
+# основного процесса и в трассировку ожидающих результат обработчиков.
+RUNTIME_PROCESSES = 2  # 0 - расчёт в потоках основного процесса
+RUNTIME_CONCURRENCY = 4  # число одновременно рассчитываемых прогнозов
+RUNTIME_IO_THREADS = 4  # число одновременных запросов к Gismeteo
+RUNTIME_STATS_INTERVAL = 600  # секунд, период записи метрик в лог
+
+logger = logging.getLogger(__name__)
+
+_worker_predictor = None
+
+
+def _init_worker(posts, backend, quality):
+    """ Инициализация процесса-обработчика
+
+    :param quality: качество графиков основного процесса (chart_quality)
+    """
+    global _worker_predictor
+    from predict import Predictor
+    from prediction_store import PredictionStore
+
+    setup_locale()
+    set_chart_quality(**quality)
+    _worker_predictor = Predictor(posts, store=PredictionStore.load(),
+                                  backend=backend)
+    warm_up(_worker_predictor)
+
+
+def _collected(func, *args):
+    """ Вызов func с наблюдениями метрик, собранными в список
+
+    :return: (результат func, наблюдения)
+    """
+    with collect() as observations:
+        result = func(*args)
+    return result, observations
+
+
+def _compute_in_worker(uid, year, month):
+    return _collected(compute_chart, _worker_predictor, uid, year, month)
+
+
+def _compute_pool_in_worker(subpool_id, year, month):
+    return _collected(compute_pool_chart, _worker_predictor, subpool_id,
+                      year, month)
+
+
+def _worker_ready():
+    return _worker_predictor is not None
+
+
+class ForecastRuntime:
+    def __init__(self, posts, get_predictor, processes=RUNTIME_PROCESSES,
+                 concurrency=RUNTIME_CONCURRENCY,
+                 io_threads=RUNTIME_IO_THREADS, prefork=False,
+                 backend=PREDICT_BACKEND):
+        """
+        :param posts: словарь с информацией о постах
+        :param get_predictor: функция, возвращающая Predictor основного
+            процесса, используется при processes = 0 и в режиме prefork
+        :param processes: число процессов для предсказания и отрисовки
+        :param concurrency: число одновременно рассчитываемых прогнозов
+        :param io_threads: число потоков для загрузки метео-данных
+        :param prefork: создавать процессы через fork из основного процесса
+            с уже загруженными моделью и данными
+        :param backend: способ расчёта предсказаний в процессах пула
+            (PREDICT_BACKENDS)
+        """
+        self.posts = posts
+        self.get_predictor = get_predictor
+        self.processes = processes
+        self.concurrency = concurrency
+        self.backend = backend
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='forecast-runtime', daemon=True)
+        self.io_executor = ThreadPoolExecutor(max_workers=io_threads,
+                                              thread_name_prefix='gismeteo')
+        self.supervisor = None
+        if processes > 0 and prefork:
+            self.supervisor = WorkerSupervisor(processes)
+            self.cpu_executor = self.supervisor
+        elif processes > 0:
+            self.cpu_executor = self._create_pool()
+        else:
+            self.cpu_executor = ThreadPoolExecutor(
+                max_workers=concurrency, thread_name_prefix='forecast')
+        self.semaphore = None
+        # ключ: (uid, year, month) или ('pool', subpool_id, year, month)
+        self.flight = AsyncSingleFlight()
+
+        # метрики
+        self.queue_depth = 0  # запросы, ожидающие свободного слота
+        self.active = 0  # рассчитываемые прогнозы
+
+    def _create_pool(self):
+        return ProcessPoolExecutor(max_workers=self.processes,
+                                   initializer=_init_worker,
+                                   initargs=(self.posts, self.backend,
+                                             dict(chart_quality)))
+
+    def start(self):
+        global _worker_predictor
+
+        if self.supervisor is not None:
+            # обработчики наследуют загруженные Predictor и шаблон графика
+            # основного процесса. Запуск до старта потоков, чтобы обработчики
+            # не унаследовали захваченные блокировки
+            _worker_predictor = self.get_predictor()
+            warm_up(_worker_predictor)
+            self.supervisor.start()
+        RUNTIME_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+        RUNTIME_ACTIVE.set_function(lambda: self.active)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._create_semaphore(),
+                                         self.loop).result()
+
+    def preload(self):
+        """ Загрузка модели и данных во всех процессах до первого запроса """
+        if self.processes == 0:
+            warm_up(self.get_predictor())
+        elif self.supervisor is None:
+            # пул запускает процессы при отправке заданий, инициализация
+            # процесса выполняется до первого задания
+            futures = [self.cpu_executor.submit(_worker_ready)
+                       for _ in range(self.processes)]
+            for future in futures:
+                future.result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.io_executor.shutdown()
+        self.cpu_executor.shutdown()
+
+    async def _create_semaphore(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    def stats(self):
+        result = {'queue_depth': self.queue_depth,
+                  'active': self.active,
+                  'in_flight': len(self.flight.calls),
+                  **self.flight.stats()}
+        if self.supervisor is not None:
+            result.update(self.supervisor.stats())
+        return result
+
+    def worker_pids(self):
+        """ Процессы расчёта: {номер: pid} """
+        if self.supervisor is not None:
+            return self.supervisor.pids()
+        if self.processes > 0:
+            # у ProcessPoolExecutor нет открытого списка процессов
+            processes = getattr(self.cpu_executor, '_processes', None) or {}
+            return dict(enumerate(sorted(processes)))
+        return {}
+
+    def recycle_workers(self, numbers):
+        """ Плавный перезапуск процессов расчёта (номера из worker_pids):
+        текущие задания выполняются до конца, новые - в новых процессах.
+        Пул процессов (без prefork) перезапускается целиком.
+        """
+        if self.supervisor is not None:
+            for number in numbers:
+                self.supervisor.recycle(number)
+        elif self.processes > 0 and numbers:
+            self.loop.call_soon_threadsafe(self._replace_pool)
+
+    def _replace_pool(self):
+        # выполняется в цикле asyncio, как и отправка заданий в _run
+        pool = self.cpu_executor
+        self.cpu_executor = self._create_pool()
+        pool.shutdown(wait=False)
+        logger.info('Пул процессов расчёта перезапущен')
+
+    def render(self, uid, year, month, timeout=None):
+        """ Построение графика с прогнозом. Блокирует только вызывающий поток.
+
+        :return: изображение в формате PNG (bytes)
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.flight.do((uid, year, month), self._compute, uid, year,
+                           month), self.loop)
+        png, observations = future.result(timeout)
+        add_spans(observations)
+        return png
+
+    def render_pool(self, subpool_id, year, month, timeout=None):
+        """ Построение тепловой карты прогноза по всем постам подбассейна
+
+        :return: изображение в формате PNG (bytes)
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.flight.do(('pool', subpool_id, year, month),
+                           self._compute_pool, subpool_id, year, month),
+            self.loop)
+        png, observations = future.result(timeout)
+        add_spans(observations)
+        return png
+
+    async def _compute(self, uid, year, month):
+        """ :return: (PNG, наблюдения метрик) """
+        observations = await self._load_weather([uid], year, month)
+        png, computed = await self._run(_compute_in_worker, compute_chart,
+                                        uid, year, month)
+        logger.info('Прогноз %s-%s-%s рассчитан, очередь: %s',
+                    uid, year, month, self.queue_depth)
+        return png, observations + computed
+
+    async def _compute_pool(self, subpool_id, year, month):
+        """ :return: (PNG, наблюдения метрик) """
+        observations = await self._load_weather(
+            get_pool_uids(self.posts, subpool_id), year, month)
+        png, computed = await self._run(_compute_pool_in_worker,
+                                        compute_pool_chart, subpool_id, year,
+                                        month)
+        logger.info('Прогноз по подбассейну %s-%s-%s рассчитан, очередь: %s',
+                    subpool_id, year, month, self.queue_depth)
+        return png, observations + computed
+
+    async def _load_weather(self, uids, year, month):
+        """ Загрузка метео-данных, которых нет в кэше. Загрузка не занимает
+        слот расчёта.
+
+        :return: наблюдения метрик загрузки
+        """
+        posts = [self.posts[uid] for uid in uids]
+        results = await asyncio.gather(*[
+            self.loop.run_in_executor(self.io_executor, _collected,
+                                      get_weather_data, post, year, month)
+            for post in posts if not is_gismeteo_cached(post, year, month)])
+        observations = [observation for _, post_observations in results
+                        for observation in post_observations]
+        merge(observations)
+        return observations
+
+    async def _run(self, worker_func, func, *args):
+        """ Расчёт в пуле процессов (worker_func) или, при processes = 0,
+        в потоке основного процесса (func с Predictor первым аргументом)
+
+        :return: (результат, наблюдения метрик)
+        """
+        self.queue_depth += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+
+        self.active += 1
+        try:
+            if self.processes > 0:
+                result, observations = await self.loop.run_in_executor(
+                    self.cpu_executor, worker_func, *args)
+            else:
+                result, observations = await self.loop.run_in_executor(
+                    self.cpu_executor, _collected, func,
+                    self.get_predictor(), *args)
+            merge(observations)
+            return result, observations
+        finally:
+            self.active -= 1
+            self.semaphore.release()
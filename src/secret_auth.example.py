@@ -3,3 +3,6 @@ water_level_login = {'username': 'enter login', 'password': 'enter_password'}
 
 tg_bot_token = '000000000:Please_enter_valid_telegram_bot_token'
 
+
+# Telegram user ids allowed to run /profile (with --profiler)
+tg_admin_ids = []
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+
+# Объединение одинаковых одновременных запросов (single-flight): первый
+# вызов с заданным ключом выполняет расчёт, а остальные вызовы с тем же
+# ключом, пришедшие до его завершения, ожидают и получают тот же результат
+# (или то же исключение). Результат общий для всех вызовов - его нельзя
+# изменять.
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Single-flight для потоков """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # ключ: _Call
+        self.computed = 0  # выполненные расчёты
+        self.coalesced = 0  # вызовы, получившие результат чужого расчёта
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self.calls[key] = call
+                self.computed += 1
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def stats(self):
+        return {'computed': self.computed, 'coalesced': self.coalesced}
+
+
+class AsyncSingleFlight:
+    """ Single-flight для корутин одного цикла asyncio """
+
+    def __init__(self):
+        self.calls = {}  # ключ: asyncio.Task
+        self.computed = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+            self.computed += 1
+        else:
+            self.coalesced += 1
+        # shield - отмена ожидания одним вызовом не отменяет общий расчёт
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {'computed': self.computed, 'coalesced': self.coalesced}
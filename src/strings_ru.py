@@ -18,6 +18,13 @@ PREDICT_MESSAGE = '🏠 <b>{}</b>\n' \
                   '<a href="{}">🌡️ архив погоды в Gismeteo</a>\n\n' \
                   'Для повтора выполните команду /start'
 
+POOL_MESSAGE = '🌊 Подбассейн <b>{}</b>\n' \
+               '📅 Период предсказания: <b>{} {} г.</b>\n\n' \
+               'Цвет показывает, где находится предсказанный уровень воды ' \
+               'в историческом диапазоне каждого пункта: от минимума ' \
+               '(синий) до максимума (красный).\n\n' \
+               'Для повтора выполните команду /start'
+
 PLEASE_WAIT_MESSAGE = '⌛ Пожалуйста, подождите 10 секунд - идёт запрос ' \
                       'метео-данных Gismeteo…'
 
@@ -27,6 +34,10 @@ SELECT_SUBPOOL = '🌊 Для отображения пунктов наблюд
 SELECT_POST = '🌊 Вы выбрали подбассейн <b>{}</b>.\n\n' \
               '🏠Выберите <u>пункт наблюдения</u>, по которому нужно сделать ' \
               'предсказание уровня воды:'
+SELECT_POOL_YEAR = '🌊 Вы выбрали все пункты подбассейна <b>{}</b>.\n\n' \
+                   '📅 Теперь выберите <u>год</u>:'
+SELECT_POOL_MONTH = 'Вы выбрали 🌊подбассейн <b>{}</b> и 📅<b>{}</b> год.\n\n' \
+                    '🔢 Выберите <u>месяц</u>:'
 SELECT_YEAR = '🏠 Вы выбрали пункт <b>{}</b>.\n\n' \
               '📅 Теперь выберите <u>год</u>:'
 SELECT_MONTH = 'Вы выбрали 🏠пункт <b>{}</b> и 📅<b>{}</b> год.\n\n' \
@@ -39,4 +50,11 @@ PREDICTED_VALUE = 'Предсказание'
 HISTORY_MIN = 'Ист. минимум'
 HISTORY_MEAN = 'Ист. среднее'
 HISTORY_MAX = 'Ист. максимум'
+POOL_TITLE = 'Предсказание уровня воды по пунктам за {} {} г.'
+POOL_LEVEL = 'Доля ист. диапазона (0 - минимум, 1 - максимум)'
+POOL_LABEL = '🌊 Все пункты подбассейна'
 BACK_LABEL = '⬅️ Назад'
+
+# Profiler
+PROFILE_STARTED = '⏱ Профилирование запущено на {} с.'
+PROFILE_RUNNING = '⏱ Профилирование уже запущено.'
@@ -0,0 +1,342 @@
+import gc
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future
+from multiprocessing.connection import Client, Listener
+from time import monotonic, sleep
+
+# Режим супервизора: модель и данные загружаются один раз в основном
+# процессе, после чего запускается процесс-шаблон (zygote), из которого
+# через fork создаются процессы-обработчики. Обработчики получают уже
+# загруженные модель и данные без повторной загрузки, память общая до первой
+# записи (copy-on-write), а массивы хранилищ открыты через memory-map.
+#
+# Процесс-шаблон создаётся до запуска потоков основного процесса, поэтому
+# упавшие обработчики перезапускаются из него без риска унаследовать
+# блокировки, захваченные другими потоками бота. Каждый обработчик
+# подключается к супервизору через локальный сокет, задания распределяются
+# по наименее загруженным обработчикам.
+#
+# Обработчик можно плавно перезапустить (recycle), например, при превышении
+# лимита памяти: новые задания ему не отправляются, а после выполнения
+# текущих он завершается и создаётся заново из процесса-шаблона.
+#
+# Работает только на платформах с fork (Linux, macOS).
+SUPERVISOR_WORKERS = 2
+RESTART_DELAY = 1  # секунд, задержка перезапуска сразу упавшего обработчика
+# секунд, период проверки того, что процесс-шаблон не завершился: обработчик,
+# созданный во время остановки супервизора, не дождётся подключения
+ORPHAN_CHECK_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerCrashedError(Exception):
+    """ Обработчик завершился во время выполнения задания """
+
+
+class _Worker:
+    def __init__(self, slot):
+        self.slot = slot
+        self.conn = None
+        self.pid = None
+        self.lock = threading.Lock()  # отправка заданий
+        self.pending = {}  # номер задания: Future
+        self.started = None  # время первого подключения (monotonic)
+        self.connected = None  # время подключения текущего процесса
+        self.completed = 0
+        self.failed = 0
+        self.restarts = 0
+        self.recycles = 0
+        self.retiring = False  # перезапуск после выполнения текущих заданий
+        self.busy_time = 0.0  # время выполнения заданий, секунд
+
+    def stats(self):
+        # счётчики общие для всех перезапусков обработчика
+        uptime = monotonic() - self.started if self.started else 0
+        return {'slot': self.slot,
+                'pid': self.pid,
+                'alive': self.conn is not None,
+                'pending': len(self.pending),
+                'completed': self.completed,
+                'failed': self.failed,
+                'restarts': self.restarts,
+                'recycles': self.recycles,
+                'busy': round(self.busy_time / uptime, 3) if uptime else 0,
+                'per_minute': round(self.completed * 60 / uptime, 2)
+                if uptime else 0}
+
+
+def _worker_main(address, authkey, slot):
+    """ Цикл процесса-обработчика: получение и выполнение заданий """
+    threading.Thread(target=_exit_with_zygote, args=(os.getppid(),),
+                     daemon=True).start()
+    conn = Client(address, authkey=authkey)
+    conn.send(('hello', slot, os.getpid()))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+
+        task_id, fn, args, kwargs = task
+        start = monotonic()
+        try:
+            result = (True, fn(*args, **kwargs))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send((task_id, monotonic() - start, *result))
+        except Exception as e:  # результат или исключение не сериализуется
+            conn.send((task_id, monotonic() - start, False,
+                       RuntimeError(repr(e))))
+
+
+def _exit_with_zygote(zygote_pid):
+    """ Завершение обработчика после завершения процесса-шаблона """
+    while os.getppid() == zygote_pid:
+        sleep(ORPHAN_CHECK_INTERVAL)
+    os._exit(0)
+
+
+def _zygote_main(conn, address, authkey):
+    """ Процесс-шаблон: создание обработчиков по запросу супервизора """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C - в основном
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # без процессов-зомби
+    while True:
+        try:
+            slot = conn.recv()
+        except EOFError:
+            return
+        if slot is None:
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            code = 0
+            try:
+                _worker_main(address, authkey, slot)
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+
+
+class WorkerSupervisor(Executor):
+    def __init__(self, workers=SUPERVISOR_WORKERS):
+        """
+        :param workers: число процессов-обработчиков
+        """
+        self.workers = [_Worker(slot) for slot in range(workers)]
+        self.authkey = os.urandom(32)
+        self.listener = None
+        self.zygote = None
+        self.zygote_conn = None
+        self.lock = threading.Lock()
+        self.backlog = deque()  # задания, ожидающие подключения обработчика
+        self.next_task_id = 0
+        self.is_shutdown = False
+
+    def start(self):
+        """ Запуск процесса-шаблона и обработчиков. Вызывать после загрузки
+        модели и данных и до запуска потоков основного процесса.
+        """
+        context = multiprocessing.get_context('fork')
+        self.listener = Listener(family='AF_UNIX', authkey=self.authkey)
+        self.zygote_conn, child_conn = context.Pipe()
+
+        # объекты, созданные при загрузке, не отслеживаются сборщиком мусора,
+        # чтобы он не изменял их страницы памяти в обработчиках
+        gc.collect()
+        gc.freeze()
+        self.zygote = context.Process(target=_zygote_main,
+                                      args=(child_conn, self.listener.address,
+                                            self.authkey),
+                                      name='forecast-zygote', daemon=True)
+        self.zygote.start()
+        child_conn.close()
+
+        threading.Thread(target=self._accept_loop, name='supervisor-accept',
+                         daemon=True).start()
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker):
+        try:
+            self.zygote_conn.send(worker.slot)
+        except OSError:
+            logger.error('Процесс-шаблон завершился, обработчик %s не '
+                         'будет перезапущен', worker.slot)
+
+    def _accept_loop(self):
+        while not self.is_shutdown:
+            try:
+                conn = self.listener.accept()
+                _, slot, pid = conn.recv()
+            except (OSError, EOFError):
+                continue
+            worker = self.workers[slot]
+            with self.lock:
+                worker.conn = conn
+                worker.pid = pid
+                worker.retiring = False
+                worker.connected = monotonic()
+                worker.started = worker.started or worker.connected
+            logger.info('Обработчик %s запущен, pid %s', slot, pid)
+            threading.Thread(target=self._read_loop, args=(worker, conn),
+                             name=f'supervisor-worker-{slot}',
+                             daemon=True).start()
+            self._drain_backlog()
+
+    def _read_loop(self, worker, conn):
+        while True:
+            try:
+                task_id, duration, is_ok, result = conn.recv()
+            except (OSError, EOFError):
+                break
+            with self.lock:
+                future = worker.pending.pop(task_id, None)
+                worker.busy_time += duration
+                if is_ok:
+                    worker.completed += 1
+                else:
+                    worker.failed += 1
+            if future is not None:
+                if is_ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+            self._stop_if_retired(worker)
+
+        with self.lock:
+            worker.conn = None
+            pending = list(worker.pending.values())
+            worker.pending.clear()
+            uptime = monotonic() - worker.connected
+            is_recycled = worker.retiring
+        conn.close()
+        for future in pending:
+            future.set_exception(WorkerCrashedError(
+                f'Обработчик {worker.slot} (pid {worker.pid}) завершился'))
+        if self.is_shutdown:
+            return
+        if is_recycled:
+            logger.info('Обработчик %s (pid %s) завершён для перезапуска',
+                        worker.slot, worker.pid)
+        else:
+            logger.warning('Обработчик %s (pid %s) завершился, перезапуск',
+                           worker.slot, worker.pid)
+            if uptime < RESTART_DELAY:
+                sleep(RESTART_DELAY)
+            with self.lock:
+                worker.restarts += 1
+        self._spawn(worker)
+
+    def recycle(self, slot):
+        """ Плавный перезапуск обработчика: новые задания ему не
+        отправляются, после выполнения текущих он завершается и создаётся
+        заново
+
+        :return: False, если обработчик не запущен или уже перезапускается
+        """
+        worker = self.workers[slot]
+        with self.lock:
+            if worker.conn is None or worker.retiring:
+                return False
+            worker.retiring = True
+            worker.recycles += 1
+        logger.info('Перезапуск обработчика %s (pid %s)', worker.slot,
+                    worker.pid)
+        self._stop_if_retired(worker)
+        return True
+
+    def _stop_if_retired(self, worker):
+        with self.lock:
+            if not worker.retiring or worker.pending or worker.conn is None:
+                return
+            conn = worker.conn
+        try:
+            with worker.lock:
+                conn.send(None)
+        except OSError:
+            pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.is_shutdown:
+                raise RuntimeError('Супервизор остановлен')
+            task = (self.next_task_id, fn, args, kwargs)
+            self.next_task_id += 1
+            self.backlog.append((task, future))
+        self._drain_backlog()
+        return future
+
+    def _drain_backlog(self):
+        while True:
+            with self.lock:
+                alive = [w for w in self.workers
+                         if w.conn is not None and not w.retiring]
+                if not self.backlog or not alive:
+                    return
+                task, future = self.backlog.popleft()
+                worker = min(alive, key=lambda w: len(w.pending))
+                worker.pending[task[0]] = future
+                conn = worker.conn
+            try:
+                with worker.lock:
+                    conn.send(task)
+            except OSError:
+                # обработчик завершился, задание будет отклонено в _read_loop
+                pass
+            except Exception as e:  # задание не сериализуется
+                with self.lock:
+                    worker.pending.pop(task[0], None)
+                future.set_exception(e)
+
+    def pids(self):
+        """ Запущенные обработчики: {номер: pid} """
+        with self.lock:
+            return {w.slot: w.pid for w in self.workers if w.conn is not None}
+
+    def stats(self):
+        with self.lock:
+            return {'backlog': len(self.backlog),
+                    'zygote_alive': self.zygote is not None
+                    and self.zygote.is_alive(),
+                    'workers': [w.stats() for w in self.workers]}
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self.lock:
+            self.is_shutdown = True
+            backlog = list(self.backlog)
+            self.backlog.clear()
+        for _, future in backlog:
+            future.cancel()
+
+        for worker in self.workers:
+            if worker.conn is None:
+                continue
+            try:
+                with worker.lock:
+                    worker.conn.send(None)
+            except OSError:
+                pass
+        if self.zygote is not None:
+            try:
+                self.zygote_conn.send(None)
+            except OSError:
+                pass
+            if wait:
+                self.zygote.join()
+        if self.listener is not None:
+            self.listener.close()
+
@@ -0,0 +1,3 @@
+from training.dataset import *
+from training.models import *
+from training.pipeline import *
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# запуск из корня репозитория: python src/training
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from training.pipeline import main
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+from utils import *
+from predict import FeatureEncoder
+
+# Формирование датасета для обучения (train_data.csv) из water_level.csv и
+# weather.csv. Объединение таблиц, кодирование дат и погоды и нормализация
+# выполняются операциями над целыми столбцами сразу для всех постов, а
+# границы нормализации (normalization_info.json) вычисляются в том же
+# проходе. Признаки кодируются тем же FeatureEncoder, что и в боте, поэтому
+# модель обучается на тех же значениях признаков, что получает при
+# предсказании. Кроме признаков бота в датасет добавляются варианты
+# кодирования погоды из notebooks/algo_research.ipynb (v1, v2, v4) для
+# сравнения наборов признаков.
+WEATHER_VARIANTS = ['weather_v1_precip', 'weather_v2_rain', 'weather_v4']
+TRAIN_COLUMNS = ['date'] + FeatureEncoder.FEATURES + WEATHER_VARIANTS + \
+                ['water_level']
+# год в normalization_info.json нормализуется с запасом на будущие годы
+NORMALIZATION_END_YEAR = 2030
+
+
+def load_observations():
+    """ Метео-данные с уровнем воды: строки weather.csv, для которых есть
+    замер уровня воды и нет пропусков, как в notebooks/eda.ipynb
+
+    :return: pandas.DataFrame, отсортированный по uid и дате, uid -
+        категориальный столбец
+    """
+    weather = read_table(DATA_WEATHER, is_raw=True)
+    water_level = read_table(DATA_WATER_LEVEL, is_raw=True,
+                             columns=['uid', 'date', 'water_level'])
+
+    # общие категории uid: объединение и сортировка идут по кодам, а не по
+    # строкам
+    uid_type = pd.CategoricalDtype(sorted(set(weather['uid'].unique()) |
+                                          set(water_level['uid'].unique())))
+    weather['uid'] = weather['uid'].astype(uid_type)
+    water_level['uid'] = water_level['uid'].astype(uid_type)
+
+    df = weather.merge(water_level, on=['uid', 'date']).dropna()
+    return df.sort_values(['uid', 'date'], kind='stable', ignore_index=True)
+
+
+def get_normalization_info(df):
+    """ Границы нормализации признаков в формате normalization_info.json
+
+    :return: строки с мин. и макс. значениями (uid, date, latitude,
+        longitude, temperature, weather, is_fallback_data)
+    """
+    uids = df['uid'].cat.remove_unused_categories().cat.categories
+    bounds = [[df[column].min().item(), df[column].max().item()]
+              for column in ['latitude', 'longitude', 'temperature']]
+    return [[uids[0], f'{START_YEAR}-01-01', *[b[0] for b in bounds],
+             'still', 0],
+            [uids[-1], f'{NORMALIZATION_END_YEAR}-01-01',
+             *[b[1] for b in bounds], 'still', 1]]
+
+
+def build_train_data():
+    """ Формирование датасета для обучения
+
+    :return: (pandas.DataFrame со столбцами TRAIN_COLUMNS, границы
+        нормализации для normalization_info.json)
+    """
+    df = load_observations()
+    norm_info = get_normalization_info(df)
+    encoder = FeatureEncoder(norm_info)
+
+    uid_values = np.array([float(uid) for uid in df['uid'].cat.categories])
+    dates = df['date'].to_numpy(dtype='datetime64[D]')
+    features = encoder.encode_arrays(
+        uid_values[df['uid'].cat.codes.to_numpy()], dates,
+        df['latitude'].to_numpy(), df['longitude'].to_numpy(),
+        df['temperature'].to_numpy(), df['weather'].to_numpy(),
+        df['is_fallback_data'].to_numpy())
+
+    result = pd.DataFrame(features, columns=FeatureEncoder.FEATURES)
+    result.insert(0, 'date', df['date'].to_numpy())
+    snow = features[:, FeatureEncoder.WEATHER['snow']]
+    rain = features[:, FeatureEncoder.WEATHER['rain']]
+    storm = features[:, FeatureEncoder.WEATHER['storm']]
+    result['weather_v1_precip'] = np.fmax(np.fmax(snow, rain), storm)
+    result['weather_v2_rain'] = np.fmax(rain, storm)
+    result['weather_v4'] = rain + 2 * storm + 3 * snow
+    result['water_level'] = df['water_level'].to_numpy(dtype=np.float64)
+    return result, norm_info
+
+
+def save_train_data(df, norm_info):
+    """ Запись датасета в train_data.csv и его колоночную версию, границ
+    нормализации - в normalization_info.json
+    """
+    df.to_csv(get_filepath(DATA_PROCESSED_TRAIN, is_raw=False), index=False)
+    write_table(DATA_PROCESSED_TRAIN, df, is_raw=False)
+    write_data(DATA_NORMALIZATION, data=norm_info, is_raw=True)
+
+
+def load_train_data():
+    return read_table(DATA_PROCESSED_TRAIN, is_raw=False)
@@ -0,0 +1,101 @@
+from predict import FeatureEncoder
+
+# Модели-кандидаты и наборы признаков из notebooks/algo_research.ipynb.
+# Модели создаются функциями без аргументов, чтобы задания можно было
+# передавать в процессы пула. Все модели используют одно ядро (n_jobs=1):
+# параллельность обеспечивается одновременным обучением нескольких моделей.
+RANDOM_STATE = 0
+
+# признаки без кодирования погоды
+BASE_FEATURES = FeatureEncoder.FEATURES[:8]
+FEATURE_SETS = {
+    'v1': BASE_FEATURES + ['weather_v1_precip'],
+    'v2': BASE_FEATURES + ['weather_v2_rain', 'weather_snow'],
+    'v3': FeatureEncoder.FEATURES,  # признаки бота
+    'v4': BASE_FEATURES + ['weather_v4'],
+}
+# набор признаков, на котором обучается модель для бота
+EXPORT_FEATURE_SET = 'v3'
+
+
+def mean_model():
+    from sklearn.dummy import DummyRegressor
+    return DummyRegressor(strategy='mean')
+
+
+def linear_regression():
+    from sklearn.linear_model import LinearRegression
+    return LinearRegression()
+
+
+def ridge():
+    from sklearn.linear_model import Ridge
+    return Ridge()
+
+
+def lasso():
+    from sklearn.linear_model import Lasso
+    return Lasso()
+
+
+def elastic_net():
+    from sklearn.linear_model import ElasticNet
+    return ElasticNet()
+
+
+def decision_tree():
+    from sklearn.tree import DecisionTreeRegressor
+    return DecisionTreeRegressor(random_state=RANDOM_STATE)
+
+
+def random_forest():
+    from sklearn.ensemble import RandomForestRegressor
+    return RandomForestRegressor(random_state=RANDOM_STATE, n_jobs=1)
+
+
+def gbr():
+    from sklearn.ensemble import GradientBoostingRegressor
+    return GradientBoostingRegressor(random_state=RANDOM_STATE)
+
+
+def svr():
+    from sklearn.svm import SVR
+    return SVR()
+
+
+def xgboost():
+    from xgboost import XGBRegressor
+    return XGBRegressor(random_state=RANDOM_STATE, n_jobs=1)
+
+
+def xgboost_tuned():
+    from xgboost import XGBRegressor
+    # параметры, найденные GridSearchCV в notebooks/algo_research.ipynb
+    return XGBRegressor(learning_rate=0.05, min_child_weight=0,
+                        random_state=RANDOM_STATE, n_jobs=1)
+
+
+# название: (функция создания модели, относительная длительность обучения)
+# длительность используется, чтобы долгие задания запускались первыми
+MODELS = {
+    'mean': (mean_model, 0),
+    'linear_regression': (linear_regression, 1),
+    'ridge': (ridge, 1),
+    'lasso': (lasso, 1),
+    'elastic_net': (elastic_net, 1),
+    'decision_tree': (decision_tree, 5),
+    'random_forest': (random_forest, 300),
+    'gbr': (gbr, 100),
+    'svr': (svr, 3000),
+    'xgboost': (xgboost, 30),
+    'xgboost_tuned': (xgboost_tuned, 30),
+}
+# SVR обучается на всём датасете десятки минут, поэтому по умолчанию не
+# используется
+DEFAULT_MODELS = [name for name in MODELS if name != 'svr']
+# модели, которые бот может загрузить (models/xgboost_model.json)
+EXPORTABLE_MODELS = ['xgboost', 'xgboost_tuned']
+
+
+def create_model(name):
+    return MODELS[name][0]()
@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import platform
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from utils import *
+from training.dataset import build_train_data, load_train_data
+from training.dataset import save_train_data
+from training.models import *
+
+# Обучение модели для бота без ноутбуков:
+# 1. формирование train_data.csv (training/dataset.py);
+# 2. матрицы признаков для каждого набора признаков сохраняются в
+#    data\processed\training\features\ - при повторном запуске на тех же
+#    данных они не формируются заново, а процессы пула открывают их через
+#    memory-map вместо передачи копий;
+# 3. все пары (модель, набор признаков) обучаются параллельно в пуле
+#    процессов на данных до TEST_YEAR и проверяются на данных за TEST_YEAR;
+# 4. лучшая по R2 модель, которую может загрузить бот, обучается на всех
+#    данных и сохраняется вместе с манифестом: параметры, метрики, отпечатки
+#    данных, версии библиотек и время этапов.
+TRAINING_DIR = 'training'
+FEATURE_CACHE_DIR = os.path.join(TRAINING_DIR, 'features')
+TRAINING_REPORT = os.path.join(TRAINING_DIR, 'report.json')
+TRAINING_MODEL = os.path.join(TRAINING_DIR, XGBOOST_MODEL)
+TEST_YEAR = END_YEAR  # обучение на 2008-2016, проверка на 2017
+TRAINING_WORKERS = os.cpu_count()
+
+
+def get_data_fingerprint(df):
+    """ Отпечаток содержимого датасета """
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return hashlib.md5(hashes.tobytes()).hexdigest()
+
+
+def get_file_md5(file_path):
+    with open(file_path, mode='rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def cache_features(df, feature_set, fingerprint):
+    """ Матрицы признаков набора feature_set, разделённые на обучающие и
+    тестовые. Формируются, только если их нет в кэше.
+
+    :return: (папка кэша в data\\processed\\, сформированы ли матрицы заново)
+    """
+    columns = FEATURE_SETS[feature_set]
+    key = hashlib.md5('/'.join([fingerprint, str(TEST_YEAR)] + columns)
+                      .encode('utf-8')).hexdigest()[:16]
+    cache_dir = os.path.join(FEATURE_CACHE_DIR, f'{feature_set}-{key}')
+    names = ['X_train.npy', 'y_train.npy', 'X_test.npy', 'y_test.npy']
+    if all(is_data_exists(os.path.join(cache_dir, name), is_raw=False)
+           for name in names):
+        return cache_dir, False
+
+    is_test = (df['date'].dt.year == TEST_YEAR).to_numpy()
+    X = df[columns].to_numpy(dtype=np.float32)
+    y = df['water_level'].to_numpy(dtype=np.float32)
+    for name, data in zip(names, [X[~is_test], y[~is_test], X[is_test],
+                                  y[is_test]]):
+        write_npy(os.path.join(cache_dir, name), np.ascontiguousarray(data),
+                  is_raw=False)
+    return cache_dir, True
+
+
+def _load_features(cache_dir, name):
+    return np.load(get_filepath(os.path.join(cache_dir, name), is_raw=False),
+                   mmap_mode='r')
+
+
+def evaluate_model(model_name, feature_set, cache_dir):
+    """ Обучение модели на данных до TEST_YEAR и оценка на TEST_YEAR.
+    Выполняется в процессе пула.
+
+    :return: словарь с метриками и временем обучения
+    """
+    from sklearn.metrics import mean_absolute_error, r2_score
+
+    X_train = _load_features(cache_dir, 'X_train.npy')
+    y_train = _load_features(cache_dir, 'y_train.npy')
+    X_test = _load_features(cache_dir, 'X_test.npy')
+    y_test = _load_features(cache_dir, 'y_test.npy')
+
+    model = create_model(model_name)
+    start = perf_counter()
+    model.fit(X_train, y_train)
+    fit_time = perf_counter() - start
+    start = perf_counter()
+    predict = model.predict(X_test)
+    predict_time = perf_counter() - start
+    return {'model': model_name,
+            'feature_set': feature_set,
+            'MAE': round(float(mean_absolute_error(y_test, predict)), 3),
+            'R2_score': round(float(r2_score(y_test, predict)), 4),
+            'fit_time': round(fit_time, 3),
+            'predict_time': round(predict_time, 3)}
+
+
+def evaluate(tasks, workers=TRAINING_WORKERS):
+    """ Оценка пар (модель, набор признаков, папка кэша) в пуле процессов
+
+    :param workers: число процессов, 0 - в текущем процессе
+    :return: результаты evaluate_model, отсортированные по убыванию R2
+    """
+    # долгие задания запускаются первыми, чтобы не ждать их в конце
+    tasks = sorted(tasks, key=lambda task: -MODELS[task[0]][1])
+    results = []
+    if workers == 0:
+        for task in tasks:
+            results.append(evaluate_model(*task))
+            _print_result(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(evaluate_model, *task)
+                       for task in tasks]
+            for future in as_completed(futures):
+                results.append(future.result())
+                _print_result(results[-1])
+    return sorted(results, key=lambda result: -result['R2_score'])
+
+
+def _print_result(result):
+    print(f"  {result['model']:18} ({result['feature_set']}): "
+          f"MAE {result['MAE']:8.3f}, R2 {result['R2_score']:.4f}, "
+          f"{result['fit_time']:.1f} с")
+
+
+def export_model(result, cache_dir, output):
+    """ Обучение модели на всех данных и сохранение в формате xgboost
+
+    :return: (обученная модель, число строк для обучения)
+    """
+    columns = FEATURE_SETS[result['feature_set']]
+    X = np.concatenate([_load_features(cache_dir, 'X_train.npy'),
+                        _load_features(cache_dir, 'X_test.npy')])
+    y = np.concatenate([_load_features(cache_dir, 'y_train.npy'),
+                        _load_features(cache_dir, 'y_test.npy')])
+    model = create_model(result['model'])
+    # DataFrame - чтобы в модели сохранились названия признаков
+    model.fit(pd.DataFrame(X, columns=columns), y)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    model.save_model(output)
+    return model, len(y)
+
+
+def get_versions():
+    import sklearn
+    import xgboost
+
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'scikit-learn': sklearn.__version__,
+            'xgboost': xgboost.__version__}
+
+
+def get_manifest_path(model_path):
+    return os.path.splitext(model_path)[0] + '.manifest.json'
+
+
+def main(argv=None):
+    """ Формирование датасета, оценка моделей и сохранение лучшей модели.
+
+    Пример: python src/training --workers 4 --export models/xgboost_model.json
+    """
+    parser = argparse.ArgumentParser(
+        prog='training',
+        description='Обучение модели предсказания уровня воды')
+    parser.add_argument('--skip-build', action='store_true',
+                        help='использовать уже сформированный train_data.csv')
+    parser.add_argument('--models', nargs='+', choices=list(MODELS),
+                        default=DEFAULT_MODELS)
+    parser.add_argument('--feature-sets', nargs='+',
+                        choices=list(FEATURE_SETS),
+                        default=list(FEATURE_SETS))
+    parser.add_argument('--workers', type=int, default=TRAINING_WORKERS,
+                        help='число процессов, 0 - без пула процессов')
+    parser.add_argument('--export', default=None,
+                        help='путь для сохранения модели, по умолчанию '
+                             f'data/processed/{TRAINING_MODEL}')
+    args = parser.parse_args(argv)
+
+    timings = {}
+    total_start = stage_start = perf_counter()
+
+    def finish_stage(name):
+        nonlocal stage_start
+        now = perf_counter()
+        timings[name] = round(now - stage_start, 3)
+        stage_start = now
+        print(f'{name}: {timings[name]:.1f} с')
+
+    if args.skip_build:
+        df = load_train_data()
+    else:
+        df, norm_info = build_train_data()
+        save_train_data(df, norm_info)
+    fingerprint = get_data_fingerprint(df)
+    print(f'Датасет: {len(df)} строк')
+    finish_stage('dataset')
+
+    cache_dirs = {}
+    for feature_set in args.feature_sets:
+        cache_dirs[feature_set], is_new = cache_features(df, feature_set,
+                                                         fingerprint)
+        print(f"  {feature_set}: {'сформирован' if is_new else 'из кэша'}")
+    finish_stage('features')
+
+    tasks = [(model, feature_set, cache_dirs[feature_set])
+             for model in args.models for feature_set in args.feature_sets]
+    print(f'Оценка {len(tasks)} моделей, процессов: {args.workers}')
+    results = evaluate(tasks, workers=args.workers)
+    finish_stage('evaluate')
+    timings['evaluate_cpu'] = round(sum(r['fit_time'] + r['predict_time']
+                                        for r in results), 3)
+
+    report = {'test_year': TEST_YEAR,
+              'train_data_fingerprint': fingerprint,
+              'results': results,
+              'timings': timings}
+    exportable = [r for r in results if r['model'] in EXPORTABLE_MODELS
+                  and r['feature_set'] == EXPORT_FEATURE_SET]
+    if exportable:
+        best = exportable[0]
+        output = args.export or get_filepath(TRAINING_MODEL, is_raw=False)
+        model, rows = export_model(best, cache_dirs[best['feature_set']],
+                                   output)
+        finish_stage('export')
+        timings['total'] = round(perf_counter() - total_start, 3)
+
+        manifest = {'model': best['model'],
+                    # параметры по умолчанию (None, NaN) не сохраняются
+                    'params': {key: value for key, value in
+                               model.get_params().items()
+                               if value is not None and value == value},
+                    'features': FEATURE_SETS[best['feature_set']],
+                    'metrics': {'MAE': best['MAE'],
+                                'R2_score': best['R2_score'],
+                                'test_year': TEST_YEAR},
+                    'train_rows': rows,
+                    'train_data_fingerprint': fingerprint,
+                    'normalization_md5': get_file_md5(
+                        get_filepath(DATA_NORMALIZATION, is_raw=True)),
+                    'model_md5': get_file_md5(output),
+                    'created': datetime.now().isoformat(timespec='seconds'),
+                    'versions': get_versions(),
+                    'leaderboard': results,
+                    'timings': timings}
+        with open(get_manifest_path(output), mode='w',
+                  encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=2)
+        print(f"Модель {best['model']} ({best['feature_set']}) сохранена: "
+              f'{output}')
+    else:
+        print(f'Нет моделей для бота ({", ".join(EXPORTABLE_MODELS)} с '
+              f'набором признаков {EXPORT_FEATURE_SET})')
+        timings['total'] = round(perf_counter() - total_start, 3)
+
+    write_data(TRAINING_REPORT, data=report, is_raw=False)
+    print(f"Общее время: {timings['total']:.1f} с")
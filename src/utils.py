@@ -1,13 +1,18 @@
 import csv
+import errno
 import json
 import os
 import os.path
 import re
-from time import sleep
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from time import monotonic
 
 import requests
 
+from http_client import HttpClient
+
 DATA_WATER_RAW = 'water_data.html'  # данные со всеми наблюдениями
 DATA_POSTS_RAW = 'water_posts_data.json'  # словарь id_поста: локация_поста
 DATA_WATER_LEVEL = 'water_level.csv'  # датасет с данными наблюдений
@@ -23,6 +28,33 @@ DATA_PROCESSED_TRAIN = 'train_data.csv'  # готовый датасет для
 DATA_POSTS_FULL_RAW = 'posts_fulldata.json'
 
 XGBOOST_MODEL = 'xgboost_model.json'
+# способ расчёта предсказаний модели (см. PREDICT_BACKENDS в predict.py):
+# sklearn - XGBRegressor.predict, как при обучении модели;
+# booster - Booster.inplace_predict без обёртки sklearn и создания DMatrix;
+# numpy   - обход деревьев из xgboost_model.json средствами numpy, без
+#           импорта xgboost
+PREDICT_BACKEND_NAMES = ['sklearn', 'booster', 'numpy']
+PREDICT_BACKEND = 'booster'
+
+# качество PNG графиков по умолчанию, в боте задаётся параметрами запуска
+# --chart-dpi и --chart-compress-level
+CHART_DPI = 100
+# уровень сжатия PNG (0-9): меньше - быстрее кодирование, больше - меньше файл
+CHART_COMPRESS_LEVEL = 6
+
+# Табличные данные (DATA_WATER_LEVEL, DATA_WEATHER, DATA_WATER_STATS,
+# DATA_PROCESSED_TRAIN) формируются в csv, а для быстрой загрузки могут быть
+# сконвертированы (src/convert_tables.py) в колоночный формат рядом с csv:
+# water_level.csv -> water_level.parquet. В колоночном формате сохраняются
+# типы столбцов и можно загружать только нужные столбцы. read_table
+# загружает колоночный файл, если он не старше csv, иначе - csv.
+TABLE_FORMATS = ['.parquet', '.feather']  # в порядке приоритета при загрузке
+TABLE_FORMAT = '.parquet'
+# типы столбцов при загрузке csv: без них uid '09386' читается как 9386
+TABLE_DTYPES = {DATA_WATER_LEVEL: {'uid': str},
+                DATA_WEATHER: {'uid': str},
+                DATA_WATER_STATS: {'uid': str}}
+TABLE_DATE_COLUMNS = ['date']  # столбцы с датами в формате ГГГГ-ММ-ДД
 
 # для получения данных к некоторым сайтам (gismeteo) нужно имитировать браузер
 DEFAULT_HEADER = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
@@ -30,8 +62,19 @@ DEFAULT_HEADER = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
                                 'Chrome/102.0.5005.63 Safari/537.36'}
 START_YEAR = 2008
 END_YEAR = 2017
+PREDICT_START_YEAR = 2018  # первый год, доступный для предсказания в боте
 WAIT_SLEEP_TIME = 2
 
+# ограничение частоты запросов, чтобы не перегрузить сайты (запросов в секунду)
+HOST_RATES = {'www.gismeteo.ru': 1 / WAIT_SLEEP_TIME,
+              'gmvo.skniivh.ru': 1.0}
+
+# секунд, наибольшее ожидание блокировки файла (file_lock) на Windows, после
+# которого выбрасывается исключение
+FILE_LOCK_TIMEOUT = 60
+
+_http_client = HttpClient(headers=DEFAULT_HEADER, host_rates=HOST_RATES)
+
 
 def format_data(year, month, day):
     return f'{year}-{month:02d}-{day:02d}'
@@ -39,21 +82,12 @@ def format_data(year, month, day):
 
 # requests methods
 def get_url(url, params=None, cookies=None):
-    r = requests.get(url, params=params, cookies=cookies,
-                     headers=DEFAULT_HEADER)
-    r.raise_for_status()
-    sleep(WAIT_SLEEP_TIME)  # ждём, чтобы не перегрузить сайт запросами
-
-    return r
+    return _http_client.get(url, params=params, cookies=cookies)
 
 
 def post_url(url, data=None, cookies=None, allow_redirects=True):
-    r = requests.post(url, data=data, cookies=cookies,
-                      allow_redirects=allow_redirects, headers=DEFAULT_HEADER)
-    r.raise_for_status()
-    sleep(1)  # ждём, чтобы не перегрузить сайт запросами
-
-    return r
+    return _http_client.post(url, data=data, cookies=cookies,
+                             allow_redirects=allow_redirects)
 
 
 # file methods
@@ -81,15 +115,6 @@ def is_data_exists(file_name, is_raw=True):
     return False
 
 
-def _delete_if_exist(file_path, is_raw):
-    if is_data_exists(file_path, is_raw):
-        os.remove(file_path)
-    else:
-        # создание директорий при необходимости
-        base_dir = os.path.split(file_path)[0]
-        os.makedirs(base_dir, exist_ok=True)
-
-
 def open_file(file_name, is_raw):
     """ Открыть файл
 
@@ -119,33 +144,192 @@ def write_data(file_name, data, is_raw):
         processed
     :return:
     """
-    file_path = get_filepath(file_name, is_raw)
-    _delete_if_exist(file_path, is_raw)
-
     if type(data) == list or type(data) == dict:
         data = json.dumps(data, ensure_ascii=False)
 
-    with open(file_path, mode='w', encoding='utf-8') as file:
-        file.write(data)
+    # запись с заменой: прерванная запись не оставляет недописанный файл,
+    # который не удастся прочитать при следующем запуске
+    with replace_file(file_name, is_raw) as tmp_path:
+        with open(tmp_path, mode='w', encoding='utf-8') as file:
+            file.write(data)
+
+
+@contextmanager
+def replace_file(file_name, is_raw):
+    """ Запись файла через временный файл с заменой:
+    with replace_file(file_name, is_raw) as tmp_path: ...
+    Читатели видят либо прежний, либо полностью записанный файл, при ошибке
+    прежний файл не изменяется.
+
+    :param file_name: название файла с данными
+    :param is_raw: сырые ли данные? если да - смотреть в папке raw, иначе в
+        processed
+    :return: путь к временному файлу, в который нужно записать данные
+    """
+    file_path = get_filepath(file_name, is_raw)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # имя временного файла своё у каждого процесса и потока
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, file_path)
 
 
 def write_csv(file_name, header, data, is_raw):
     """ Записать данные в csv файл
 
+    Запись идёт во временный файл с заменой, поэтому при ошибке во время
+    формирования данных (data - генератор) прежний файл не изменяется, а
+    недописанный не появляется.
+
     :param file_name: название файла с данными
     :param header: заголовок с названиями столбцов
-    :param data: данные для записи (list)
+    :param data: данные для записи (list или генератор строк)
     :param is_raw: сырые ли данные? если да - смотреть в папке raw, иначе в
         processed
     :return:
     """
-    file_path = get_filepath(file_name, is_raw)
-    _delete_if_exist(file_path, is_raw)
+    with replace_file(file_name, is_raw) as tmp_path:
+        with open(tmp_path, mode='w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+            writer.writerows(data)
+
 
-    with open(file_path, mode='w', encoding='utf-8', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(header)
-        writer.writerows(data)
+def write_npy(file_name, data, is_raw):
+    """ Записать numpy массив в файл .npy
+
+    Запись идёт во временный файл с заменой, чтобы не испортить массив,
+    открытый через memory-map в работающем боте.
+
+    :param file_name: название файла с данными
+    :param data: numpy массив
+    :param is_raw: сырые ли данные? если да - смотреть в папке raw, иначе в
+        processed
+    :return:
+    """
+    import numpy as np
+
+    with replace_file(file_name, is_raw) as tmp_path:
+        with open(tmp_path, mode='wb') as file:
+            np.save(file, data)
+
+
+@contextmanager
+def file_lock(file_name, is_raw):
+    """ Блокировка файла между процессами на время чтения, изменения и
+    записи: with file_lock(file_name, is_raw): ...
+    Блокируется отдельный файл <file_name>.lock, т.к. сам файл заменяется
+    при записи.
+    """
+    lock_path = get_filepath(file_name, is_raw) + '.lock'
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, mode='a+b') as file:
+        if os.name == 'nt':
+            import msvcrt
+            file.seek(0)
+            # LK_LOCK сам повторяет попытку 10 раз с интервалом в секунду,
+            # затем выбрасывает EDEADLOCK - тогда ожидание продолжается до
+            # FILE_LOCK_TIMEOUT; остальные ошибки не связаны с блокировкой
+            deadline = monotonic() + FILE_LOCK_TIMEOUT
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EDEADLOCK, errno.EACCES) \
+                            or monotonic() >= deadline:
+                        raise
+            try:
+                yield
+            finally:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def get_table_path(file_name, is_raw):
+    """ Путь к файлу таблицы, который будет загружен read_table:
+    колоночному, если он не старше csv, иначе к csv
+
+    :param file_name: название csv файла с данными
+    :param is_raw: сырые ли данные? если да - смотреть в папке raw, иначе в
+        processed
+    :return:
+    """
+    csv_path = get_filepath(file_name, is_raw)
+    csv_mtime = None
+    if os.path.isfile(csv_path):
+        csv_mtime = os.path.getmtime(csv_path)
+    for extension in TABLE_FORMATS:
+        file_path = os.path.splitext(csv_path)[0] + extension
+        if os.path.isfile(file_path) and (
+                csv_mtime is None or os.path.getmtime(file_path) >= csv_mtime):
+            return file_path
+    return csv_path
+
+
+def read_table(file_name, is_raw, columns=None):
+    """ Загрузить таблицу в pandas.DataFrame
+
+    :param file_name: название csv файла с данными
+    :param is_raw: сырые ли данные? если да - смотреть в папке raw, иначе в
+        processed
+    :param columns: список загружаемых столбцов, None - все столбцы
+    :return:
+    """
+    import pandas as pd
+
+    file_path = get_table_path(file_name, is_raw)
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path, columns=columns)
+    if file_path.endswith('.feather'):
+        return pd.read_feather(file_path, columns=columns)
+
+    # round_trip - значения float совпадают с записанными в csv
+    df = pd.read_csv(file_path, usecols=columns,
+                     dtype=TABLE_DTYPES.get(file_name),
+                     float_precision='round_trip')
+    for column in TABLE_DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], format='%Y-%m-%d')
+    return df
+
+
+def write_table(file_name, df, is_raw, table_format=TABLE_FORMAT):
+    """ Записать таблицу в колоночном формате рядом с csv файлом
+
+    :param file_name: название csv файла с данными
+    :param df: pandas.DataFrame
+    :param is_raw: сырые ли данные? если да - смотреть в папке raw, иначе в
+        processed
+    :param table_format: формат из TABLE_FORMATS
+    :return: путь к записанному файлу
+    """
+    if table_format not in TABLE_FORMATS:
+        raise ValueError(f'Неизвестный формат таблицы: {table_format}')
+
+    file_path = os.path.splitext(get_filepath(file_name, is_raw))[0] + \
+        table_format
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    tmp_path = file_path + '.tmp'
+    df = df.reset_index(drop=True)
+    if table_format == '.parquet':
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_feather(tmp_path)
+    os.replace(tmp_path, file_path)
+    return file_path
 
 
 def get_xgboost_path():
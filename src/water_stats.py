@@ -0,0 +1,91 @@
+import logging
+
+import numpy as np
+
+from utils import *
+
+# Статистика уровня воды (мин., среднее, макс.) по дням года для каждого поста.
+# Загружается один раз в плотный массив (пост, день года, статистика) с
+# индексом uid: строка массива, поэтому статистика за месяц - срез массива без
+# поиска по DataFrame и merge.
+#
+# water_stats.npy        - float64 массив (пост, 366, 3), NaN - нет данных
+# water_stats_index.json - порядок uid постов
+# Файлы формируются из water_stats.csv и открываются через memory-map, поэтому
+# процессы-обработчики бота используют одну копию данных в памяти.
+WATER_STATS_VALUES = 'water_stats.npy'
+WATER_STATS_INDEX = 'water_stats_index.json'
+WATER_STATS_COLUMNS = ['min', 'mean', 'max']
+DAYS_IN_YEAR = 366
+
+logger = logging.getLogger(__name__)
+
+
+class WaterStats:
+    def __init__(self, uids, values):
+        """
+        :param uids: список uid постов в порядке строк values
+        :param values: массив (пост, день года - 1, [min, mean, max])
+        """
+        self.uids = {uid: i for i, uid in enumerate(uids)}
+        self.values = values
+
+    @classmethod
+    def from_csv(cls):
+        """ Формирование статистики из water_stats.csv (или его колоночной
+        версии, см. read_table)
+        """
+        import pandas as pd
+
+        df = read_table(DATA_WATER_STATS, is_raw=False,
+                        columns=['uid', 'day_of_year'] + WATER_STATS_COLUMNS)
+        rows, uids = pd.factorize(df['uid'])
+        values = np.full((len(uids), DAYS_IN_YEAR, len(WATER_STATS_COLUMNS)),
+                         np.nan, dtype=np.float64)
+        values[rows, df['day_of_year'].to_numpy() - 1] = \
+            df[WATER_STATS_COLUMNS].to_numpy(dtype=np.float64)
+        return cls(list(uids), values)
+
+    @classmethod
+    def load(cls):
+        """ Загрузка статистики через memory-map. Если файлы не сформированы
+        или water_stats.csv изменился, они формируются заново.
+        """
+        table_path = get_table_path(DATA_WATER_STATS, is_raw=False)
+        values_path = get_filepath(WATER_STATS_VALUES, is_raw=False)
+        if not is_data_exists(WATER_STATS_INDEX, is_raw=False) or \
+                os.path.getmtime(values_path) < os.path.getmtime(table_path):
+            logger.info('Формирование %s', WATER_STATS_VALUES)
+            cls.from_csv().save()
+
+        index = json.loads(open_file(WATER_STATS_INDEX, is_raw=False))
+        return cls(index['uids'], np.load(values_path, mmap_mode='r'))
+
+    def save(self):
+        uids = sorted(self.uids, key=self.uids.get)
+        write_npy(WATER_STATS_VALUES, np.asarray(self.values), is_raw=False)
+        # индекс записывается последним - без него массив не используется
+        write_data(WATER_STATS_INDEX, data={'uids': uids}, is_raw=False)
+
+    def get(self, uid, day_of_year):
+        """ Статистика поста по дням года
+
+        :param uid: uid поста
+        :param day_of_year: массив дней года (1-366)
+        :return: массив (день, [min, mean, max]), NaN - нет данных
+        """
+        day_of_year = np.asarray(day_of_year, dtype=np.int64)
+        if uid not in self.uids:
+            return np.full((len(day_of_year), len(WATER_STATS_COLUMNS)),
+                           np.nan)
+        return self.values[self.uids[uid], day_of_year - 1]
+
+
+def main():
+    """ Формирование water_stats.npy из water_stats.csv """
+    WaterStats.from_csv().save()
+    print(f'{WATER_STATS_VALUES} сформирован')
+
+
+if __name__ == '__main__':
+    main()
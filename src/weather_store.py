@@ -0,0 +1,324 @@
+import sys
+import threading
+import zlib
+from time import time
+
+import numpy as np
+
+from utils import *
+
+# Хранилище разобранных метео-данных Gismeteo. Вместо разбора html-страниц
+# из data\raw\gismeteo\ через BeautifulSoup на каждый запрос строки таблицы
+# (день, температура, погода) хранятся в одном бинарном файле на каждый
+# город: data\processed\gismeteo\<id_гисметео>.npy
+#
+# Месяц без данных (страница с empty_phrase) хранится одной строкой с day = 0.
+#
+# Для незавершённых месяцев (текущего и загруженных до их окончания) в
+# data\processed\gismeteo\freshness.json хранится время загрузки и последний
+# загруженный день. Такой месяц загружается повторно не чаще раза в
+# REFRESH_TTL, пока не будет загружен позже FINAL_DELAY после окончания
+# месяца - после этого данные считаются окончательными, а запись удаляется.
+# Месяцы без записи (в том числе загруженные до её появления) считаются
+# окончательными, если они закончились.
+WEATHER_STORE_DIR = 'gismeteo'
+FRESHNESS_FILE = os.path.join(WEATHER_STORE_DIR, 'freshness.json')
+REFRESH_TTL = 3 * 60 * 60  # секунд
+FINAL_DELAY = 24 * 60 * 60  # секунд, вечерние данные последнего дня месяца
+WEATHER_CODES = ['clear', 'rain', 'snow', 'storm',
+                 'sun', 'sunc', 'suncl', 'dull']
+NO_TEMPERATURE = np.iinfo(np.int16).min  # за день нет информации
+# погода не из WEATHER_CODES (новая картинка на сайте или нет информации за
+# день), возвращается как None и не кодируется в признаки
+UNKNOWN_WEATHER = -1
+
+RECORD_DTYPE = np.dtype([('month', np.int32),  # год * 12 + месяц - 1
+                         ('day', np.int8),
+                         ('temperature', np.int16),
+                         ('weather', np.int8)])
+
+_stations = {}  # id_гисметео: (время изменения файла, массив)
+_freshness = (None, {})  # (время изменения файла, данные freshness.json)
+_lock = threading.Lock()
+
+
+def get_store_filename(gismeteo_id):
+    return os.path.join(WEATHER_STORE_DIR, f'{gismeteo_id}.npy')
+
+
+def _month_key(year, month):
+    return year * 12 + month - 1
+
+
+def _load_station(gismeteo_id):
+    """ Записи города, загруженные в память. Файл перечитывается только при
+    его изменении.
+    """
+    file_path = get_filepath(get_store_filename(gismeteo_id), is_raw=False)
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return np.empty(0, dtype=RECORD_DTYPE)
+
+    cached = _stations.get(gismeteo_id)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    records = np.load(file_path)
+    _stations[gismeteo_id] = (mtime, records)
+    return records
+
+
+def _load_freshness():
+    """ Данные freshness.json: '<id_гисметео>/<год>-<месяц>':
+    [время загрузки, последний загруженный день]
+    """
+    global _freshness
+    file_path = get_filepath(FRESHNESS_FILE, is_raw=False)
+    try:
+        mtime = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    if _freshness[0] != mtime:
+        with open(file_path, mode='r', encoding='utf-8') as file:
+            _freshness = (mtime, json.load(file))
+    return _freshness[1]
+
+
+def _save_freshness(data):
+    global _freshness
+    file_path = get_filepath(FRESHNESS_FILE, is_raw=False)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    # запись с заменой: процессы-обработчики читают файл одновременно
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, file_path)
+    _freshness = (None, {})
+
+
+def _freshness_key(gismeteo_id, year, month):
+    return f'{gismeteo_id}/{year}-{month:02d}'
+
+
+def _final_after(year, month):
+    """ Время, после которого данные за месяц считаются окончательными """
+    next_month = datetime(year + month // 12, month % 12 + 1, 1)
+    return next_month.timestamp() + FINAL_DELAY
+
+
+def get_freshness(gismeteo_id, year, month):
+    """ Время загрузки и последний загруженный день незавершённого месяца
+
+    :return: [время загрузки, последний день] или None, если месяц
+        окончательный или загружен до появления freshness.json
+    """
+    return _load_freshness().get(_freshness_key(gismeteo_id, year, month))
+
+
+def is_stale(gismeteo_id, year, month, now=None):
+    """ Нужно ли загрузить месяц повторно: данные за месяц ещё не
+    окончательные и загружены раньше, чем REFRESH_TTL назад
+    """
+    now = now or time()
+    freshness = get_freshness(gismeteo_id, year, month)
+    if freshness is None:
+        # месяц загружен до его окончания, но без записи о свежести
+        return now < _final_after(year, month)
+    return now - freshness[0] > REFRESH_TTL
+
+
+def _find_month(records, year, month):
+    key = _month_key(year, month)
+    start = np.searchsorted(records['month'], key, side='left')
+    end = np.searchsorted(records['month'], key, side='right')
+    return records[start:end]
+
+
+def has_month(gismeteo_id, year, month):
+    return len(_find_month(_load_station(gismeteo_id), year, month)) > 0
+
+
+def get_month(gismeteo_id, year, month):
+    """ Разобранные строки таблицы Gismeteo за месяц
+
+    :return: (есть ли месяц в хранилище, строки [день, температура, погода]
+        или None, если за месяц нет данных)
+    """
+    records = _find_month(_load_station(gismeteo_id), year, month)
+    if len(records) == 0:
+        return False, None
+    if records[0]['day'] == 0:
+        return True, None
+    return True, [[int(day),
+                   None if temperature == NO_TEMPERATURE else int(temperature),
+                   None if weather == UNKNOWN_WEATHER
+                   else WEATHER_CODES[weather]]
+                  for day, temperature, weather in zip(records['day'],
+                                                       records['temperature'],
+                                                       records['weather'])]
+
+
+def get_month_records(gismeteo_id, months):
+    """ Записи города сразу за несколько месяцев с одним чтением файла
+
+    :param months: список (год, месяц)
+    :return: словарь (год, месяц): записи RECORD_DTYPE, месяцев без записей
+        в хранилище нет в словаре
+    """
+    records = _load_station(gismeteo_id)
+    keys = [_month_key(year, month) for year, month in months]
+    starts = np.searchsorted(records['month'], keys, side='left')
+    ends = np.searchsorted(records['month'], keys, side='right')
+    return {key: records[start:end]
+            for key, start, end in zip(months, starts, ends) if end > start}
+
+
+def get_month_version(gismeteo_id, year, month):
+    """ Контрольная сумма записей месяца, '-' если месяца нет в хранилище """
+    records = _find_month(_load_station(gismeteo_id), year, month)
+    if len(records) == 0:
+        return '-'
+    return str(zlib.crc32(records.tobytes()))
+
+
+def _to_records(year, month, rows):
+    if not rows:
+        records = np.zeros(1, dtype=RECORD_DTYPE)
+        records['month'] = _month_key(year, month)
+        return records
+
+    records = np.empty(len(rows), dtype=RECORD_DTYPE)
+    records['month'] = _month_key(year, month)
+    for i, (day, temperature, weather) in enumerate(rows):
+        records[i] = (records[i]['month'], day,
+                      NO_TEMPERATURE if temperature is None else temperature,
+                      WEATHER_CODES.index(weather) if weather in WEATHER_CODES
+                      else UNKNOWN_WEATHER)
+    return records
+
+
+def put_months(gismeteo_id, months):
+    """ Запись разобранных данных за несколько месяцев
+
+    :param gismeteo_id: id города в Gismeteo
+    :param months: словарь (год, месяц): строки [день, температура, погода]
+        или None, если за месяц нет данных
+    :return:
+    """
+    # чтение, изменение и запись файла города могут одновременно выполняться
+    # в нескольких процессах (бот, процессы-обработчики, backfill.py)
+    with _lock, file_lock(get_store_filename(gismeteo_id), is_raw=False):
+        records = _load_station(gismeteo_id)
+        keys = [_month_key(year, month) for year, month in months]
+        records = records[~np.isin(records['month'], keys)]
+        new_records = [_to_records(year, month, rows)
+                       for (year, month), rows in months.items()]
+        records = np.concatenate([records] + new_records)
+        records = records[np.argsort(records['month'], kind='stable')]
+
+        write_npy(get_store_filename(gismeteo_id), records, is_raw=False)
+        _stations.pop(gismeteo_id, None)
+
+
+def put_month(gismeteo_id, year, month, rows, fetched=None):
+    """ Запись разобранных данных за месяц
+
+    :param rows: строки [день, температура, погода] или None
+    :param fetched: время загрузки страницы с сайта (timestamp), для
+        незавершённых месяцев сохраняется в freshness.json; None - страница
+        взята из html-кэша
+    :return:
+    """
+    put_months(gismeteo_id, {(year, month): rows})
+    if fetched is not None:
+        _set_freshness(gismeteo_id, year, month, rows, fetched)
+
+
+def merge_month(gismeteo_id, year, month, rows, fetched):
+    """ Дополнение незавершённого месяца повторно загруженными данными.
+    Заменяются только дни начиная с последнего загруженного (его данные за
+    вечер могли появиться позже), остальные дни остаются без изменений.
+    Если данные не изменились, записи месяца не перезаписываются и его
+    версия (get_month_version) не меняется.
+
+    :param rows: строки [день, температура, погода] или None
+    :param fetched: время загрузки страницы с сайта (timestamp)
+    :return: строки месяца после объединения или None
+    """
+    _, stored = get_month(gismeteo_id, year, month)
+    freshness = get_freshness(gismeteo_id, year, month)
+    stored = stored or []
+    if freshness is not None:
+        last_day = freshness[1]
+    else:
+        last_day = stored[-1][0] if stored else 0
+
+    merged = [row for row in stored if row[0] < last_day] + \
+             [row for row in rows or [] if row[0] >= last_day]
+    merged = merged or None
+    if merged != (stored or None):
+        put_months(gismeteo_id, {(year, month): merged})
+    _set_freshness(gismeteo_id, year, month, merged, fetched)
+    return merged
+
+
+def _set_freshness(gismeteo_id, year, month, rows, fetched):
+    key = _freshness_key(gismeteo_id, year, month)
+    with _lock, file_lock(FRESHNESS_FILE, is_raw=False):
+        data = dict(_load_freshness())
+        if fetched >= _final_after(year, month):
+            if key not in data:
+                return
+            data.pop(key)
+        else:
+            data[key] = [fetched, rows[-1][0] if rows else 0]
+        _save_freshness(data)
+
+
+def main():
+    """ Перенос уже загруженных html-страниц Gismeteo из data\\raw\\gismeteo\\
+    в хранилище разобранных метео-данных.
+
+    Параметры запуска:
+    --remove-html - удалить html-страницы после переноса
+    """
+    from bs4 import BeautifulSoup
+    from gismeteo_parse import parse_gismeteo_table, release_html
+
+    remove_html = '--remove-html' in sys.argv[1:]
+    html_dir = get_filepath('gismeteo', is_raw=True)
+    html_size, store_size = 0, 0
+    for gismeteo_id in sorted(os.listdir(html_dir)):
+        station_dir = os.path.join(html_dir, gismeteo_id)
+        if not os.path.isdir(station_dir):
+            continue
+
+        months = {}
+        for file_name in sorted(os.listdir(station_dir)):
+            match = re.match(r'(\d{4})-(\d{2})\.html$', file_name)
+            if not match:
+                continue
+            file_path = os.path.join(station_dir, file_name)
+            html_size += os.path.getsize(file_path)
+            with open(file_path, mode='r', encoding='utf-8') as file:
+                soup = BeautifulSoup(file.read(), 'lxml')
+            year, month = int(match.group(1)), int(match.group(2))
+            months[(year, month)] = parse_gismeteo_table(
+                gismeteo_id, year, month, soup)
+            release_html(soup)
+
+        put_months(int(gismeteo_id), months)
+        store_size += os.path.getsize(get_filepath(
+            get_store_filename(gismeteo_id), is_raw=False))
+        if remove_html:
+            for year, month in months:
+                os.remove(os.path.join(station_dir, f'{year}-{month:02d}.html'))
+        print(f'{gismeteo_id}: перенесено месяцев - {len(months)}')
+
+    print(f'Размер html: {html_size / 2 ** 20:.1f} МБ, '
+          f'хранилища: {store_size / 2 ** 20:.2f} МБ')
+
+
+if __name__ == '__main__':
+    main()